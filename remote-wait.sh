@@ -1,12 +1,25 @@
 #!/bin/sh
 set -e
 
+# Retry after a short delay first, doubling up to $UVTOOL_WAIT_INTERVAL
+delay=0.05
+backoff() {
+	sleep $delay
+	delay=`awk -v d=$delay -v m=${UVTOOL_WAIT_INTERVAL:-1} \
+		'BEGIN { d *= 2; print (d > m) ? m : d }'`
+}
+
 # Wait for runlevel 2 (upstart) or 5 (systemd)
 while :; do
 	runlevel=`runlevel|awk '{print $2}'`
 	[ "$runlevel" = 2 -o "$runlevel" = 5 ] && break
-	sleep $UVTOOL_WAIT_INTERVAL
+	backoff
 done
 
-# Wait for cloud-init's signal
-while [ ! -e /var/lib/cloud/instance/boot-finished ]; do sleep $UVTOOL_WAIT_INTERVAL; done
+# Wait for cloud-init's signal. Newer cloud-init can block on this itself;
+# it fails if cloud-init reported errors or is too old to support --wait,
+# so the loop below remains the final check either way.
+if [ ! -e /var/lib/cloud/instance/boot-finished ]; then
+	cloud-init status --wait >/dev/null 2>&1 || true
+fi
+while [ ! -e /var/lib/cloud/instance/boot-finished ]; do backoff; done
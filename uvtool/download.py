@@ -0,0 +1,347 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Resumable HTTP downloads using parallel Range requests.
+
+A download of url to path keeps its data in path.part and its progress in
+path.state while it runs. The file is split into fixed size segments, each
+fetched with its own Range request over a small set of keep-alive
+connections. A segment is only recorded as done once its data has been
+synced to disk, so an interrupted download picks up where it left off when
+run again. The completed file is renamed into place only after its size and
+checksum have been verified.
+
+Servers that do not support Range requests are downloaded sequentially
+instead, without the ability to resume.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import httplib
+import json
+import os
+import re
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+import uvtool.parallel
+
+DEFAULT_CONNECTIONS = 4
+SEGMENT_SIZE = 16 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+MAX_ATTEMPTS = 5
+MAX_REDIRECTS = 5
+RETRY_DELAY = 1
+TIMEOUT = 60
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+def supports(url):
+    """Return True if url can be fetched by this module."""
+    return urlparse.urlsplit(url).scheme in ['http', 'https']
+
+
+def _connect(url):
+    """Return an HTTP(S)Connection for url and the request target to use.
+
+    Honour the same proxy environment variables as urllib.
+
+    """
+    parts = urlparse.urlsplit(url)
+    if parts.scheme == 'https':
+        connection_class = httplib.HTTPSConnection
+    else:
+        connection_class = httplib.HTTPConnection
+    target = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+    proxy = urllib.getproxies().get(parts.scheme)
+    if proxy and not urllib.proxy_bypass(parts.hostname):
+        proxy_netloc = urlparse.urlsplit(proxy).netloc or proxy
+        if parts.scheme == 'https':
+            conn = connection_class(proxy_netloc, timeout=TIMEOUT)
+            conn.set_tunnel(parts.hostname, parts.port)
+        else:
+            conn = connection_class(proxy_netloc, timeout=TIMEOUT)
+            target = url
+    else:
+        conn = connection_class(parts.hostname, parts.port, timeout=TIMEOUT)
+    return conn, target
+
+
+def _read_exactly(response, fobj, length):
+    """Copy exactly length bytes of response body into fobj."""
+    while length:
+        data = response.read(min(READ_SIZE, length))
+        if not data:
+            # An HTTPException, so that the range is retried
+            raise httplib.IncompleteRead(b'', length)
+        fobj.write(data)
+        length -= len(data)
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def _unlink_if_exists(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class Download(object):
+    """A resumable download of url to path.
+
+    size and sha256, if known in advance, are checked against what the
+    server provides. connections is the maximum number of Range requests in
+    flight at once.
+
+    """
+
+    def __init__(self, url, path, size=None, sha256=None,
+            connections=DEFAULT_CONNECTIONS, segment_size=SEGMENT_SIZE):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.connections = connections
+        self.segment_size = segment_size
+        self.part_path = path + '.part'
+        self.state_path = path + '.state'
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open_connections = []
+
+    def discard(self):
+        """Remove the downloaded file and any partial download state."""
+        for path in [self.path, self.part_path, self.state_path]:
+            _unlink_if_exists(path)
+
+    def fetch(self):
+        """Download the file if necessary and return its path."""
+        if self.sha256 and os.path.exists(self.path):
+            # Only ever renamed into place after verification, and named
+            # by the caller after its content, so this is already done.
+            return self.path
+
+        try:
+            response, url = self._probe()
+            try:
+                if response.status == 206:
+                    self._fetch_ranges(url, response)
+                else:
+                    self._fetch_sequential(response)
+            finally:
+                response.close()
+            self._verify()
+        finally:
+            self._close_connections()
+
+        os.rename(self.part_path, self.path)
+        _unlink_if_exists(self.state_path)
+        return self.path
+
+    def _open(self, url):
+        conn, target = _connect(url)
+        with self._lock:
+            self._open_connections.append(conn)
+        return conn, target
+
+    def _close_connections(self):
+        with self._lock:
+            connections, self._open_connections = self._open_connections, []
+        for conn in connections:
+            conn.close()
+
+    def _probe(self):
+        """Find out the size of the file and whether ranges are supported.
+
+        Ask for the first byte only. A server that supports ranges answers
+        with a 206 and the total size in Content-Range; one that does not
+        answers with a 200 and the whole file, which is then used directly.
+        Redirects are followed.
+
+        """
+        url = self.url
+        for _ in range(MAX_REDIRECTS + 1):
+            conn, target = self._open(url)
+            conn.request('GET', target, headers={'Range': 'bytes=0-0'})
+            response = conn.getresponse()
+            if response.status in [301, 302, 303, 307, 308]:
+                location = response.getheader('location')
+                response.read()
+                if not location:
+                    break
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.status not in [200, 206]:
+                break
+            return response, url
+        raise DownloadError(
+            "Unable to fetch %s: %s %s" %
+            (self.url, response.status, response.reason)
+        )
+
+    def _check_size(self, size):
+        if self.size is not None and size != self.size:
+            raise DownloadError(
+                "%s has size %d, expected %d" % (self.url, size, self.size))
+
+    def _fetch_sequential(self, response):
+        length = response.getheader('content-length')
+        if length is not None:
+            self._check_size(int(length))
+        _unlink_if_exists(self.state_path)
+        with open(self.part_path, 'wb') as f:
+            while True:
+                data = response.read(READ_SIZE)
+                if not data:
+                    break
+                f.write(data)
+
+    def _load_state(self, size, validator):
+        """Return the set of segments already downloaded, if still valid."""
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return set()
+        if (state.get('size') != size or
+                state.get('validator') != validator or
+                state.get('segment_size') != self.segment_size or
+                not os.path.exists(self.part_path)):
+            return set()
+        return set(state.get('done', []))
+
+    def _save_state(self, size, validator, done):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            json.dump({
+                'url': self.url,
+                'size': size,
+                'validator': validator,
+                'segment_size': self.segment_size,
+                'done': sorted(done),
+            }, f)
+        os.rename(tmp_path, self.state_path)
+
+    def _fetch_ranges(self, url, response):
+        response.read()
+        match = CONTENT_RANGE_RE.match(
+            response.getheader('content-range', ''))
+        if not match:
+            raise DownloadError(
+                "Unexpected Content-Range from %s: %r" %
+                (url, response.getheader('content-range')))
+        size = int(match.group(3))
+        self._check_size(size)
+        validator = (
+            response.getheader('etag') or response.getheader('last-modified'))
+
+        done = self._load_state(size, validator)
+        if not done:
+            with open(self.part_path, 'wb') as f:
+                f.truncate(size)
+            self._save_state(size, validator, done)
+
+        segment_count = (size + self.segment_size - 1) // self.segment_size
+        pending = [i for i in range(segment_count) if i not in done]
+
+        def fetch_segment(index):
+            start = index * self.segment_size
+            end = min(start + self.segment_size, size) - 1
+            self._fetch_range(url, start, end, validator)
+            with self._lock:
+                done.add(index)
+                self._save_state(size, validator, done)
+
+        jobs = uvtool.parallel.run_all(
+            fetch_segment, pending, max(1, min(self.connections, len(pending))))
+        for job in jobs:
+            if job.exception is not None:
+                raise job.exception
+
+    def _fetch_range(self, url, start, end, validator):
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+        if validator:
+            # If the file changes under us, the server sends the whole new
+            # file instead of a range, which we refuse below.
+            headers['If-Range'] = validator
+        for attempt in range(MAX_ATTEMPTS):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn, self._local.target = self._open(url)
+                self._local.conn = conn
+            try:
+                conn.request('GET', self._local.target, headers=headers)
+                response = conn.getresponse()
+                if response.status != 206:
+                    response.read()
+                    raise DownloadError(
+                        "%s changed during download (%s %s)" %
+                        (self.url, response.status, response.reason))
+                with open(self.part_path, 'r+b') as f:
+                    f.seek(start)
+                    _read_exactly(response, f, end - start + 1)
+                    f.flush()
+                    os.fsync(f.fileno())
+                return
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                self._local.conn = None
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise DownloadError(
+                        "Failed to fetch bytes %d-%d of %s: %s" %
+                        (start, end, self.url, e))
+                time.sleep(RETRY_DELAY)
+
+    def _verify(self):
+        size = os.stat(self.part_path).st_size
+        try:
+            self._check_size(size)
+            if self.sha256:
+                found = _hash_file(self.part_path)
+                if found != self.sha256:
+                    raise DownloadError(
+                        "Checksum mismatch for %s: expected %s, got %s" %
+                        (self.url, self.sha256, found))
+        except DownloadError:
+            # Corrupt data must not be resumed from
+            _unlink_if_exists(self.part_path)
+            _unlink_if_exists(self.state_path)
+            raise
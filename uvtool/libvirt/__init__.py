@@ -19,14 +19,17 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import codecs
+import collections
 import contextlib
 import errno
-import itertools
+import functools
+import hashlib
 import json
 import os
-import shutil
+import stat
 import subprocess
 import tempfile
+import threading
 
 import libvirt
 from lxml import etree
@@ -38,6 +41,18 @@ LIBVIRT_DNSMASQ_STATUS_FILE = '/var/lib/libvirt/dnsmasq/virbr0.status'
 # The xmlns used for custom libvirt domain xml storage
 LIBVIRT_METADATA_XMLNS = 'https://launchpad.net/uvtool/libvirt/1'
 
+# Timings are kept apart from the rest of uvtool's metadata, since they are
+# updated with virDomainSetMetadata, which replaces a whole namespace
+LIBVIRT_TIMINGS_XMLNS = 'https://launchpad.net/uvtool/libvirt/timings/1'
+
+# The virtio-serial channel over which guests announce that they have
+# finished booting
+READY_CHANNEL_NAME = 'org.launchpad.uvtool.ready'
+READY_MESSAGE = b'boot-finished'
+
+
+DEFAULT_LIBVIRT_URI = 'qemu:///system'
+
 
 def get_libvirt_pool_object(libvirt_conn, pool_name):
     try:
@@ -47,48 +62,453 @@ def get_libvirt_pool_object(libvirt_conn, pool_name):
     return pool
 
 
-def pool_type(pool_name):
-    conn = libvirt.open('qemu:///system')
-    pool = get_libvirt_pool_object(conn, pool_name)
-    return etree.fromstring(pool.XMLDesc(0)).get('type')
+class Session(object):
+    """A libvirt connection with cached pool and volume handles.
+
+    Connection setup dominates the cost of most uvtool operations, so a
+    single Session is shared by everything in a process; see get_session.
+    The connection is opened lazily on first use.
+
+    Volume handles are cached by name, so volumes looked up through a
+    Session must be deleted through delete_volume to keep the cache
+    accurate.
+
+    """
+    def __init__(self, uri=DEFAULT_LIBVIRT_URI):
+        self.uri = uri
+        self._conn = None
+        self._pools = {}
+        self._pool_types = {}
+        self._volumes = {}
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self):
+        with self._lock:
+            if self._conn is None:
+                self._conn = libvirt.open(self.uri)
+            return self._conn
+
+    def pool(self, pool_name):
+        with self._lock:
+            try:
+                return self._pools[pool_name]
+            except KeyError:
+                pool = get_libvirt_pool_object(self.conn, pool_name)
+                self._pools[pool_name] = pool
+                return pool
+
+    def pool_type(self, pool_name):
+        with self._lock:
+            try:
+                return self._pool_types[pool_name]
+            except KeyError:
+                result = etree.fromstring(
+                    self.pool(pool_name).XMLDesc(0)).get('type')
+                self._pool_types[pool_name] = result
+                return result
+
+    def volume(self, volume_name, pool_name):
+        """Return a volume handle, raising libvirtError if it is missing."""
+        key = (pool_name, volume_name)
+        with self._lock:
+            try:
+                return self._volumes[key]
+            except KeyError:
+                volume = self.pool(pool_name).storageVolLookupByName(
+                    volume_name)
+                self._volumes[key] = volume
+                return volume
+
+    def volume_names(self, pool_name):
+        """Return the names of all volumes in a pool as a frozenset.
+
+        This is a single listing call, and the volume handles it returns
+        replace any cached for the pool, so later lookups of these volumes
+        are free.
+
+        """
+        volumes = self.pool(pool_name).listAllVolumes(0)
+        with self._lock:
+            self.forget_volumes(pool_name)
+            for volume in volumes:
+                self._volumes[(pool_name, volume.name())] = volume
+        return frozenset(volume.name() for volume in volumes)
+
+    def volume_by_path(self, path):
+        """Return the (pool name, volume name) of the volume at path.
+
+        Its handle is cached as if looked up through volume(), so that it
+        can be deleted through delete_volume.
+
+        """
+        volume = self.conn.storageVolLookupByKey(path)
+        pool_name = volume.storagePoolLookupByVolume().name()
+        volume_name = volume.name()
+        with self._lock:
+            self._volumes.setdefault((pool_name, volume_name), volume)
+        return pool_name, volume_name
+
+    def delete_volume(self, volume_name, pool_name):
+        volume = self.volume(volume_name, pool_name)
+        with self._lock:
+            self._volumes.pop((pool_name, volume_name), None)
+        volume.delete(flags=0)
+
+    def forget_volumes(self, pool_name=None):
+        """Drop cached volume handles, for example after a pool refresh."""
+        with self._lock:
+            for key in list(self._volumes):
+                if pool_name is None or key[0] == pool_name:
+                    del self._volumes[key]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+            self._pools.clear()
+            self._pool_types.clear()
+            self._volumes.clear()
+
+
+_default_uri = DEFAULT_LIBVIRT_URI
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def set_default_uri(uri):
+    """Set the libvirt URI used by get_session when none is given."""
+    global _default_uri
+    _default_uri = uri
+
+
+def get_session(uri=None):
+    """Return the shared Session for uri, or for the default URI."""
+    if uri is None:
+        uri = _default_uri
+    with _sessions_lock:
+        try:
+            return _sessions[uri]
+        except KeyError:
+            session = Session(uri)
+            _sessions[uri] = session
+            return session
+
+
+def _session(session):
+    return get_session() if session is None else session
+
+
+def pool_type(pool_name, session=None):
+    return _session(session).pool_type(pool_name)
+
+
+class ChecksumError(RuntimeError):
+    """Downloaded data did not match its published checksum."""
+    pass
+
+
+# Large enough to keep syscall overhead negligible on multi-GB images.
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def _is_regular_file(fobj):
+    try:
+        fileno = fobj.fileno()
+    except (AttributeError, IOError, ValueError):
+        return False
+    return stat.S_ISREG(os.fstat(fileno).st_mode)
+
+
+def _spool_fobj(fobj, expected_sha256=None):
+    """Return a regular file containing the data from fobj.
+
+    If fobj is already a regular file, it is used in place. Otherwise its
+    data is copied into a single temporary file. Either way, the data is
+    hashed while it is read and checked against expected_sha256 if given.
+
+    The caller must close the returned file object.
+
+    """
+    digest = hashlib.sha256() if expected_sha256 else None
+    if _is_regular_file(fobj):
+        spool_fobj = os.fdopen(os.dup(fobj.fileno()), 'rb')
+        spool_fobj.seek(0)
+        if digest:
+            for chunk in iter(
+                    functools.partial(spool_fobj.read, COPY_BUFFER_SIZE),
+                    b''):
+                digest.update(chunk)
+            spool_fobj.seek(0)
+    else:
+        spool_fobj = tempfile.NamedTemporaryFile()
+        for chunk in iter(
+                functools.partial(fobj.read, COPY_BUFFER_SIZE), b''):
+            if digest:
+                digest.update(chunk)
+            spool_fobj.write(chunk)
+        spool_fobj.flush()
+        spool_fobj.seek(0)
+
+    if digest and digest.hexdigest() != expected_sha256.lower():
+        spool_fobj.close()
+        raise ChecksumError(
+            "sha256 mismatch: expected %s, got %s." %
+            (expected_sha256, digest.hexdigest())
+        )
+    return spool_fobj
+
+
+def _image_virtual_size(path, image_type):
+    output = subprocess.check_output(
+        ['qemu-img', 'info', '--output=json', '-f', image_type, path],
+        close_fds=False
+    )
+    return json.loads(output.decode('utf-8'))['virtual-size']
 
 
 def create_volume_from_fobj(new_volume_name, fobj, image_type='raw',
-        pool_name='default'):
-    """Create a new libvirt volume and populate it from a file-like object."""
-
-    compressed_fobj = tempfile.NamedTemporaryFile()
-    decompressed_fobj = tempfile.NamedTemporaryFile()
-    with contextlib.closing(compressed_fobj):
-        with contextlib.closing(decompressed_fobj):
-            shutil.copyfileobj(fobj, compressed_fobj)
-            compressed_fobj.flush()
-            compressed_fobj.seek(0)  # is this necessary?
-            subprocess.check_call(
-                [
-                    'qemu-img', 'convert', '-f', image_type, '-O', image_type,
-                    compressed_fobj.name, decompressed_fobj.name
-                ],
-                shell=False, close_fds=False)
-            decompressed_fobj.seek(0)  # is this necessary?
-            return _create_volume_from_fobj_with_size(
-                new_volume_name=new_volume_name,
-                fobj=decompressed_fobj,
-                fobj_size=os.fstat(decompressed_fobj.fileno()).st_size,
-                image_type=image_type,
-                pool_name=pool_name
+        pool_name='default', expected_sha256=None, session=None):
+    """Create a new libvirt volume and populate it from a file-like object.
+
+    The image is normalised through qemu-img, which needs a seekable source,
+    so a non-file fobj is spooled to one temporary file while it is hashed
+    against expected_sha256. The result is then written into the pool once:
+    qemu-img converts straight into the new volume if its path is writable
+    by us, and otherwise the spooled image is uploaded to a staging volume
+    which libvirt converts into the new volume on the host side.
+
+    """
+    spool_fobj = _spool_fobj(fobj, expected_sha256=expected_sha256)
+    with contextlib.closing(spool_fobj):
+        spool_path = '/proc/self/fd/%d' % spool_fobj.fileno()
+        session = _session(session)
+        pool = session.pool(pool_name)
+        new_vol = E.volume(
+            E.name(new_volume_name),
+            E.allocation('0'),
+            E.capacity(str(_image_virtual_size(spool_path, image_type))),
+            E.target(E.format(type=image_type)),
+        )
+
+        vol = pool.createXML(etree.tostring(new_vol), 0)
+        if os.access(vol.path(), os.W_OK):
+            try:
+                subprocess.check_call(
+                    [
+                        'qemu-img', 'convert', '-n',
+                        '-f', image_type, '-O', image_type,
+                        spool_path, vol.path()
+                    ],
+                    shell=False, close_fds=False)
+            except:
+                vol.delete(flags=0)
+                raise
+            return vol
+
+        # The volume belongs to the libvirt daemon's user, so have libvirt
+        # do the conversion instead.
+        vol.delete(flags=0)
+        staging_vol = _create_volume_from_fobj_with_size(
+            new_volume_name='%s.staging' % new_volume_name,
+            fobj=spool_fobj,
+            fobj_size=os.fstat(spool_fobj.fileno()).st_size,
+            image_type=image_type,
+            pool_name=pool_name,
+            session=session,
+        )
+        try:
+            return pool.createXMLFrom(etree.tostring(new_vol), staging_vol, 0)
+        finally:
+            staging_vol.delete(flags=0)
+
+
+# lseek(2) whence values for sparse file support. Python 2 does not define
+# them, but they are part of the Linux ABI.
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+# Upload in chunks much larger than libvirt's default request size so that
+# per-message overhead is negligible. Chunks consisting entirely of zeroes
+# are sent as holes when the stream is sparse.
+UPLOAD_BUFFER_SIZE = 4 * 1024 * 1024
+_ZERO_BUFFER = b'\0' * UPLOAD_BUFFER_SIZE
+
+
+def _sparse_upload_supported():
+    return hasattr(libvirt, 'VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM')
+
+
+def _file_extents(fd, start, end):
+    """Yield (is_data, offset, length) tuples describing fd from start to end.
+
+    If the filesystem cannot report holes, the whole range is one data
+    extent.
+
+    """
+    offset = start
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a trailing hole remains
+                yield False, offset, end - offset
+                return
+            elif e.errno == errno.EINVAL:
+                yield True, offset, end - offset
+                return
+            raise
+        if data > offset:
+            data = min(data, end)
+            yield False, offset, data - offset
+            offset = data
+            continue
+        hole = min(os.lseek(fd, offset, SEEK_HOLE), end)
+        yield True, offset, hole - offset
+        offset = hole
+
+
+def _read_chunks(fobj, size):
+    """Yield (is_data, chunk_or_length) tuples covering size bytes of fobj.
+
+    Regular files are read directly through their descriptor, and holes
+    that the filesystem reports are skipped without being read. Other file
+    objects are read sequentially.
+
+    """
+    if _is_regular_file(fobj):
+        fd = fobj.fileno()
+        start = fobj.tell()
+        for is_data, offset, length in _file_extents(fd, start, start + size):
+            if not is_data:
+                yield False, length
+                continue
+            os.lseek(fd, offset, os.SEEK_SET)
+            while length:
+                chunk = os.read(fd, min(length, UPLOAD_BUFFER_SIZE))
+                if not chunk:
+                    raise IOError("Unexpected end of file during upload")
+                length -= len(chunk)
+                yield True, chunk
+        return
+
+    remaining = size
+    while remaining:
+        chunk = fobj.read(min(remaining, UPLOAD_BUFFER_SIZE))
+        if not chunk:
+            raise IOError("Unexpected end of file during upload")
+        remaining -= len(chunk)
+        yield True, chunk
+
+
+def _stream_send_chunks(stream, chunks, sparse):
+    """Send (is_data, chunk_or_length) tuples down a libvirt stream.
+
+    If sparse is True, holes and all-zero chunks are coalesced and sent with
+    sendHole. Otherwise holes are sent as explicit zeroes.
+
+    """
+    pending_hole = 0
+    for is_data, chunk in chunks:
+        if is_data and sparse and chunk == _ZERO_BUFFER[:len(chunk)]:
+            is_data, chunk = False, len(chunk)
+        if not is_data:
+            if sparse:
+                pending_hole += chunk
+                continue
+            chunk_length = chunk
+            while chunk_length:
+                zeroes = _ZERO_BUFFER[:min(chunk_length, UPLOAD_BUFFER_SIZE)]
+                _stream_send_all(stream, zeroes)
+                chunk_length -= len(zeroes)
+            continue
+        if pending_hole:
+            stream.sendHole(pending_hole, 0)
+            pending_hole = 0
+        _stream_send_all(stream, chunk)
+    if pending_hole:
+        stream.sendHole(pending_hole, 0)
+
+
+def _stream_send_all(stream, data):
+    while data:
+        sent = stream.send(data)
+        if sent < 0:
+            raise libvirt.libvirtError("stream send failed")
+        data = data[sent:]
+
+
+def _upload_fobj(conn, vol, fobj, fobj_size):
+    """Upload fobj_size bytes from fobj into vol.
+
+    A sparse stream is used where libvirt supports it, so that holes in the
+    source and runs of zeroes cost neither bandwidth nor space in the
+    target volume.
+
+    """
+    sparse = _sparse_upload_supported()
+    if sparse:
+        stream = conn.newStream(0)
+        try:
+            vol.upload(
+                stream, 0, fobj_size,
+                libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM
             )
+        except libvirt.libvirtError:
+            # The daemon may be older than the client library. Retry below
+            # without sparse support, on a new stream; this one must not be
+            # left open on the shared connection.
+            try:
+                stream.abort()
+            except:
+                pass
+            sparse = False
+    if not sparse:
+        stream = conn.newStream(0)
+        vol.upload(stream, 0, fobj_size, 0)
+
+    try:
+        _stream_send_chunks(stream, _read_chunks(fobj, fobj_size), sparse)
+    except Exception as e:
+        try:
+            # This unexpectedly raises an exception even on a normal call,
+            # so ignore it.
+            stream.abort()
+        except:
+            pass
+        raise e
+    stream.finish()
+
+
+def upload_volume_from_fobj(new_volume_name, fobj, fobj_size,
+        image_type='raw', pool_name='default', session=None):
+    """Create a new libvirt volume and upload fobj into it as it is.
+
+    Unlike create_volume_from_fobj, the image is not normalised through
+    qemu-img, so fobj must already hold a complete image_type image of
+    fobj_size bytes. This suits small images built in memory.
+
+    """
+    return _create_volume_from_fobj_with_size(
+        new_volume_name, fobj, fobj_size, image_type, pool_name,
+        session=session)
 
 
 def _create_volume_from_fobj_with_size(new_volume_name, fobj, fobj_size,
-        image_type, pool_name):
-    conn = libvirt.open('qemu:///system')
-    pool = get_libvirt_pool_object(conn, pool_name)
+        image_type, pool_name, session=None):
+    session = _session(session)
+    pool = session.pool(pool_name)
 
     if image_type == 'raw':
-        extra = [E.allocation(str(fobj_size)), E.capacity(str(fobj_size))]
+        # A sparse upload only allocates what it writes, so do not ask
+        # libvirt to preallocate the whole volume first.
+        allocation = '0' if _sparse_upload_supported() else str(fobj_size)
+        extra = [E.allocation(allocation), E.capacity(str(fobj_size))]
     elif image_type == 'qcow2':
-        extra = [E.capacity('0' if pool_type(pool_name) == 'dir' else str(fobj_size))]
+        extra = [E.capacity(
+            '0' if session.pool_type(pool_name) == 'dir' else str(fobj_size))]
     else:
         raise NotImplementedError("Unknown image type %r." % image_type)
 
@@ -100,23 +520,7 @@ def _create_volume_from_fobj_with_size(new_volume_name, fobj, fobj_size,
     vol = pool.createXML(etree.tostring(new_vol), 0)
 
     try:
-        stream = conn.newStream(0)
-        vol.upload(stream, 0, fobj_size, 0)
-
-        def handler(stream_ignored, size, opaque_ignored):
-            return fobj.read(size)
-
-        try:
-            stream.sendAll(handler, None)
-        except Exception as e:
-            try:
-                # This unexpectedly raises an exception even on a normal call,
-                # so ignore it.
-                stream.abort()
-            except:
-                pass
-            raise e
-        stream.finish()
+        _upload_fobj(session.conn, vol, fobj, fobj_size)
     except:
         vol.delete(flags=0)
         raise
@@ -124,129 +528,146 @@ def _create_volume_from_fobj_with_size(new_volume_name, fobj, fobj_size,
     return vol
 
 
-def volume_names_in_pool(pool_name='default'):
-    conn = libvirt.open('qemu:///system')
-    pool = get_libvirt_pool_object(conn, pool_name)
-    return pool.listVolumes()
+def volume_names_in_pool(pool_name='default', session=None):
+    return sorted(_session(session).volume_names(pool_name))
+
 
-def get_volume_path_by_name(volume_name, pool_name='default'):
-    conn = libvirt.open('qemu:///system')
-    pool = get_libvirt_pool_object(conn, pool_name)
-    volume = pool.storageVolLookupByName(volume_name)
-    return volume.path()
+def get_volume_path_by_name(volume_name, pool_name='default', session=None):
+    return _session(session).volume(volume_name, pool_name).path()
 
-def delete_volume_by_name(volume_name, pool_name='default'):
-    conn = libvirt.open('qemu:///system')
-    pool = get_libvirt_pool_object(conn, pool_name)
-    volume = pool.storageVolLookupByName(volume_name)
-    volume.delete(flags=0)
 
+def delete_volume_by_name(volume_name, pool_name='default', session=None):
+    _session(session).delete_volume(volume_name, pool_name)
 
-def have_volume_by_name(volume_name, pool_name='default'):
-    conn = libvirt.open('qemu:///system')
-    pool = get_libvirt_pool_object(conn, pool_name)
+
+def have_volume_by_name(volume_name, pool_name='default', session=None):
     try:
-        volume = pool.storageVolLookupByName(volume_name)
+        _session(session).volume(volume_name, pool_name)
     except libvirt.libvirtError:
         return False
     else:
         return True
 
 
-def _get_all_domains(conn=None):
-    if conn is None:
-        conn = libvirt.open('qemu:///system')
-
-    # libvirt in Precise doesn't seem to have a binding for
-    # virConnectListAllDomains, and it seems that we must enumerate
-    # defined-by-not-running and running instances separately and in different
-    # ways.
-
-    for domain_id in conn.listDomainsID():
-        yield conn.lookupByID(domain_id)
-
-    for domain_name in conn.listDefinedDomains():
-        yield conn.lookupByName(domain_name)
-
-
-def _domain_element_to_volume_paths(element):
+def _domain_element_to_volume_paths(element, volume_paths_by_name):
     assert element.tag == 'domain'
-    return (
-        source.get('file')
-        for source in element.xpath(
-            "/domain/devices/disk[@type='file']/source[@file]"
-        )
-    )
-
-
-def _domain_volume_paths(domain):
-    volume_paths = set()
-
-    for flags in [0, libvirt.VIR_DOMAIN_XML_INACTIVE]:
-        element = etree.fromstring(domain.XMLDesc(flags))
-        volume_paths.update(_domain_element_to_volume_paths(element))
-
-    return frozenset(volume_paths)
-
-
-def _volume_element_to_volume_paths(element):
-    assert element.tag == 'volume'
-    return itertools.chain(
-        (path.text for path in element.xpath('/volume/target/path')),
-        (path.text for path in element.xpath('/volume/backingStore/path')),
-    )
-
-
-def _volume_volume_paths(volume):
-    # Volumes can depend on other volumes ("backing stores"), so return all
-    # paths a volume needs to function, including the top level one.
-    volume_paths = set()
-
-    element = etree.fromstring(volume.XMLDesc(0))
-    volume_paths.update(_volume_element_to_volume_paths(element))
-
-    return frozenset(volume_paths)
+    for source in element.xpath(
+            "/domain/devices/disk[@type='file']/source[@file]"):
+        yield source.get('file')
+    for source in element.xpath(
+            "/domain/devices/disk[@type='volume']/source[@pool][@volume]"):
+        path = volume_paths_by_name.get(
+            (source.get('pool'), source.get('volume')))
+        if path:
+            yield path
+
+
+VolumeInfo = collections.namedtuple(
+    'VolumeInfo', ['pool_name', 'name', 'path', 'backing_path'])
+
+
+class VolumeDependencyIndex(object):
+    """Which domains use which volumes, following full backing chains.
+
+    The index is built from one listAllVolumes call per active pool and one
+    listAllDomains call, plus the XML of each volume and domain, rather than
+    from lookups per disk. Build one and query it as often as needed.
+
+    """
+    def __init__(self, session=None):
+        conn = _session(session).conn
+
+        self.volumes_by_path = {}
+        volume_paths_by_name = {}
+        for pool in conn.listAllStoragePools(
+                libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE):
+            pool_name = pool.name()
+            for volume in pool.listAllVolumes(0):
+                element = etree.fromstring(volume.XMLDesc(0))
+                info = VolumeInfo(
+                    pool_name=pool_name,
+                    name=volume.name(),
+                    path=element.findtext('target/path'),
+                    backing_path=element.findtext('backingStore/path'),
+                )
+                self.volumes_by_path[info.path] = info
+                volume_paths_by_name[(pool_name, info.name)] = info.path
+
+        # Paths attached directly to each domain
+        self.domain_paths = {}
+        for domain in conn.listAllDomains(0):
+            # A running domain may have been redefined with different disks
+            # since it started, so both definitions count.
+            if domain.isActive():
+                all_flags = [0, libvirt.VIR_DOMAIN_XML_INACTIVE]
+            else:
+                all_flags = [0]
+            paths = set()
+            for flags in all_flags:
+                element = etree.fromstring(domain.XMLDesc(flags))
+                paths.update(_domain_element_to_volume_paths(
+                    element, volume_paths_by_name))
+            self.domain_paths[domain.name()] = frozenset(paths)
+
+        self._users_by_path = collections.defaultdict(set)
+        for domain_name, paths in self.domain_paths.items():
+            for path in paths:
+                for chain_path in self.backing_chain(path):
+                    self._users_by_path[chain_path].add(domain_name)
+
+    def backing_chain(self, path):
+        """Yield path followed by the paths of all its backing volumes."""
+        seen = set()
+        while path and path not in seen:
+            seen.add(path)
+            yield path
+            info = self.volumes_by_path.get(path)
+            path = info.backing_path if info else None
+
+    def paths_in_use(self):
+        return frozenset(self._users_by_path)
+
+    def volumes_in_use(self, pool_name=None):
+        """Return VolumeInfo for every pool volume that a domain needs."""
+        return [
+            self.volumes_by_path[path] for path in self._users_by_path
+            if path in self.volumes_by_path and (
+                pool_name is None or
+                self.volumes_by_path[path].pool_name == pool_name
+            )
+        ]
 
+    def users(self, path):
+        """Return the names of domains that need the volume at path."""
+        return frozenset(self._users_by_path.get(path, ()))
 
-def _get_all_domain_volume_paths(conn=None):
-    if conn is None:
-        conn = libvirt.open('qemu:///system')
+    def users_of_volume(self, volume_name, pool_name):
+        for info in self.volumes_by_path.values():
+            if info.pool_name == pool_name and info.name == volume_name:
+                return self.users(info.path)
+        return frozenset()
 
-    all_volume_paths = set()
-    for domain in _get_all_domains(conn):
-        for path in _domain_volume_paths(domain):
-            try:
-                volume = conn.storageVolLookupByKey(path)
-            except libvirt.libvirtError:
-                # ignore a lookup failure, since if a volume doesn't exist,
-                # it isn't reasonable to consider what backing volumes it may
-                # have
-                continue
-            all_volume_paths.update(_volume_volume_paths(volume))
 
-    return frozenset(all_volume_paths)
+def get_all_domain_volume_names(session=None, filter_by_dir=None,
+        pool_name=None, index=None):
+    """Yield the names of volumes needed by any domain.
 
+    Results can be restricted to volumes in pool_name, or to those whose
+    path starts with filter_by_dir. An existing VolumeDependencyIndex may be
+    passed in to avoid building a new one.
 
-def get_all_domain_volume_names(conn=None, filter_by_dir=None):
-    # Limitation: filter_by_dir must currently end in a '/' and be the
-    # canonical path as libvirt returns it. Ideally I'd filter by pool instead,
-    # but the libvirt API appears to not provide any method to find what pool a
-    # volume is in when looked up by key.
-    if conn is None:
-        conn = libvirt.open('qemu:///system')
+    """
+    if index is None:
+        index = VolumeDependencyIndex(session=session)
 
-    for path in _get_all_domain_volume_paths(conn=conn):
-        volume = conn.storageVolLookupByKey(path)
-        if filter_by_dir and not volume.path().startswith(filter_by_dir):
+    for info in index.volumes_in_use(pool_name=pool_name):
+        if filter_by_dir and not info.path.startswith(filter_by_dir):
             continue
-        yield volume.name()
-
+        yield info.name
 
-def get_domain_macs(domain_name, conn=None):
-    if conn is None:
-        conn = libvirt.open('qemu:///system')
 
-    domain = conn.lookupByName(domain_name)
+def get_domain_macs(domain_name, session=None):
+    domain = _session(session).conn.lookupByName(domain_name)
     xml = etree.fromstring(domain.XMLDesc(0))
     for mac in xml.xpath(
             "/domain/devices/interface[@type='network' or @type='bridge']/mac[@address]"):
@@ -256,63 +677,145 @@ def get_domain_macs(domain_name, conn=None):
         }
 
 
-def dnsmasq_lease_file_mac_to_ip(lowercase_mac):
+class _FileIndex(object):
+    """A map parsed from a file, and parsed again only when the file changes.
+
+    Files that do not exist give an empty map.
+
+    """
+    def __init__(self, parse):
+        self._parse = parse
+        self._lock = threading.Lock()
+        self._key = None
+        self._map = {}
+
+    def get(self, path):
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return {}
+            raise
+        key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        with self._lock:
+            if key != self._key:
+                try:
+                    self._map = self._parse(path)
+                except IOError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    self._map = {}
+                self._key = key
+            return self._map
+
+
+def _parse_dnsmasq_lease_file(path):
     MAC_FIELD = 1
     IP_FIELD = 2
     MIN_FIELDS = max(MAC_FIELD, IP_FIELD)
 
-    try:
-        f = codecs.open(LIBVIRT_DNSMASQ_LEASE_FILE, 'r')
-    except IOError as e:
-        if e.errno == errno.ENOENT:
-            return None
-        else:
-            raise
-
-    with contextlib.closing(f):
+    result = {}
+    with contextlib.closing(codecs.open(path, 'r')) as f:
         for line in f:
             fields = line.split()
-            if (len(fields) >= MIN_FIELDS and
-                    fields[MAC_FIELD].lower() == lowercase_mac):
-                return fields[IP_FIELD]
-        return None
-
+            if len(fields) > MIN_FIELDS:
+                result.setdefault(fields[MAC_FIELD].lower(), fields[IP_FIELD])
+    return result
 
-def libvirt_dnsmasq_status_file_mac_to_ip(lowercase_mac):
-    try:
-        f = codecs.open(LIBVIRT_DNSMASQ_STATUS_FILE , 'r')
-    except IOError as e:
-        if e.errno == errno.ENOENT:
-            return None
-        else:
-            raise
 
-    with contextlib.closing(f):
+def _parse_dnsmasq_status_file(path):
+    with contextlib.closing(codecs.open(path, 'r')) as f:
         try:
             j = json.load(f)
         except ValueError:
-            return None
-
+            return {}
+    result = {}
     for entry in j:
-        if entry.get('mac-address') == lowercase_mac:
-            return entry['ip-address']
+        if 'mac-address' in entry and 'ip-address' in entry:
+            result.setdefault(
+                entry['mac-address'].lower(), entry['ip-address'])
+    return result
 
-    return None
 
+_lease_file_index = _FileIndex(_parse_dnsmasq_lease_file)
+_status_file_index = _FileIndex(_parse_dnsmasq_status_file)
 
-def mac_to_ip(mac):
-    lowercase_mac = mac.lower()
-    return (
-        dnsmasq_lease_file_mac_to_ip(lowercase_mac) or
-        libvirt_dnsmasq_status_file_mac_to_ip(lowercase_mac)
-    )
 
+def dnsmasq_lease_file_mac_to_ip(lowercase_mac):
+    return _lease_file_index.get(LIBVIRT_DNSMASQ_LEASE_FILE).get(
+        lowercase_mac)
+
+
+def libvirt_dnsmasq_status_file_mac_to_ip(lowercase_mac):
+    return _status_file_index.get(LIBVIRT_DNSMASQ_STATUS_FILE).get(
+        lowercase_mac)
+
+
+def dnsmasq_leases():
+    """Return the leased IP address of every MAC address.
 
-def get_domain_ssh_known_hosts(domain_name, conn=None, prefix=None):
-    if conn is None:
-        conn = libvirt.open('qemu:///system')
+    Keys are lower case MAC addresses. Each dnsmasq file is only parsed
+    again once it has changed.
 
-    domain = conn.lookupByName(domain_name)
+    """
+    result = dict(_status_file_index.get(LIBVIRT_DNSMASQ_STATUS_FILE))
+    result.update(_lease_file_index.get(LIBVIRT_DNSMASQ_LEASE_FILE))
+    return result
+
+
+def libvirt_network_leases(session=None):
+    """Return the IPv4 address leased to each MAC address by libvirt.
+
+    This asks libvirt for the DHCP leases of every active network, so it
+    works whatever the networks and their bridges are called, and on remote
+    hosts. Keys are lower case MAC addresses.
+
+    """
+    conn = _session(session).conn
+    result = {}
+    for network in conn.listAllNetworks(
+            libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE):
+        try:
+            leases = network.DHCPLeases()
+        except libvirt.libvirtError:
+            continue
+        for lease in leases:
+            if (lease.get('iptype') == libvirt.VIR_IP_ADDR_TYPE_IPV4 and
+                    lease.get('mac') and lease.get('ipaddr')):
+                result.setdefault(lease['mac'].lower(), lease['ipaddr'])
+    return result
+
+
+def macs_to_ips(macs, session=None):
+    """Return the IP address of each of macs that has one, by MAC address.
+
+    The local dnsmasq files of the default network are tried first. Any
+    addresses not found there are looked up in the DHCP leases of all
+    libvirt networks, with one call per network however many there are.
+
+    """
+    leases = dnsmasq_leases()
+    result = {}
+    for mac in macs:
+        ip = leases.get(mac.lower())
+        if ip:
+            result[mac] = ip
+    missing = [mac for mac in macs if mac not in result]
+    if missing:
+        leases = libvirt_network_leases(session=session)
+        for mac in missing:
+            ip = leases.get(mac.lower())
+            if ip:
+                result[mac] = ip
+    return result
+
+
+def mac_to_ip(mac, session=None):
+    return macs_to_ips([mac], session=session).get(mac)
+
+
+def get_domain_ssh_known_hosts(domain_name, session=None, prefix=None):
+    domain = _session(session).conn.lookupByName(domain_name)
     xml = etree.fromstring(domain.XMLDesc(0))
     element = xml.xpath(
         '/domain/metadata/uvt:ssh_known_hosts',
@@ -327,3 +830,217 @@ def get_domain_ssh_known_hosts(domain_name, conn=None, prefix=None):
             return element[0].text
     else:
         return None
+
+
+def is_uvtool_domain(domain, xml=None):
+    """Return True if uvtool recorded metadata in the domain's definition.
+
+    xml is the parsed domain definition, if the caller already has it.
+
+    """
+    if xml is None:
+        xml = etree.fromstring(domain.XMLDesc(0))
+    return bool(xml.xpath(
+        '/domain/metadata/uvt:*',
+        namespaces={'uvt': LIBVIRT_METADATA_XMLNS}
+    ))
+
+
+def has_ready_channel(domain, xml=None):
+    """Return whether domain has the channel for boot-finished messages."""
+    if xml is None:
+        xml = etree.fromstring(domain.XMLDesc(0))
+    return bool(xml.xpath(
+        "/domain/devices/channel/target[@type='virtio'][@name=$name]",
+        name=READY_CHANNEL_NAME
+    ))
+
+
+def get_domain_seed_token(domain):
+    """Return the token of the HTTP seed a domain was created with, if any."""
+    xml = etree.fromstring(domain.XMLDesc(0))
+    element = xml.xpath(
+        '/domain/metadata/uvt:seed',
+        namespaces={'uvt': LIBVIRT_METADATA_XMLNS}
+    )
+    return element[0].text if element else None
+
+
+def get_domain_fleet(domain):
+    """Return the (fleet name, spec hash) recorded by uvt-kvm apply, if any."""
+    xml = etree.fromstring(domain.XMLDesc(0))
+    element = xml.xpath(
+        '/domain/metadata/uvt:fleet',
+        namespaces={'uvt': LIBVIRT_METADATA_XMLNS}
+    )
+    if element:
+        return element[0].get('name'), element[0].get('spec')
+    return None
+
+
+def get_domain_timings(domain):
+    """Return the timings stored by record_domain_timings, by operation."""
+    try:
+        xml = domain.metadata(
+            libvirt.VIR_DOMAIN_METADATA_ELEMENT, LIBVIRT_TIMINGS_XMLNS, 0)
+    except libvirt.libvirtError:
+        return {}
+    result = {}
+    for operation in etree.fromstring(xml).findall('operation'):
+        result[operation.get('name')] = {
+            'started': float(operation.get('started')),
+            'phases': [
+                {
+                    'name': phase.get('name'),
+                    'start': float(phase.get('start')),
+                    'duration': float(phase.get('duration')),
+                }
+                for phase in operation.findall('phase')
+            ],
+        }
+    return result
+
+
+def record_domain_timings(domain, operation, timings):
+    """Store the timings of operation in domain, replacing any earlier ones.
+
+    timings is in the form of uvtool.timing.Timings.as_dict. Those of other
+    operations are kept, so that a VM's whole bring-up can be seen later.
+
+    """
+    all_timings = get_domain_timings(domain)
+    all_timings[operation] = timings
+    xml = E.timings(*[
+        E.operation(
+            *[
+                E.phase(
+                    name=phase['name'],
+                    start=repr(phase['start']),
+                    duration=repr(phase['duration']),
+                )
+                for phase in operation_timings['phases']
+            ],
+            name=name,
+            started=repr(operation_timings['started'])
+        )
+        for name, operation_timings in sorted(all_timings.items())
+    ])
+    flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    if domain.isActive():
+        flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+    domain.setMetadata(
+        libvirt.VIR_DOMAIN_METADATA_ELEMENT, etree.tostring(xml),
+        'uvt-timings', LIBVIRT_TIMINGS_XMLNS, flags
+    )
+
+
+def get_network_host_address(network_name='default', session=None):
+    """Return the host's own IPv4 address on a libvirt network."""
+    network = _session(session).conn.networkLookupByName(network_name)
+    xml = etree.fromstring(network.XMLDesc(0))
+    for ip in xml.xpath('/network/ip[@address]'):
+        if ip.get('family', 'ipv4') == 'ipv4':
+            return ip.get('address')
+    return None
+
+
+_event_loop_lock = threading.Lock()
+_event_loop_started = []
+
+
+def _run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def start_event_loop():
+    """Run libvirt's default event loop in a background thread.
+
+    Events are only delivered on connections opened after this is called,
+    so call it before the Session's connection is first used.
+
+    """
+    with _event_loop_lock:
+        if _event_loop_started:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        thread = threading.Thread(target=_run_event_loop)
+        thread.daemon = True
+        thread.start()
+        _event_loop_started.append(thread)
+
+
+class DomainLifecycleWatcher(object):
+    """Track whether a domain is running using libvirt lifecycle events.
+
+    If events cannot be registered (for example because start_event_loop
+    was not called before the connection was opened), the domain's state
+    is queried instead each time it is asked for.
+
+    """
+    RUNNING_STATES = [libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_BLOCKED]
+    STOPPED_STATES = [libvirt.VIR_DOMAIN_SHUTOFF, libvirt.VIR_DOMAIN_CRASHED]
+
+    def __init__(self, domain, session=None):
+        self.domain = domain
+        self.conn = _session(session).conn
+        self.running = threading.Event()
+        self.stopped = threading.Event()
+        try:
+            self._callback_id = self.conn.domainEventRegisterAny(
+                domain,
+                libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self._lifecycle_event,
+                None,
+            )
+        except libvirt.libvirtError:
+            self._callback_id = None
+        # Only read the state once registered, so that no change can fall
+        # between the two
+        self._update_state()
+
+    def _set(self, running, stopped):
+        for event, value in [(self.running, running), (self.stopped, stopped)]:
+            if value:
+                event.set()
+            else:
+                event.clear()
+
+    def _update_state(self):
+        state = self.domain.state(0)[0]
+        self._set(state in self.RUNNING_STATES, state in self.STOPPED_STATES)
+
+    def _lifecycle_event(self, conn, domain, event, detail, opaque):
+        if event in [libvirt.VIR_DOMAIN_EVENT_STARTED,
+                     libvirt.VIR_DOMAIN_EVENT_RESUMED]:
+            self._set(running=True, stopped=False)
+        elif event in [libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                       libvirt.VIR_DOMAIN_EVENT_CRASHED]:
+            self._set(running=False, stopped=True)
+        elif event == libvirt.VIR_DOMAIN_EVENT_SUSPENDED:
+            self._set(running=False, stopped=False)
+
+    def is_running(self):
+        if self._callback_id is None:
+            self._update_state()
+        return self.running.is_set()
+
+    def is_stopped(self):
+        if self._callback_id is None:
+            self._update_state()
+        return self.stopped.is_set()
+
+    def wait_until_running(self, timeout):
+        """Wait for the domain to start, and return whether it is running."""
+        if self._callback_id is None:
+            return self.is_running()
+        self.running.wait(timeout)
+        return self.running.is_set()
+
+    def close(self):
+        if self._callback_id is not None:
+            try:
+                self.conn.domainEventDeregisterAny(self._callback_id)
+            except libvirt.libvirtError:
+                pass
+            self._callback_id = None
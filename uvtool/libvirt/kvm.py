@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-# Wrapper around cloud-localds and libvirt
+# Wrapper around libvirt
 
 # Copyright (C) 2012-3 Canonical Ltd.
 # Author: Robie Basak <robie.basak@canonical.com>
@@ -23,18 +23,28 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import collections
+import contextlib
+import copy
 import errno
+import fnmatch
 import functools
+import hashlib
+import io
 import itertools
+import json
 import os
 import platform
-import shutil
+import re
 import signal
 import string
 import StringIO
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import urlparse
 import uuid
 import yaml
 
@@ -45,15 +55,25 @@ from lxml.builder import E, ElementMaker
 import uvtool.libvirt
 from uvtool.libvirt import LIBVIRT_METADATA_XMLNS
 import uvtool.libvirt.simplestreams
+import uvtool.parallel
+import uvtool.seed
 import uvtool.ssh
+import uvtool.timing
 import uvtool.wait
+import uvtool.watchd
 
 
 ARCH = platform.machine()
 DEFAULT_TEMPLATE = '/usr/share/uvtool/libvirt/template.xml'
 
 DEFAULT_REMOTE_WAIT_SCRIPT = '/usr/share/uvtool/libvirt/remote-wait.sh'
+LIBVIRT_QEMU_RUN_DIR = '/var/run/libvirt/qemu'
 POOL_NAME = 'uvtool'
+DEFAULT_CREATE_JOBS = 4
+DEFAULT_DESTROY_JOBS = 8
+# Waiting mostly sleeps, so many VMs can be waited for at once
+DEFAULT_WAIT_JOBS = 64
+PREALLOCATION_MODES = ['off', 'metadata', 'falloc']
 
 
 class CLIError(Exception):
@@ -172,6 +192,26 @@ def get_ssh_authorized_keys(filename):
         return []
 
 
+# Installed as a per-boot script so that every boot is announced, not just
+# the first. Each write to the port blocks until the host opens the channel.
+READY_NOTIFY_PATH = '/var/lib/cloud/scripts/per-boot/uvtool-ready'
+READY_NOTIFY_SCRIPT = """#!/bin/sh
+port=/dev/virtio-ports/%(channel)s
+[ -e "$port" ] || exit 0
+(
+	# This runs within cloud-init's final stage, so wait for it to end
+	cloud-init status --wait >/dev/null 2>&1 ||
+		while [ ! -e /var/lib/cloud/instance/boot-finished ]; do
+			sleep 0.1
+		done
+	while echo %(message)s > "$port"; do sleep 1; done
+) </dev/null >/dev/null 2>&1 &
+""" % {
+    'channel': uvtool.libvirt.READY_CHANNEL_NAME,
+    'message': uvtool.libvirt.READY_MESSAGE.decode('ascii'),
+}
+
+
 def create_default_user_data(fobj, args, ssh_host_keys=None):
     """Write some sensible default cloud-init user-data to the given file
     object.
@@ -180,15 +220,15 @@ def create_default_user_data(fobj, args, ssh_host_keys=None):
 
     ssh_authorized_keys = get_ssh_authorized_keys(args.ssh_public_key_file)
 
+    if ssh_host_keys is None:
+        ssh_host_keys = uvtool.ssh.generate_ssh_host_keys()[0]
+
     data = {
         b'hostname': args.hostname.encode('ascii'),
         b'manage_etc_hosts': b'localhost',
-        b'ssh_keys': uvtool.ssh.generate_ssh_host_keys()[0],
+        b'ssh_keys': ssh_host_keys,
     }
 
-    if ssh_host_keys:
-        data[b'ssh_keys'] = ssh_host_keys
-
     if ssh_authorized_keys:
         data[b'ssh_authorized_keys'] = ssh_authorized_keys
 
@@ -200,6 +240,13 @@ def create_default_user_data(fobj, args, ssh_host_keys=None):
     if args.run_script_once:
         data[b'runcmd'] = run_script_once_args_to_config(args.run_script_once)
 
+    if args.ready_channel:
+        data[b'write_files'] = [{
+            b'path': READY_NOTIFY_PATH.encode('ascii'),
+            b'permissions': b'0755',
+            b'content': READY_NOTIFY_SCRIPT.encode('ascii'),
+        }]
+
     if args.packages:
         data[b'packages'] = [
             s.encode('ascii')  # Debian Policy dictates a-z,0-9,+,-,.
@@ -217,62 +264,88 @@ def create_default_meta_data(fobj, args):
     fobj.write(yaml.dump(data))
 
 
-def create_ds_image(temp_dir, hostname, user_data_fobj, meta_data_fobj):
-    """Create a file called ds.img inside temp_dir that contains a useful
-    cloud-init data source.
+def create_ds_volume(new_volume_name, hostname, user_data_fobj, meta_data_fobj,
+        pool_name=POOL_NAME, session=None):
+    """Create a new libvirt cloud-init datasource volume.
 
-    Other temporary files created in temp_dir are currently metadata and
-    userdata and can be safely deleted.
+    The NoCloud seed image is built in memory and uploaded as a raw volume
+    as it is, without any temporary files or conversion.
 
     """
+    seed = uvtool.seed.build_nocloud_seed(
+        user_data_fobj.read(), meta_data_fobj.read())
+    return uvtool.libvirt.upload_volume_from_fobj(
+        new_volume_name, io.BytesIO(seed), len(seed), image_type='raw',
+        pool_name=pool_name, session=session)
 
-    with open(os.path.join(temp_dir, 'userdata'), 'wb') as f:
-        f.write(user_data_fobj.read())
-    with open(os.path.join(temp_dir, 'metadata'), 'wb') as f:
-        f.write(meta_data_fobj.read())
 
-    subprocess.check_call(
-        ['cloud-localds', '--disk-format=qcow2', 'ds.img', 'userdata', 'metadata'], cwd=temp_dir)
+def _qcow2_volume_xml(new_volume_name, size, backing_volume_path=None,
+        preallocation='off', cluster_size=None):
+    """Return the libvirt definition of a new qcow2 volume of size GiB.
 
+    With preallocation "metadata", libvirt has qemu-img lay out all qcow2
+    metadata up front; with "falloc", the space is allocated as well.
+    cluster_size is in KiB.
 
-def create_ds_volume(new_volume_name, hostname, user_data_fobj, meta_data_fobj,
-        pool_name=POOL_NAME):
-    """Create a new libvirt cloud-init datasource volume."""
+    """
+    if preallocation == 'falloc':
+        allocation = E.allocation(str(size), unit='G')
+    else:
+        allocation = E.allocation('0')
+    target = E.target(E.format(type='qcow2'))
+    if cluster_size:
+        target.append(E.clusterSize(str(cluster_size), unit='KiB'))
+    volume = E.volume(
+        E.name(new_volume_name),
+        allocation,
+        E.capacity(str(size), unit='G'),
+        target,
+    )
+    if backing_volume_path:
+        volume.append(E.backingStore(
+            E.path(backing_volume_path),
+            E.format(type='qcow2'),
+        ))
+    return etree.tostring(volume)
 
-    temp_dir = tempfile.mkdtemp(prefix='uvt-kvm-')
-    try:
-        create_ds_image(temp_dir, hostname, user_data_fobj, meta_data_fobj)
-        with open(os.path.join(temp_dir, 'ds.img'), 'rb') as f:
-            return uvtool.libvirt.create_volume_from_fobj(
-                new_volume_name, f, image_type='qcow2', pool_name=pool_name)
-    finally:
-        shutil.rmtree(temp_dir)
 
+def _create_qcow2_volume(pool, xml, preallocation='off'):
+    if preallocation == 'off':
+        flags = 0
+    else:
+        flags = libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA
+    return pool.createXML(xml, flags)
 
-def create_new_volume(new_volume_name, size=2):
-    """Create a new libvirt volume with provided name and size."""
 
-    temp_dir = tempfile.mkdtemp(prefix='uvt-kvm-')
-    try:
-        fname = os.path.join(temp_dir, 'disk.qcow')
-        output = subprocess.check_output(
-            ['qemu-img', 'create', '-f', 'qcow2', fname, "%dG" % size])
-        with open(fname, 'rb') as f:
-            return uvtool.libvirt.create_volume_from_fobj(
-                new_volume_name, f, image_type='qcow2', pool_name=POOL_NAME)
-    finally:
-        shutil.rmtree(temp_dir)
+def create_new_volume(new_volume_name, size=2, session=None,
+        pool_name=POOL_NAME, preallocation='off', cluster_size=None):
+    """Create a new empty qcow2 libvirt volume of size GiB.
+
+    The volume is created by libvirt itself, so no image data is
+    transferred.
+
+    """
+    if session is None:
+        session = uvtool.libvirt.get_session()
+
+    return _create_qcow2_volume(
+        session.pool(pool_name),
+        _qcow2_volume_xml(
+            new_volume_name, size, preallocation=preallocation,
+            cluster_size=cluster_size),
+        preallocation=preallocation,
+    )
 
 
 def create_cow_volume(backing_volume_name, new_volume_name, new_volume_size,
-        conn=None, pool_name=POOL_NAME):
+        session=None, pool_name=POOL_NAME, preallocation='off',
+        cluster_size=None):
 
-    if conn is None:
-        conn = libvirt.open('qemu:///system')
+    if session is None:
+        session = uvtool.libvirt.get_session()
 
-    pool = conn.storagePoolLookupByName(pool_name)
     try:
-        backing_vol = pool.storageVolLookupByName(backing_volume_name)
+        backing_vol = session.volume(backing_volume_name, pool_name)
     except libvirt.libvirtError:
         raise RuntimeError("Cannot find volume %s" % backing_volume_name)
 
@@ -280,36 +353,51 @@ def create_cow_volume(backing_volume_name, new_volume_name, new_volume_size,
         backing_volume_path=backing_vol.path(),
         new_volume_name=new_volume_name,
         new_volume_size=new_volume_size,
-        conn=conn,
-        pool_name=pool_name
+        session=session,
+        pool_name=pool_name,
+        preallocation=preallocation,
+        cluster_size=cluster_size,
     )
 
 def create_cow_volume_by_path(backing_volume_path, new_volume_name,
-        new_volume_size, conn=None, pool_name=POOL_NAME):
+        new_volume_size, session=None, pool_name=POOL_NAME,
+        preallocation='off', cluster_size=None):
     """Create a new libvirt qcow2 volume backed by an existing volume path."""
 
-    if conn is None:
-        conn = libvirt.open('qemu:///system')
+    if session is None:
+        session = uvtool.libvirt.get_session()
 
-    pool = conn.storagePoolLookupByName(pool_name)
+    return _create_qcow2_volume(
+        session.pool(pool_name),
+        _qcow2_volume_xml(
+            new_volume_name, new_volume_size,
+            backing_volume_path=backing_volume_path,
+            preallocation=preallocation, cluster_size=cluster_size),
+        preallocation=preallocation,
+    )
 
-    new_vol = E.volume(
-        E.name(new_volume_name),
-        E.allocation('0'),
-        E.capacity(str(new_volume_size), unit='G'),
-        E.target(E.format(type='qcow2')),
-        E.backingStore(
-            E.path(backing_volume_path),
-            E.format(type='qcow2'),
-            )
-        )
-    return pool.createXML(etree.tostring(new_vol), 0)
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def _load_template(template_path):
+    """Return a copy of a parsed domain template, parsing each file once."""
+    with _templates_lock:
+        try:
+            root = _templates[template_path]
+        except KeyError:
+            root = etree.parse(template_path).getroot()
+            _templates[template_path] = root
+    return etree.ElementTree(copy.deepcopy(root))
 
 
 def compose_domain_xml(name, volumes, template_path, cpu=1, memory=512,
         unsafe_caching=False, log_console_output=False, host_passthrough=False,
-        bridge=None, ssh_known_hosts=None, disk_cache=None):
-    tree = etree.parse(template_path)
+        bridge=None, ssh_known_hosts=None, disk_cache=None,
+        smbios_serial=None, seed_token=None, fleet=None,
+        ready_channel=False):
+    tree = _load_template(template_path)
     domain = tree.getroot()
     assert domain.tag == 'domain'
 
@@ -328,14 +416,15 @@ def compose_domain_xml(name, volumes, template_path, cpu=1, memory=512,
     devices = domain.find('devices')
 
     etree.strip_elements(devices, 'disk')
+    base_image_path = None
     for num, vol in enumerate(volumes):
         disk_device = "vd%s" % string.ascii_letters[num]
+        vol_element = etree.fromstring(vol.XMLDesc(0))
         disk_format_type = (
-            etree.fromstring(vol.XMLDesc(0)).
-            find('target').
-            find('format').
-            get('type')
-            )
+            vol_element.find('target').find('format').get('type'))
+        if num == 0:
+            # Recorded so that "uvt-kvm list" need not look at the volume
+            base_image_path = vol_element.findtext('backingStore/path')
         if unsafe_caching:
             disk_driver = E.driver(
                 name='qemu', type=disk_format_type, cache='unsafe')
@@ -376,6 +465,14 @@ def compose_domain_xml(name, volumes, template_path, cpu=1, memory=512,
             etree.strip_elements(devices, 'serial')
             devices.append(E.serial(E.target(port='0'), type='stdio'))
 
+    if ready_channel:
+        # libvirt picks the host side socket path itself
+        devices.append(E.channel(
+            E.source(mode='bind'),
+            E.target(type='virtio', name=uvtool.libvirt.READY_CHANNEL_NAME),
+            type='unix',
+        ))
+
     if host_passthrough:
         if ARCH == 'aarch64':
             print("Info: on aarch64 a host type cpu is the default",
@@ -383,7 +480,19 @@ def compose_domain_xml(name, volumes, template_path, cpu=1, memory=512,
         else:
             etree.SubElement(domain, 'cpu', mode='host-passthrough')
 
-    if ssh_known_hosts:
+    if smbios_serial:
+        # Handed to the guest as its SMBIOS system serial number, where
+        # cloud-init looks for datasource configuration
+        os_element = domain.find('os')
+        etree.strip_elements(os_element, 'smbios')
+        os_element.append(E.smbios(mode='sysinfo'))
+        etree.strip_elements(domain, 'sysinfo')
+        domain.append(E.sysinfo(
+            E.system(E.entry(smbios_serial, name='serial')),
+            type='smbios',
+        ))
+
+    if ssh_known_hosts or seed_token or fleet or base_image_path:
         metadata = domain.find('metadata')
         if metadata is None:
             metadata = E.metadata()
@@ -392,20 +501,75 @@ def compose_domain_xml(name, volumes, template_path, cpu=1, memory=512,
             namespace=LIBVIRT_METADATA_XMLNS,
             nsmap={'uvt': LIBVIRT_METADATA_XMLNS}
         )
-        metadata.append(EX.ssh_known_hosts(ssh_known_hosts))
+        if ssh_known_hosts:
+            metadata.append(EX.ssh_known_hosts(ssh_known_hosts))
+        if seed_token:
+            metadata.append(EX.seed(seed_token))
+        if fleet:
+            fleet_name, spec_hash = fleet
+            metadata.append(EX.fleet(name=fleet_name, spec=spec_hash))
+        if base_image_path:
+            metadata.append(EX.base_image(path=base_image_path))
 
     return etree.tostring(tree)
 
 
-def get_base_image(filters, pool_name=POOL_NAME):
-    result = list(uvtool.libvirt.simplestreams.query(filters, pool_name=pool_name))
+def get_base_image(filters, pool_name=POOL_NAME, session=None):
+    result = list(uvtool.libvirt.simplestreams.query(
+        filters, pool_name=pool_name, session=session))
     if not result:
         raise CLIError(
             "no images found that match filters %s." % repr(filters))
     elif len(result) != 1:
         raise CLIError(
             "multiple images found that match filters %s." % repr(filters))
-    return uvtool.libvirt.simplestreams.get_libvirt_pool_name(*result[0], pool_name=pool_name)
+    return uvtool.libvirt.simplestreams.get_libvirt_pool_name(
+        *result[0], pool_name=pool_name, session=session)
+
+
+def resolve_base_image(filters, image_pool=POOL_NAME, pool=POOL_NAME,
+        backing_image_file=None, session=None):
+    """Return (base volume name, backing file path) for a new VM's disk.
+
+    Exactly one of the two is set: the name when the base image is a
+    volume in the VM's own pool, and the path otherwise.
+
+    """
+    if backing_image_file is not None:
+        return None, backing_image_file
+    base_volume_name = get_base_image(
+        filters, pool_name=image_pool, session=session)
+    if image_pool != pool:
+        return None, uvtool.libvirt.get_volume_path_by_name(
+            base_volume_name, pool_name=image_pool, session=session)
+    return base_volume_name, None
+
+
+def get_default_seed_base_url(template_path, session=None):
+    """Return where guests of a template can reach this host's seed server.
+
+    This is the host's address on the libvirt network that the template
+    attaches guests to.
+
+    """
+    source = _load_template(template_path).find(
+        "devices/interface[@type='network']/source")
+    if source is None:
+        raise CLIError(
+            "template has no libvirt network interface; use --seed-url.")
+    address = uvtool.libvirt.get_network_host_address(
+        source.get('network'), session=session)
+    if not address:
+        raise CLIError(
+            "libvirt network %s has no IPv4 address; use --seed-url." %
+            repr(source.get('network'))
+        )
+    return 'http://%s:%d/' % (address, uvtool.seed.default_seed_port())
+
+
+def _resolve(value):
+    """Return value, or what it returns if it is a callable."""
+    return value() if callable(value) else value
 
 
 def create(hostname, filters, user_data_fobj, meta_data_fobj, template_path,
@@ -413,43 +577,92 @@ def create(hostname, filters, user_data_fobj, meta_data_fobj, template_path,
            log_console_output=False, host_passthrough=False, bridge=None,
            backing_image_file=None, start=True, ssh_known_hosts=None,
            ephemeral_disks=None, image_pool=POOL_NAME, pool=POOL_NAME,
-           disk_cache=None):
-    if backing_image_file is None:
-        base_volume_name = get_base_image(filters, pool_name=image_pool)
-        if image_pool != pool:
-            backing_image_file = uvtool.libvirt.get_volume_path_by_name(
-                base_volume_name, pool_name=image_pool)
+           disk_cache=None, seed_mode='volume', seed_base_url=None,
+           preallocation='off', cluster_size=None, base_image=None,
+           fleet=None, ready_channel=False, session=None):
+    """Create, and by default start, a new VM.
+
+    The volumes and seed that make up the VM are prepared concurrently.
+    user_data_fobj and ssh_known_hosts may be given as callables that
+    return them, so that slow work such as ssh host key generation can
+    happen alongside. base_image, if given, is the result of
+    resolve_base_image for filters, which saves looking it up again.
+    fleet, if given, is the (fleet name, spec hash) pair that "uvt-kvm
+    apply" records in the domain to recognise VMs it manages.
+    ready_channel adds the channel that the default user-data uses to tell
+    "uvt-kvm wait" that the guest has finished booting.
+
+    How long each part took is recorded in the domain; see
+    uvtool.libvirt.get_domain_timings.
+
+    """
+    timings = uvtool.timing.Timings()
+    if session is None:
+        session = uvtool.libvirt.get_session()
     if ephemeral_disks is None:
         ephemeral_disks = []
+    undo_lock = threading.Lock()
     undo_volume_creation = []
-    try:
+    seed_tokens = []
+
+    def created(vol):
+        with undo_lock:
+            undo_volume_creation.append(vol)
+        return vol
+
+    def create_main_volume(base_image):
         # cow image names must end in ".qcow" so that the current Apparmor
         # profile for /usr/lib/libvirt/virt-aa-helper is able to read them,
         # determine their backing volumes, and generate a dynamic libvirt
         # profile that permits reading the backing volume. Once our pool
         # directory is added to the virt-aa-helper profile, this requirement
         # can be dropped.
-
-        if backing_image_file:
-            main_vol = create_cow_volume_by_path(
-                backing_image_file, "%s.qcow" % hostname, disk, pool_name=pool)
+        base_volume_name, backing_path = base_image
+        if backing_path:
+            return created(create_cow_volume_by_path(
+                backing_path, "%s.qcow" % hostname, disk,
+                session=session, pool_name=pool,
+                preallocation=preallocation, cluster_size=cluster_size))
         else:
-            main_vol = create_cow_volume(
-                base_volume_name, "%s.qcow" % hostname, disk, pool_name=pool)
-        undo_volume_creation.append(main_vol)
-
-        ds_vol = create_ds_volume(
-            "%s-ds.qcow" % hostname, hostname, user_data_fobj, meta_data_fobj,
-            pool)
-        undo_volume_creation.append(ds_vol)
-
-        volumes = [main_vol, ds_vol]
-        for num, ephem_size in enumerate(ephemeral_disks):
-            vol = create_new_volume(
-                "%s-ephem-%02d.qcow" % (hostname, num), ephem_size)
-            undo_volume_creation.append(vol)
-            volumes.append(vol)
-
+            return created(create_cow_volume(
+                base_volume_name, "%s.qcow" % hostname, disk,
+                session=session, pool_name=pool,
+                preallocation=preallocation, cluster_size=cluster_size))
+
+    def create_seed():
+        """Return the seed volume and SMBIOS serial, whichever is used."""
+        user_data = _resolve(user_data_fobj)
+        if seed_mode == 'smbios':
+            base_url = seed_base_url
+            if base_url is None:
+                if bridge:
+                    raise CLIError("--bridge requires --seed-url.")
+                base_url = get_default_seed_base_url(
+                    template_path, session=session)
+            seed_token = uvtool.seed.store_seed(
+                user_data.read(), meta_data_fobj.read())
+            with undo_lock:
+                seed_tokens.append(seed_token)
+            uvtool.seed.ensure_seed_server(base_url, seed_token)
+            return None, 'ds=nocloud-net;s=%s' % uvtool.seed.seed_url(
+                base_url, seed_token)
+        else:
+            # The seed is raw now, but keep the name that existing tools
+            # expect
+            return created(create_ds_volume(
+                "%s-ds.qcow" % hostname, hostname, user_data,
+                meta_data_fobj, pool, session=session)), None
+
+    def create_ephemeral_volume(num, ephem_size):
+        return created(create_new_volume(
+            "%s-ephem-%02d.qcow" % (hostname, num), ephem_size,
+            session=session, pool_name=pool,
+            preallocation=preallocation, cluster_size=cluster_size))
+
+    def define(main_vol, seed, known_hosts, *ephemeral_vols):
+        ds_vol, smbios_serial = seed
+        volumes = [main_vol] + ([ds_vol] if ds_vol else [])
+        volumes.extend(ephemeral_vols)
         xml = compose_domain_xml(
             hostname, volumes=volumes,
             bridge=bridge,
@@ -459,14 +672,39 @@ def create(hostname, filters, user_data_fobj, meta_data_fobj, template_path,
             memory=memory,
             template_path=template_path,
             unsafe_caching=unsafe_caching,
-            ssh_known_hosts=ssh_known_hosts,
-            disk_cache=disk_cache
+            ssh_known_hosts=known_hosts,
+            disk_cache=disk_cache,
+            smbios_serial=smbios_serial,
+            seed_token=seed_tokens[0] if seed_tokens else None,
+            ready_channel=ready_channel,
+            fleet=fleet,
         )
-        conn = libvirt.open('qemu:///system')
-        domain = conn.defineXML(xml)
+        return session.conn.defineXML(xml)
+
+    graph = uvtool.parallel.TaskGraph()
+    graph.add('base-image', lambda: base_image or resolve_base_image(
+        filters, image_pool=image_pool, pool=pool,
+        backing_image_file=backing_image_file, session=session))
+    graph.add('main-volume', create_main_volume, requires=['base-image'])
+    graph.add('seed', create_seed)
+    graph.add('ssh-known-hosts', lambda: _resolve(ssh_known_hosts))
+    ephemeral_tasks = []
+    for num, ephem_size in enumerate(ephemeral_disks):
+        name = 'ephemeral-%02d' % num
+        graph.add(name, functools.partial(
+            create_ephemeral_volume, num, ephem_size))
+        ephemeral_tasks.append(name)
+    graph.add(
+        'define', define,
+        requires=['main-volume', 'seed', 'ssh-known-hosts'] + ephemeral_tasks
+    )
+
+    try:
+        domain = graph.run(timings=timings)['define']
         if start:
             try:
-                domain.create()
+                with timings.phase('start'):
+                    domain.create()
             except:
                 if ARCH == 'aarch64':
                     # aarch runs with nvram per our default template, flag
@@ -478,26 +716,102 @@ def create(hostname, filters, user_data_fobj, meta_data_fobj, template_path,
     except:
         for vol in undo_volume_creation:
             vol.delete(0)
+        for seed_token in seed_tokens:
+            uvtool.seed.remove_seed(seed_token)
         raise
+    record_timings(domain, 'create', timings)
+
+
+def record_timings(domain, operation, timings):
+    """Store timings in domain, if this libvirt can."""
+    try:
+        uvtool.libvirt.record_domain_timings(
+            domain, operation, timings.as_dict())
+    except libvirt.libvirtError:
+        # They are only diagnostics, so not worth failing over
+        pass
+
+
+def create_many(hostnames, filters, instance_data, template_path,
+        jobs=DEFAULT_CREATE_JOBS, image_pool=POOL_NAME, pool=POOL_NAME,
+        backing_image_file=None, session=None, **kwargs):
+    """Create a VM for each of hostnames alike, at most jobs at a time.
+
+    The base image is looked up once for all of them, and they share one
+    libvirt connection. instance_data(hostname) returns the user_data_fobj,
+    meta_data_fobj and ssh_known_hosts for each VM, as accepted by create();
+    any other create() arguments are given as keyword arguments.
+
+    Return the finished uvtool.parallel.Job for each VM, in order. A VM that
+    failed has already been rolled back, without affecting the others.
+
+    """
+    if session is None:
+        session = uvtool.libvirt.get_session()
+    base_image = resolve_base_image(
+        filters, image_pool=image_pool, pool=pool,
+        backing_image_file=backing_image_file, session=session)
+
+    def create_one(hostname):
+        user_data_fobj, meta_data_fobj, ssh_known_hosts = (
+            instance_data(hostname))
+        create(
+            hostname, filters, user_data_fobj, meta_data_fobj,
+            template_path, ssh_known_hosts=ssh_known_hosts,
+            image_pool=image_pool, pool=pool, base_image=base_image,
+            session=session, **kwargs
+        )
+
+    return uvtool.parallel.run_all(create_one, hostnames, jobs)
+
+
+def _delete_volume(session, path, discard=False):
+    pool_name, volume_name = session.volume_by_path(path)
+    if discard:
+        try:
+            session.volume(volume_name, pool_name).wipePattern(
+                libvirt.VIR_STORAGE_VOL_WIPE_ALG_TRIM, 0)
+        except libvirt.libvirtError:
+            # Not every pool or volume can discard; deleting is enough
+            pass
+    session.delete_volume(volume_name, pool_name)
 
 
-def delete_domain_volumes(conn, domain):
+def delete_domain_volumes(session, domain, discard=False, pool=None):
     """Delete all volumes associated with a domain.
 
-    :param conn: libvirt connection object
+    :param session: uvtool.libvirt.Session, through which the volumes are
+        looked up and deleted
     :param domain: libvirt domain object
+    :param discard: discard each volume's data first, so that thin
+        provisioned storage gets the space back at once
+    :param pool: uvtool.parallel.WorkerPool to delete the volumes on
+        concurrently; without one, they are deleted one after another
 
     """
     domain_xml = etree.fromstring(domain.XMLDesc(0))
     assert domain_xml.tag == 'domain'
-    for disk in domain_xml.find('devices').iter('disk'):
-        disk_file = disk.find('source').get('file')
-        vol = conn.storageVolLookupByKey(disk_file)
-        vol.delete(0)
+    disk_files = [
+        disk.find('source').get('file')
+        for disk in domain_xml.find('devices').iter('disk')
+    ]
+    if pool is None:
+        for disk_file in disk_files:
+            _delete_volume(session, disk_file, discard=discard)
+        return
+    jobs = [
+        pool.submit(_delete_volume, session, disk_file, discard=discard)
+        for disk_file in disk_files
+    ]
+    pool.wait_for(jobs)
+    for job in jobs:
+        job.result()
 
 
-def destroy(hostname):
-    conn = libvirt.open('qemu:///system')
+def destroy(hostname, session=None, discard=False, pool=None):
+    if session is None:
+        session = uvtool.libvirt.get_session()
+    conn = session.conn
     try:
         domain = conn.lookupByName(hostname)
     except libvirt.libvirtError as e:
@@ -509,7 +823,10 @@ def destroy(hostname):
     if state != libvirt.VIR_DOMAIN_SHUTOFF:
         domain.destroy()
 
-    delete_domain_volumes(conn, domain)
+    seed_token = uvtool.libvirt.get_domain_seed_token(domain)
+    delete_domain_volumes(session, domain, discard=discard, pool=pool)
+    if seed_token:
+        uvtool.seed.remove_seed(seed_token)
 
     if ARCH == 'aarch64':
         # aarch runs with nvram per our default template, flag
@@ -519,6 +836,403 @@ def destroy(hostname):
         domain.undefine()
 
 
+def select_domains(selectors, regex=False, created_by_uvtool=False,
+        session=None):
+    """Return the names of the domains matching any of selectors.
+
+    Selectors are glob patterns, or regular expressions that must match a
+    whole name if regex is set. A selector without any glob characters is
+    a plain name, which is returned whether or not the domain exists. With
+    created_by_uvtool, every domain that uvtool created is selected too.
+
+    """
+    if session is None:
+        session = uvtool.libvirt.get_session()
+    names = []
+    patterns = []
+    for selector in selectors:
+        if regex:
+            patterns.append(re.compile(r'(?:%s)\Z' % selector).match)
+        elif any(c in selector for c in '*?['):
+            patterns.append(re.compile(fnmatch.translate(selector)).match)
+        else:
+            names.append(selector)
+    if patterns or created_by_uvtool:
+        for domain in session.conn.listAllDomains(0):
+            name = domain.name()
+            if name in names:
+                continue
+            if (any(match(name) for match in patterns) or (
+                    created_by_uvtool and
+                    uvtool.libvirt.is_uvtool_domain(domain))):
+                names.append(name)
+    return names
+
+
+def destroy_many(hostnames, jobs=DEFAULT_DESTROY_JOBS, session=None,
+        discard=False):
+    """Destroy each of hostnames, at most jobs at a time.
+
+    The volumes of each VM are deleted on the same threads. Return the
+    finished uvtool.parallel.Job for each, in order.
+
+    """
+    if session is None:
+        session = uvtool.libvirt.get_session()
+    with uvtool.parallel.WorkerPool(jobs) as pool:
+        submitted = [
+            pool.submit(
+                destroy, hostname, session=session, discard=discard,
+                pool=pool)
+            for hostname in hostnames
+        ]
+    return submitted
+
+
+FLEET_SPEC_DEFAULTS = {
+    'filters': None,
+    'cpu': 1,
+    'memory': 512,
+    'disk': 8,
+    'ephemeral_disks': [],
+    'bridge': None,
+    'packages': [],
+}
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _normalise_vm_spec(fields, where):
+    """Check the fields of a VM in a fleet spec and return them normalised."""
+    if not isinstance(fields, dict):
+        raise CLIError("%s in fleet spec must be a mapping." % where)
+    unknown = set(fields) - set(FLEET_SPEC_DEFAULTS)
+    if unknown:
+        raise CLIError(
+            "unknown fields in %s of fleet spec: %s" %
+            (where, ', '.join(sorted(unknown)))
+        )
+    result = {}
+    try:
+        for key, value in fields.items():
+            if key == 'filters':
+                # Order does not matter, so it must not change the hash
+                result[key] = sorted(str(f) for f in _as_list(value)) or None
+            elif key == 'packages':
+                result[key] = [str(p) for p in _as_list(value)]
+            elif key == 'ephemeral_disks':
+                result[key] = [int(size) for size in _as_list(value)]
+            elif key == 'bridge':
+                result[key] = str(value) if value is not None else None
+            else:
+                result[key] = int(value)
+    except (TypeError, ValueError):
+        raise CLIError("invalid %s in %s of fleet spec." % (key, where))
+    return result
+
+
+def load_fleet_spec(fobj, default_name=None):
+    """Read a fleet spec, returning its name and each VM's spec by hostname.
+
+    A fleet spec is a YAML mapping with a "vms" list, an optional "name" and
+    optional "defaults" for every VM. Each VM is a mapping with a hostname
+    and any of the keys of FLEET_SPEC_DEFAULTS, which supplies whatever
+    neither the VM nor the spec's defaults give.
+
+    """
+    try:
+        document = yaml.safe_load(fobj)
+    except yaml.YAMLError as e:
+        raise CLIError("cannot parse fleet spec: %s" % e)
+    if not isinstance(document, dict) or not isinstance(
+            document.get('vms'), list):
+        raise CLIError('fleet spec must be a mapping with a "vms" list.')
+    unknown = set(document) - set(['name', 'defaults', 'vms'])
+    if unknown:
+        raise CLIError(
+            "unknown fields in fleet spec: %s" % ', '.join(sorted(unknown)))
+    name = document.get('name', default_name)
+    if not name:
+        raise CLIError("fleet spec needs a name.")
+
+    defaults = dict(FLEET_SPEC_DEFAULTS)
+    defaults.update(
+        _normalise_vm_spec(document.get('defaults') or {}, 'defaults'))
+    specs = collections.OrderedDict()
+    for entry in document['vms']:
+        if not isinstance(entry, dict) or not entry.get('hostname'):
+            raise CLIError("each VM in fleet spec needs a hostname.")
+        entry = dict(entry)
+        hostname = str(entry.pop('hostname'))
+        if hostname in specs:
+            raise CLIError(
+                "%s appears twice in fleet spec." % repr(hostname))
+        spec = dict(defaults)
+        spec.update(_normalise_vm_spec(entry, repr(hostname)))
+        specs[hostname] = spec
+    return str(name), specs
+
+
+def fleet_spec_hash(hostname, spec):
+    return hashlib.sha256(
+        json.dumps([hostname, spec], sort_keys=True)).hexdigest()
+
+
+def plan_fleet(fleet_name, specs, session=None):
+    """Return the (action, hostname) steps that bring a fleet in line.
+
+    action is "create", "replace", "destroy" or "keep". Only domains that
+    were created for this fleet are ever replaced or destroyed; any other
+    domain with the name of a VM in the spec is an error.
+
+    """
+    if session is None:
+        session = uvtool.libvirt.get_session()
+    existing = dict(
+        (domain.name(), uvtool.libvirt.get_domain_fleet(domain))
+        for domain in session.conn.listAllDomains(0)
+    )
+    plan = []
+    for hostname, spec in specs.items():
+        if hostname not in existing:
+            plan.append(('create', hostname))
+        elif not existing[hostname] or existing[hostname][0] != fleet_name:
+            raise CLIError(
+                "domain %s exists but is not part of fleet %s." %
+                (repr(hostname), repr(fleet_name))
+            )
+        elif existing[hostname][1] == fleet_spec_hash(hostname, spec):
+            plan.append(('keep', hostname))
+        else:
+            plan.append(('replace', hostname))
+    for hostname, fleet in sorted(existing.items()):
+        if fleet and fleet[0] == fleet_name and hostname not in specs:
+            plan.append(('destroy', hostname))
+    return plan
+
+
+def apply_fleet(fleet_name, specs, instance_data, template_path,
+        default_filters, jobs=DEFAULT_CREATE_JOBS, image_pool=POOL_NAME,
+        pool=POOL_NAME, session=None, **kwargs):
+    """Create, replace and destroy VMs so that they match a fleet spec.
+
+    specs are as returned by load_fleet_spec. instance_data(hostname, spec)
+    returns the user_data_fobj, meta_data_fobj and ssh_known_hosts for each
+    VM to create, as accepted by create(); other create() arguments are
+    given as keyword arguments. VMs whose filters are not given use
+    default_filters.
+
+    Return (action, hostname, job) for each step taken by plan_fleet, where
+    job is the finished uvtool.parallel.Job for the step, or None for VMs
+    that were already up to date.
+
+    """
+    if session is None:
+        session = uvtool.libvirt.get_session()
+    plan = plan_fleet(fleet_name, specs, session=session)
+
+    # Look up each distinct base image once, and fail before changing
+    # anything if one is missing
+    base_images = {}
+    for action, hostname in plan:
+        if action in ['create', 'replace']:
+            filters = specs[hostname]['filters'] or default_filters
+            if tuple(filters) not in base_images:
+                base_images[tuple(filters)] = resolve_base_image(
+                    filters, image_pool=image_pool, pool=pool,
+                    session=session)
+
+    def take_step(step):
+        action, hostname = step
+        if action in ['replace', 'destroy']:
+            destroy(hostname, session=session)
+        if action in ['create', 'replace']:
+            spec = specs[hostname]
+            filters = spec['filters'] or default_filters
+            user_data_fobj, meta_data_fobj, ssh_known_hosts = instance_data(
+                hostname, spec)
+            create(
+                hostname, filters, user_data_fobj, meta_data_fobj,
+                template_path, cpu=spec['cpu'], memory=spec['memory'],
+                disk=spec['disk'], ephemeral_disks=spec['ephemeral_disks'],
+                bridge=spec['bridge'], ssh_known_hosts=ssh_known_hosts,
+                image_pool=image_pool, pool=pool,
+                base_image=base_images[tuple(filters)],
+                fleet=(fleet_name, fleet_spec_hash(hostname, spec)),
+                session=session, **kwargs
+            )
+
+    steps = [step for step in plan if step[0] != 'keep']
+    finished = dict(zip(
+        steps, uvtool.parallel.run_all(take_step, steps, jobs)))
+    return [
+        (action, hostname, finished.get((action, hostname)))
+        for action, hostname in plan
+    ]
+
+
+DOMAIN_STATE_NAMES = {
+    libvirt.VIR_DOMAIN_NOSTATE: 'no state',
+    libvirt.VIR_DOMAIN_RUNNING: 'running',
+    libvirt.VIR_DOMAIN_BLOCKED: 'blocked',
+    libvirt.VIR_DOMAIN_PAUSED: 'paused',
+    libvirt.VIR_DOMAIN_SHUTDOWN: 'shutting down',
+    libvirt.VIR_DOMAIN_SHUTOFF: 'shut off',
+    libvirt.VIR_DOMAIN_CRASHED: 'crashed',
+    libvirt.VIR_DOMAIN_PMSUSPENDED: 'suspended',
+}
+
+
+def _base_image_path(element):
+    """Return the path at the bottom of the first disk's backing chain.
+
+    Only the domain definition is used. Running domains show the whole
+    chain there, and uvtool records the base image of the domains it
+    creates; otherwise the base image is unknown and None is returned.
+
+    """
+    disk = element.find("devices/disk[@device='disk']")
+    if disk is None or disk.find('source') is None:
+        return None
+    backing = disk
+    while backing.find('backingStore/source') is not None:
+        backing = backing.find('backingStore')
+    if backing is not disk:
+        return backing.find('source').get('file')
+    recorded = element.xpath(
+        '/domain/metadata/uvt:base_image/@path',
+        namespaces={'uvt': LIBVIRT_METADATA_XMLNS}
+    )
+    if recorded:
+        return recorded[0]
+    if disk.find('backingStore') is not None:
+        # An empty backingStore: the disk has no backing file
+        return disk.find('source').get('file')
+    return None
+
+
+def _local_qemu_run_dir(uri):
+    """Return where the qemu driver behind uri keeps its pid files, if
+    they are on this host and in a known place.
+
+    """
+    parts = urlparse.urlsplit(uri)
+    if parts.scheme == 'qemu' and not parts.netloc and parts.path == '/system':
+        return LIBVIRT_QEMU_RUN_DIR
+    return None
+
+
+def _domain_uptime(run_dir, name, now):
+    # libvirt does not report when a domain started, but the qemu driver
+    # writes its pid file then
+    if run_dir is None:
+        return None
+    try:
+        started = os.stat(os.path.join(run_dir, '%s.pid' % name)).st_mtime
+    except OSError:
+        return None
+    return max(0, int(now - started))
+
+
+def list_domains(include_all=False, details=True, session=None):
+    """Return a dict describing each VM, sorted by name.
+
+    Only VMs created by uvtool are included, unless include_all is set.
+    Each dict has the VM's name and, with details, its state, IP addresses,
+    base image, vcpus, memory in MiB, first disk's size in GiB and uptime in
+    seconds. Values that cannot be determined are None; uptime is only
+    known for the local qemu:///system connection.
+
+    All domains and their statistics are fetched in one call each, and the
+    IP addresses of all of them are looked up together. Beyond that, each
+    domain's definition is read once, for its MAC addresses and uvtool
+    metadata, which no bulk call reports; no volume is looked at.
+
+    """
+    if session is None:
+        session = uvtool.libvirt.get_session()
+    conn = session.conn
+    if details:
+        domain_stats = conn.getAllDomainStats(
+            libvirt.VIR_DOMAIN_STATS_STATE |
+            libvirt.VIR_DOMAIN_STATS_BALLOON |
+            libvirt.VIR_DOMAIN_STATS_VCPU |
+            libvirt.VIR_DOMAIN_STATS_BLOCK,
+            0
+        )
+        run_dir = _local_qemu_run_dir(session.uri)
+    else:
+        domain_stats = [(domain, {}) for domain in conn.listAllDomains(0)]
+    now = time.time()
+
+    vms = []
+    vm_macs = {}
+    base_image_paths = {}
+    for domain, stats in domain_stats:
+        element = etree.fromstring(domain.XMLDesc(0))
+        if not include_all and not uvtool.libvirt.is_uvtool_domain(
+                domain, xml=element):
+            continue
+        vm = {'name': domain.name()}
+        vms.append(vm)
+        if not details:
+            continue
+
+        state = stats.get('state.state')
+        vm['state'] = DOMAIN_STATE_NAMES.get(state)
+        vm_macs[vm['name']] = [
+            mac.get('address') for mac in
+            element.xpath('/domain/devices/interface/mac[@address]')
+        ]
+        vcpus = stats.get('vcpu.current', element.findtext('vcpu'))
+        vm['vcpus'] = int(vcpus) if vcpus else None
+        memory = stats.get(
+            'balloon.current', element.findtext('currentMemory'))
+        vm['memory'] = int(memory) // 1024 if memory else None
+        capacity = stats.get('block.0.capacity')
+        vm['disk'] = (
+            round(capacity / (1024.0 ** 3), 1) if capacity is not None
+            else None
+        )
+        if state == libvirt.VIR_DOMAIN_RUNNING:
+            vm['uptime'] = _domain_uptime(run_dir, vm['name'], now)
+        else:
+            vm['uptime'] = None
+        base_image_paths[vm['name']] = _base_image_path(element)
+
+    if details:
+        ips = macs_to_ips(
+            list(itertools.chain(*vm_macs.values())), session=session)
+        for vm in vms:
+            vm['ips'] = [
+                ips[mac] for mac in vm_macs[vm['name']] if mac in ips]
+
+        descriptions = uvtool.libvirt.simplestreams.volume_descriptions(
+            os.path.basename(path)
+            for path in base_image_paths.values() if path
+        )
+        for vm in vms:
+            path = base_image_paths[vm['name']]
+            vm['base_image'] = descriptions.get(
+                os.path.basename(path), path) if path else None
+
+    return sorted(vms, key=lambda vm: vm['name'])
+
+
+def _format_uptime(seconds):
+    if seconds is None:
+        return '-'
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    if days:
+        return '%dd%02dh' % (days, hours)
+    return '%d:%02d' % (hours, seconds // 60)
+
+
 def get_lts_series():
     output = subprocess.check_output(['distro-info', '--lts'], close_fds=True)
     return output.strip()
@@ -558,13 +1272,21 @@ def check_kvm_ok():
     return (False, stdout) if process.returncode else (True, None)
 
 
-def name_to_ips(name):
-    macs = uvtool.libvirt.get_domain_macs(name)
-    return [
-        ip for ip
-        in (uvtool.libvirt.mac_to_ip(mac) for mac in macs)
-        if ip
+def macs_to_ips(macs, session=None):
+    """Look up IP addresses through watchd if it is running and working."""
+    try:
+        return uvtool.watchd.macs_to_ips(macs, session=session)
+    except uvtool.watchd.WatchdError:
+        return uvtool.libvirt.macs_to_ips(macs, session=session)
+
+
+def name_to_ips(name, session=None):
+    macs = [
+        mac['address']
+        for mac in uvtool.libvirt.get_domain_macs(name, session=session)
     ]
+    ips = macs_to_ips(macs, session=session)
+    return [ips[mac] for mac in macs if mac in ips]
 
 
 def ssh(name, login_name, arguments, stdin=None, checked=False, sysexit=True,
@@ -631,6 +1353,62 @@ def ssh(name, login_name, arguments, stdin=None, checked=False, sysexit=True,
         [x.close() for x in objects_to_close]
 
 
+def print_vm_error(hostname, exception, doing=None):
+    """Report the failure of one VM of many, in the style of errors."""
+    if isinstance(exception, libvirt.libvirtError):
+        message = 'libvirt: %s' % exception.get_error_message()
+    else:
+        message = exception
+    if doing:
+        message = '%s: %s' % (doing, message)
+    print(
+        "%s: error: %s: %s" % (
+            os.path.basename(sys.argv[0]), hostname, message),
+        file=sys.stderr
+    )
+
+
+def default_instance_data(args, key_types):
+    """Return an instance_data function for create_many from CLI options.
+
+    Each VM gets the default cloud-init data for args, or the user-data and
+    meta-data files given in args, and its own ssh host keys.
+
+    """
+    # User supplied data is read once and given to every VM
+    user_data = args.user_data.read() if args.user_data else None
+    meta_data = args.meta_data.read() if args.meta_data else None
+
+    def instance_data(hostname):
+        instance_args = copy.copy(args)
+        instance_args.hostname = hostname
+        if user_data is not None:
+            instance_args.user_data = io.BytesIO(user_data)
+        if meta_data is not None:
+            instance_args.meta_data = io.BytesIO(meta_data)
+
+        # Host keys are only needed once create() gets to the seed and
+        # domain definition, so take them while it prepares the rest.
+        host_keys = uvtool.parallel.start_job(
+            uvtool.ssh.take_ssh_host_keys,
+            key_types, pool_size=args.ssh_host_key_pool_size
+        )
+
+        def user_data_fobj():
+            return apply_default_fobj(
+                instance_args, 'user_data',
+                lambda fobj, args: create_default_user_data(
+                    fobj, args, ssh_host_keys=host_keys.result()[0])
+            )
+        meta_data_fobj = apply_default_fobj(
+            instance_args, 'meta_data', create_default_meta_data
+        )
+        return (
+            user_data_fobj, meta_data_fobj, lambda: host_keys.result()[1])
+
+    return instance_data
+
+
 def main_create(parser, args):
     if args.user_data and args.password:
         parser.error("--password cannot be used with --user-data.")
@@ -649,17 +1427,54 @@ def main_create(parser, args):
         )
         return
 
-    ssh_host_keys, ssh_known_hosts = uvtool.ssh.generate_ssh_host_keys()
+    if args.cluster_size is not None and (
+            args.cluster_size < 1 or args.cluster_size > 2048 or
+            args.cluster_size & (args.cluster_size - 1)):
+        parser.error(
+            "--cluster-size must be a power of two between 1 and 2048.")
+    if args.seed_url and args.seed_mode != 'smbios':
+        parser.error("--seed-url requires --seed-mode=smbios.")
+    if args.seed_mode == 'smbios':
+        print(
+            "Warning: --seed-mode=smbios serves user-data, including the " +
+                "guest's ssh host keys, over unauthenticated HTTP to " +
+                "anything that can reach the seed server and learn its URL.",
+            file=sys.stderr
+        )
 
-    user_data_fobj = apply_default_fobj(
-        args, 'user_data', functools.partial(
-            create_default_user_data,
-            ssh_host_keys=ssh_host_keys
+    key_types = args.ssh_host_key_types.split(',')
+    unknown_key_types = set(key_types) - set(uvtool.ssh.KEY_TYPES)
+    if unknown_key_types:
+        parser.error(
+            "unknown ssh host key types: %s" %
+            ', '.join(sorted(unknown_key_types))
         )
-    )
-    meta_data_fobj = apply_default_fobj(
-        args, 'meta_data', create_default_meta_data
-    )
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    if args.count is not None and args.count < 1:
+        parser.error("--count must be at least 1.")
+    if args.count is None and args.name_pattern is None:
+        if args.hostname is None:
+            parser.error("a hostname is required.")
+        hostnames = [args.hostname]
+        filters = args.filters
+    elif args.count is None or args.name_pattern is None:
+        parser.error("--count and --name-pattern must be used together.")
+    else:
+        try:
+            hostnames = [
+                args.name_pattern % i for i in range(1, args.count + 1)]
+        except (TypeError, ValueError):
+            parser.error(
+                "--name-pattern must contain one integer format such as %d.")
+        if len(set(hostnames)) != len(hostnames):
+            parser.error(
+                "--name-pattern must give each VM a different name.")
+        # Without a hostname, the first filter lands in its place
+        filters = [args.hostname] if args.hostname else []
+        filters.extend(args.filters or [])
+    if not filters:
+        filters = ["release=%s" % get_lts_series()]
 
     template = get_template_path(ARCH)
     if args.guest_arch:
@@ -672,8 +1487,9 @@ def main_create(parser, args):
         abs_image_backing_file = os.path.abspath(args.backing_image_file)
     else:
         abs_image_backing_file = None
-    create(
-        args.hostname, args.filters, user_data_fobj, meta_data_fobj,
+    jobs = create_many(
+        hostnames, filters, default_instance_data(args, key_types),
+        jobs=args.jobs,
         backing_image_file=abs_image_backing_file,
         bridge=args.bridge,
         cpu=args.cpu,
@@ -684,23 +1500,190 @@ def main_create(parser, args):
         template_path=template,
         unsafe_caching=args.unsafe_caching,
         start=not args.no_start,
-        ssh_known_hosts=ssh_known_hosts,
         ephemeral_disks=args.ephemeral_disks,
         image_pool=args.image_pool,
         pool=args.pool,
         disk_cache=args.disk_cache,
+        seed_mode=args.seed_mode,
+        seed_base_url=args.seed_url,
+        preallocation=args.preallocation,
+        cluster_size=args.cluster_size,
+        # Only the default user-data sends the message
+        ready_channel=args.ready_channel and not args.user_data,
     )
+    if args.count is None:
+        jobs[0].result()
+        if args.timings:
+            print_timings_report(hostnames)
+        return
+
+    failures = 0
+    for hostname, job in zip(hostnames, jobs):
+        if job.exception is None:
+            if not args.timings:
+                print(hostname)
+            continue
+        failures += 1
+        print_vm_error(hostname, job.exception)
+    if args.timings:
+        print_timings_report([
+            hostname for hostname, job in zip(hostnames, jobs)
+            if job.exception is None
+        ])
+    if failures:
+        raise CLIError(
+            "failed to create %d of %d VMs." % (failures, len(hostnames)))
+
+
+def print_timings_report(hostnames, session=None):
+    """Print the timings stored in each of hostnames, as JSON."""
+    if session is None:
+        session = uvtool.libvirt.get_session()
+    report = {}
+    for hostname in hostnames:
+        try:
+            domain = session.conn.lookupByName(hostname)
+        except libvirt.libvirtError:
+            continue
+        report[hostname] = uvtool.libvirt.get_domain_timings(domain)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+
+FLEET_ACTION_RESULTS = {
+    'create': 'created',
+    'replace': 'replaced',
+    'destroy': 'destroyed',
+    'keep': 'unchanged',
+}
+
+
+def main_apply(parser, args):
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    default_name = None
+    if args.spec is not sys.stdin:
+        default_name = os.path.splitext(os.path.basename(args.spec.name))[0]
+    fleet_name, specs = load_fleet_spec(args.spec, default_name)
+
+    if args.dry_run:
+        for action, hostname in plan_fleet(fleet_name, specs):
+            print("%s: %s" % (hostname, action))
+        return
+
+    template = get_template_path(ARCH)
+    if args.template:
+        template = args.template
+
+    def instance_data(hostname, spec):
+        vm_args = copy.copy(args)
+        vm_args.packages = spec['packages']
+        return default_instance_data(vm_args, uvtool.ssh.KEY_TYPES)(hostname)
+
+    steps = apply_fleet(
+        fleet_name, specs, instance_data, template,
+        default_filters=["release=%s" % get_lts_series()],
+        jobs=args.jobs,
+        image_pool=args.image_pool,
+        pool=args.pool,
+        ready_channel=args.ready_channel,
+    )
+    failures = 0
+    for action, hostname, job in steps:
+        if job is None or job.exception is None:
+            print("%s: %s" % (hostname, FLEET_ACTION_RESULTS[action]))
+            continue
+        failures += 1
+        print_vm_error(hostname, job.exception, "failed to %s" % action)
+    if failures:
+        raise CLIError(
+            "failed to apply %d of %d changes to fleet %s." % (
+                failures,
+                len([step for step in steps if step[2] is not None]),
+                repr(fleet_name)
+            )
+        )
 
 
 def main_destroy(parser, args):
-    for h in args.hostname:
-        destroy(h)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    if not args.hostname and not args.all_created_by_uvtool:
+        parser.error("no domains given.")
+    if args.regex:
+        for selector in args.hostname:
+            try:
+                re.compile(selector)
+            except re.error as e:
+                parser.error("invalid --regex %s: %s" % (repr(selector), e))
+    hostnames = select_domains(
+        args.hostname, regex=args.regex,
+        created_by_uvtool=args.all_created_by_uvtool,
+    )
+    jobs = destroy_many(hostnames, jobs=args.jobs, discard=args.discard)
+    if len(jobs) == 1:
+        jobs[0].result()
+        return
+
+    failures = 0
+    for hostname, job in zip(hostnames, jobs):
+        if job.exception is None:
+            continue
+        failures += 1
+        print_vm_error(hostname, job.exception)
+    if failures:
+        raise CLIError(
+            "failed to destroy %d of %d VMs." % (failures, len(hostnames)))
+
+
+def main_seed_server(parser, args):
+    if args.address:
+        address = args.address
+    else:
+        address = uvtool.libvirt.get_network_host_address(args.network)
+        if not address:
+            raise CLIError(
+                "libvirt network %s has no IPv4 address." %
+                repr(args.network)
+            )
+    uvtool.seed.serve(address, args.port)
+
+
+def main_watchd(parser, args):
+    try:
+        uvtool.watchd.serve(args.connect, args.socket)
+    except RuntimeError as e:
+        raise CLIError(e)
 
 
 def main_list(parser, args):
-    # Hack for now. In time this should properly use the API and list
-    # only instances created with this tool.
-    subprocess.check_call('virsh -q list --all|awk \'{print $2}\'', shell=True)
+    vms = list_domains(
+        include_all=args.all, details=(args.format != 'names'))
+    if args.format == 'json':
+        json.dump(vms, sys.stdout, indent=2, sort_keys=True)
+        print()
+    elif args.format == 'table':
+        rows = [['NAME', 'STATE', 'IP', 'VCPU', 'MEMORY', 'DISK', 'UPTIME',
+            'BASE IMAGE']]
+        for vm in vms:
+            rows.append([
+                vm['name'],
+                vm['state'] or '-',
+                ','.join(vm['ips']) or '-',
+                str(vm['vcpus'] or '-'),
+                '%dM' % vm['memory'] if vm['memory'] else '-',
+                '%gG' % vm['disk'] if vm['disk'] is not None else '-',
+                _format_uptime(vm['uptime']),
+                vm['base_image'] or '-',
+            ])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            print('  '.join(
+                cell.ljust(width) for cell, width in zip(row, widths)
+            ).rstrip())
+    else:
+        for vm in vms:
+            print(vm['name'])
 
 
 def main_ip(parser, args):
@@ -738,20 +1721,23 @@ def main_ssh(parser, args, default_login_name='ubuntu'):
         )
 
 
-def main_wait_remote(parser, args):
+def main_wait_remote(parser, args, name, timeout=None):
+    if timeout is None:
+        timeout = args.timeout
     with open(args.remote_wait_script, 'rb') as wait_script:
         try:
             ssh(
-                args.name,
+                name,
                 args.remote_wait_user,
                 [
                     'env',
                     'UVTOOL_WAIT_INTERVAL=%s' % args.interval,
-                    'UVTOOL_WAIT_TIMEOUT=%s' % args.timeout,
+                    'UVTOOL_WAIT_TIMEOUT=%s' % timeout,
                     'sh',
                     '-'
                 ],
                 checked=True,
+                sysexit=False,
                 stdin=wait_script,
                 private_key_file=args.ssh_private_key_file,
                 insecure=args.insecure,
@@ -764,35 +1750,142 @@ def main_wait_remote(parser, args):
 
 
 def main_wait(parser, args):
-    conn = libvirt.open('qemu:///system')
-    domain = conn.lookupByName(args.name)
-    state = domain.state(0)[0]
-    if state != libvirt.VIR_DOMAIN_RUNNING:
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    if not args.name and not args.all_created_by_uvtool:
+        parser.error("no domains given.")
+    if args.regex:
+        for selector in args.name:
+            try:
+                re.compile(selector)
+            except re.error as e:
+                parser.error("invalid --regex %s: %s" % (repr(selector), e))
+
+    # Must come before the connection is opened for events to be delivered
+    uvtool.libvirt.start_event_loop()
+    deadline = uvtool.wait.monotonic() + args.timeout
+    session = uvtool.libvirt.get_session()
+    names = select_domains(
+        args.name, regex=args.regex,
+        created_by_uvtool=args.all_created_by_uvtool, session=session,
+    )
+    lease_watcher = uvtool.watchd.lease_watcher(session=session)
+    with contextlib.closing(lease_watcher):
+        if len(names) == 1:
+            try:
+                main_wait_domain(
+                    parser, args, names[0], deadline, lease_watcher)
+            finally:
+                if args.timings:
+                    print_timings_report(names, session=session)
+            return
+
+        print_lock = threading.Lock()
+
+        def wait_and_report(name):
+            main_wait_domain(parser, args, name, deadline, lease_watcher)
+            if args.timings:
+                return
+            # Report each VM as soon as it is ready, not all at the end
+            with print_lock:
+                print(name)
+                sys.stdout.flush()
+
+        jobs = uvtool.parallel.run_all(wait_and_report, names, args.jobs)
+
+    if args.timings:
+        print_timings_report(names, session=session)
+    failures = 0
+    for name, job in zip(names, jobs):
+        if job.exception is None:
+            continue
+        failures += 1
+        print_vm_error(name, job.exception)
+    if failures:
+        raise CLIError(
+            "%d of %d VMs did not become ready." % (failures, len(names)))
+
+
+def main_wait_domain(parser, args, name, deadline, lease_watcher):
+    session = lease_watcher.session
+    domain = session.conn.lookupByName(name)
+    watcher = uvtool.watchd.domain_watcher(domain, session=session)
+    timings = uvtool.timing.Timings()
+    try:
+        with contextlib.closing(watcher):
+            wait_for_domain(
+                parser, args, name, deadline, lease_watcher, watcher,
+                timings)
+    finally:
+        # Also kept when the wait failed, to show where it got stuck
+        record_timings(domain, 'wait', timings)
+
+
+def wait_for_domain(parser, args, name, deadline, lease_watcher, watcher,
+        timings):
+    def remaining():
+        return max(0, deadline - uvtool.wait.monotonic())
+
+    def check_stopped():
+        if watcher.is_stopped():
+            raise CLIError(
+                "libvirt domain %s stopped while waiting." % repr(name))
+
+    with timings.phase('running'):
+        running = watcher.wait_until_running(remaining())
+    if not running:
         raise CLIError(
-            "libvirt domain %s is not running." % repr(args.name))
+            "libvirt domain %s is not running." % repr(name))
+
+    if uvtool.libvirt.has_ready_channel(watcher.domain):
+        try:
+            with timings.phase('ready-channel'):
+                ready = uvtool.wait.wait_for_ready_channel(
+                    watcher.domain, remaining(), cancel=watcher.is_stopped,
+                    session=lease_watcher.session,
+                )
+        except libvirt.libvirtError:
+            # Fall back to waiting over the network
+            pass
+        else:
+            if not ready:
+                check_stopped()
+                raise CLIError(
+                    "timed out waiting for %s to finish booting." %
+                    repr(name)
+                )
+            return
 
-    macs = list(uvtool.libvirt.get_domain_macs(args.name))
+    macs = list(uvtool.libvirt.get_domain_macs(
+        name, session=lease_watcher.session))
     if not macs:
         raise CLIError(
-            "libvirt domain %s has no NIC MACs available." % repr(args.name))
+            "libvirt domain %s has no NIC MACs available." % repr(name))
     if len(macs) > 1:
         raise CLIError(
             "libvirt domain %s has more than one NIC defined."
-                % repr(args.name)
+                % repr(name)
         )
     mac = macs[0]
     if mac['type'] == 'network':
-        if not uvtool.wait.wait_for_libvirt_dnsmasq_lease(
-                mac['address'], args.timeout):
+        with timings.phase('lease'):
+            host_ip = lease_watcher.wait(
+                mac['address'], remaining(), cancel=watcher.is_stopped)
+        if host_ip is None:
+            check_stopped()
             raise CLIError(
                 "timed out waiting for dnsmasq lease for %s." % mac['address'])
-        host_ip = uvtool.libvirt.mac_to_ip(mac['address'])
-        if not uvtool.wait.wait_for_open_ssh_port(
-                host_ip, args.interval, args.timeout):
+        with timings.phase('ssh-port'):
+            ssh_open = uvtool.wait.wait_for_open_ssh_port(
+                host_ip, args.interval, remaining(),
+                cancel=watcher.is_stopped)
+        if not ssh_open:
+            check_stopped()
             raise CLIError(
                 "timed out waiting for ssh to open on %s." % host_ip)
         if not args.without_ssh:
-            main_wait_remote(parser, args)
+            with timings.phase('remote-wait'):
+                main_wait_remote(parser, args, name, timeout=remaining())
 
 
 class DeveloperOptionAction(argparse.Action):
@@ -807,6 +1900,9 @@ def main(args):
     libvirt.registerErrorHandler(lambda _: None, None)
 
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--connect', '-c', default=uvtool.libvirt.DEFAULT_LIBVIRT_URI,
+        help='libvirt connection URI', metavar='URI')
     subparsers = parser.add_subparsers()
     create_subparser = subparsers.add_parser('create')
     create_subparser.set_defaults(func=main_create)
@@ -821,6 +1917,11 @@ def main(args):
     create_subparser.add_argument(
         '--ephemeral-disk', action='append', type=int, dest='ephemeral_disks',
         help='Add an empty disk of SIZE in GB', metavar='SIZE')
+    create_subparser.add_argument(
+        '--preallocation', choices=PREALLOCATION_MODES, default='off')
+    create_subparser.add_argument(
+        '--cluster-size', type=int, metavar='KIB',
+        help='qcow2 cluster size in KiB')
     create_subparser.add_argument('--bridge')
     create_subparser.add_argument('--unsafe-caching', action='store_true')
     create_subparser.add_argument('--disk-cache')
@@ -836,18 +1937,72 @@ def main(args):
     create_subparser.add_argument('--backing-image-file')
     create_subparser.add_argument('--run-script-once', action='append')
     create_subparser.add_argument('--ssh-public-key-file')
+    create_subparser.add_argument(
+        '--ssh-host-key-types', default=','.join(uvtool.ssh.KEY_TYPES))
+    create_subparser.add_argument(
+        '--ssh-host-key-pool-size', type=int,
+        default=uvtool.ssh.HOST_KEY_POOL_SIZE)
+    create_subparser.add_argument(
+        '--seed-mode', choices=['volume', 'smbios'], default='volume')
+    create_subparser.add_argument('--seed-url', metavar='URL')
     create_subparser.add_argument('--packages', action='append')
     create_subparser.add_argument('--no-start', action='store_true', default=False)
-    create_subparser.add_argument('hostname')
     create_subparser.add_argument(
-        'filters', nargs='*', metavar='filter',
-        default=["release=%s" % get_lts_series()],
+        '--timings', choices=['json'],
+        help='print how long each phase of creating the VMs took')
+    create_subparser.add_argument(
+        '--no-ready-channel', action='store_false', dest='ready_channel',
+        help='do not add the channel that tells wait when boot finishes')
+    create_subparser.add_argument('--count', type=int)
+    create_subparser.add_argument('--name-pattern', metavar='PATTERN')
+    create_subparser.add_argument(
+        '--jobs', '-j', type=int, default=DEFAULT_CREATE_JOBS,
+        help='create at most JOBS VMs at a time')
+    create_subparser.add_argument('hostname', nargs='?')
+    create_subparser.add_argument(
+        'filters', nargs='*', metavar='filter')
+    apply_subparser = subparsers.add_parser('apply')
+    apply_subparser.set_defaults(
+        func=main_apply, user_data=None, meta_data=None, password=None,
+        run_script_once=None, ready_channel=True,
+        ssh_host_key_pool_size=uvtool.ssh.HOST_KEY_POOL_SIZE,
     )
+    apply_subparser.add_argument(
+        '--jobs', '-j', type=int, default=DEFAULT_CREATE_JOBS)
+    apply_subparser.add_argument('--dry-run', action='store_true')
+    apply_subparser.add_argument('--template', default=None)
+    apply_subparser.add_argument('--image-pool', default=POOL_NAME)
+    apply_subparser.add_argument('--pool', default=POOL_NAME)
+    apply_subparser.add_argument('--ssh-public-key-file')
+    apply_subparser.add_argument('spec', type=argparse.FileType('rb'))
     destroy_subparser = subparsers.add_parser('destroy')
     destroy_subparser.set_defaults(func=main_destroy)
-    destroy_subparser.add_argument('hostname', nargs='+')
+    destroy_subparser.add_argument(
+        '--regex', action='store_true',
+        help='treat each name as a regular expression')
+    destroy_subparser.add_argument(
+        '--all-created-by-uvtool', action='store_true')
+    destroy_subparser.add_argument(
+        '--jobs', '-j', type=int, default=DEFAULT_DESTROY_JOBS)
+    destroy_subparser.add_argument(
+        '--discard', action='store_true',
+        help="discard volume data before deleting volumes")
+    destroy_subparser.add_argument('hostname', nargs='*')
+    watchd_subparser = subparsers.add_parser('watchd')
+    watchd_subparser.set_defaults(func=main_watchd)
+    watchd_subparser.add_argument('--socket', metavar='PATH')
+    seed_server_subparser = subparsers.add_parser('seed-server')
+    seed_server_subparser.set_defaults(func=main_seed_server)
+    seed_server_subparser.add_argument('--address')
+    seed_server_subparser.add_argument('--network', default='default')
+    seed_server_subparser.add_argument('--port', type=int)
     list_subparser = subparsers.add_parser('list')
     list_subparser.set_defaults(func=main_list)
+    list_subparser.add_argument(
+        '--format', choices=['names', 'table', 'json'], default='names')
+    list_subparser.add_argument(
+        '--all', action='store_true',
+        help='include libvirt domains not created by uvtool')
     ip_subparser = subparsers.add_parser('ip')
     ip_subparser.set_defaults(func=main_ip)
     ip_subparser.add_argument('name')
@@ -860,15 +2015,30 @@ def main(args):
     wait_subparser = subparsers.add_parser('wait')
     wait_subparser.set_defaults(func=main_wait)
     wait_subparser.add_argument('--timeout', type=float, default=120.0)
-    wait_subparser.add_argument('--interval', type=float, default=8.0)
+    wait_subparser.add_argument(
+        '--interval', type=float, default=1.0,
+        help='longest delay between attempts, in seconds')
     wait_subparser.add_argument('--remote-wait-script',
         default=DEFAULT_REMOTE_WAIT_SCRIPT)
     wait_subparser.add_argument('--insecure', action='store_true')
     wait_subparser.add_argument('--remote-wait-user', default='ubuntu')
     wait_subparser.add_argument('--without-ssh', action='store_true')
     wait_subparser.add_argument('--ssh-private-key-file')
-    wait_subparser.add_argument('name')
+    wait_subparser.add_argument(
+        '--regex', action='store_true',
+        help='treat the names as regular expressions')
+    wait_subparser.add_argument(
+        '--all-created-by-uvtool', action='store_true',
+        help='also wait for every VM created by uvtool')
+    wait_subparser.add_argument(
+        '--jobs', '-j', type=int, default=DEFAULT_WAIT_JOBS,
+        help='wait for at most this many VMs at a time')
+    wait_subparser.add_argument(
+        '--timings', choices=['json'],
+        help='print how long each phase of bringing up the VMs took')
+    wait_subparser.add_argument('name', nargs='*')
     args = parser.parse_args(args)
+    uvtool.libvirt.set_default_uri(args.connect)
     args.func(parser, args)
 
 
@@ -27,13 +27,20 @@ from __future__ import unicode_literals
 
 import argparse
 import base64
+import binascii
 import codecs
 import collections
+import contextlib
 import errno
+import hashlib
 import json
 import os
+import re
+import sqlite3
 import subprocess
 import sys
+import threading
+import urllib2
 
 import libvirt
 
@@ -41,11 +48,16 @@ import simplestreams.filters
 import simplestreams.mirrors
 import simplestreams.util
 
+import uvtool.download
 import uvtool.libvirt
+import uvtool.parallel
 
 LIBVIRT_POOL_NAME = 'uvtool'
-IMAGE_DIR = '/var/lib/uvtool/libvirt/images/' # must end in '/'; see use
 METADATA_DIR = '/var/lib/uvtool/libvirt/metadata'
+DOWNLOAD_DIR = '/var/lib/uvtool/libvirt/downloads'
+CATALOG_NAME = 'catalog.sqlite'
+METADATA_CACHE_NAME = 'cache.sqlite'
+METADATA_TIMEOUT = 60
 USEFUL_FIELD_NAMES = ['release', 'arch', 'label']
 
 
@@ -58,73 +70,403 @@ def mkdir_p(path):
             raise
 
 class MetadataItem():
-    def __init__(self, product, version, metadata_dir=METADATA_DIR):
+    def __init__(self, product, version, catalog):
         self.product = product
         self.version = version
-        self.metadata_dir = metadata_dir
-        self.path = self._metadata_path(_encode_libvirt_pool_name(
-            self.product, self.version))
-
-    def _metadata_path(self, name):
-        return os.path.join(self.metadata_dir, name)
-    
-    def set(self, metadata):
-        mkdir_p(self.metadata_dir)
-        with codecs.open(
-                self.path, 'wb',
-                encoding='utf-8') as f:
-            json.dump(metadata, f, indent=4)
-    
+        self.catalog = catalog
+
+    def set(self, metadata, volume=None):
+        self.catalog.set(self.product, self.version, metadata, volume=volume)
+
     def get(self):
-        with codecs.open(
-                self.path, 'rb',
-                encoding='utf-8') as f:
-            return json.load(f)
+        return self.catalog.load(self.product, self.version)
 
     def delete(self):
-        os.unlink(self.path)
-    
-    def exists(self):
-        return os.path.exists(self.path)
+        self.catalog.delete(self.product, self.version)
 
+    def exists(self):
+        return self.catalog.has(self.product, self.version)
+
+
+class _SqliteStore(object):
+    """A sqlite database in a directory shared by the libvirt group.
+
+    Subclasses provide SCHEMA, which is applied the first time the database
+    is opened, and may override _migrate to import older data at the same
+    time. A new database connection is used for each operation, so instances
+    may be shared between threads and processes.
+
+    """
+    SCHEMA = []
+
+    def __init__(self, directory, filename):
+        self.directory = directory
+        self.path = os.path.join(directory, filename)
+        self._initialised = False
+        # Deliberately do not create directory as a side-effect here, since
+        # instances are created when this module is loaded, and we want to be
+        # able to test this module without the side-effect of it affecting
+        # the system metadata directory.
+
+    def _migrate(self, db):
+        """Import older data into db and return paths to remove afterwards."""
+        return []
+
+    @contextlib.contextmanager
+    def _connect(self):
+        if not self._initialised:
+            mkdir_p(self.directory)
+        created = not os.path.exists(self.path)
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            with db:
+                if not self._initialised:
+                    for statement in self.SCHEMA:
+                        db.execute(statement)
+                    migrated_files = self._migrate(db)
+            if not self._initialised:
+                if created:
+                    # Other members of the libvirt group need to write too,
+                    # like they could the metadata directory itself.
+                    try:
+                        os.chmod(self.path, 0o664)
+                    except OSError:
+                        pass
+                for path in migrated_files:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                self._initialised = True
+            with db:
+                yield db
+        finally:
+            db.close()
+
+
+class Metadata(_SqliteStore):
+    """Catalog of the simplestreams metadata of every image in the pool.
+
+    The catalog is a single sqlite database inside metadata_dir, indexed by
+    the fields that filters commonly use, so that finding an image does not
+    need every entry to be read and parsed. Entries from older versions of
+    uvtool, which stored one JSON file per image in metadata_dir, are
+    imported the first time the catalog is opened.
+
+    Each entry records the pool volume holding its image. Entries with
+    identical content share a volume, which is only removed once no entry
+    refers to it; see clean_extraneous_images. Entries from before volumes
+    were recorded have none, and use the volume named after their product
+    and version.
+
+    """
+    # Flattened metadata fields that are indexed, and their columns
+    INDEXED_FIELDS = collections.OrderedDict([
+        ('product_name', 'product'),
+        ('version_name', 'version'),
+        ('release', 'release'),
+        ('arch', 'arch'),
+        ('label', 'label'),
+    ])
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS items (
+            product TEXT NOT NULL,
+            version TEXT NOT NULL,
+            release TEXT,
+            arch TEXT,
+            label TEXT,
+            metadata TEXT NOT NULL,
+            volume TEXT,
+            PRIMARY KEY (product, version)
+        )''',
+        'CREATE INDEX IF NOT EXISTS items_release ON items (release)',
+        'CREATE INDEX IF NOT EXISTS items_arch ON items (arch)',
+        'CREATE INDEX IF NOT EXISTS items_label ON items (label)',
+        'CREATE INDEX IF NOT EXISTS items_version ON items (version)',
+    ]
 
-class Metadata():
     def __init__(self, metadata_dir=METADATA_DIR):
+        super(Metadata, self).__init__(metadata_dir, CATALOG_NAME)
         self.metadata_dir = metadata_dir
-        # Deliberately do not create metadata_dir as a side-effect here, since
-        # this class is instantiated below when the module is loaded, and we
-        # want to be able to test this module without the side-effect of it
-        # affecting the system metadata directory.
-    
-    def _metadata_files(self):
-        return [str(metafile) for metafile in os.listdir(self.metadata_dir)
-            if os.path.isfile(os.path.join(self.metadata_dir, metafile))]
+
+    def _legacy_metadata_files(self):
+        return [
+            str(metafile) for metafile in os.listdir(self.metadata_dir)
+            if metafile.startswith((BASE64_PREFIX, PLAIN_PREFIX)) and
+            os.path.isfile(os.path.join(self.metadata_dir, metafile))
+        ]
+
+    def _migrate(self, db):
+        """Import metadata from older versions of uvtool.
+
+        Return the paths imported, which the caller should remove once the
+        import is committed.
+
+        """
+        columns = [row[1] for row in db.execute('PRAGMA table_info(items)')]
+        if 'volume' not in columns:
+            db.execute('ALTER TABLE items ADD COLUMN volume TEXT')
+        db.execute(
+            'CREATE INDEX IF NOT EXISTS items_volume ON items (volume)')
+
+        migrated = []
+        for metafile in self._legacy_metadata_files():
+            path = os.path.join(self.metadata_dir, metafile)
+            try:
+                with codecs.open(path, 'rb', encoding='utf-8') as f:
+                    metadata = json.load(f)
+            except (IOError, ValueError):
+                continue
+            product, version = _decode_libvirt_pool_name(metafile)
+            self._insert(db, product, version, metadata)
+            migrated.append(path)
+        return migrated
+
+    def _insert(self, db, product, version, metadata, volume=None):
+        db.execute(
+            '''INSERT OR REPLACE INTO items
+                (product, version, release, arch, label, metadata, volume)
+                VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            (
+                product, version,
+                metadata.get('release'), metadata.get('arch'),
+                metadata.get('label'), json.dumps(metadata), volume,
+            )
+        )
 
     def get(self, product, version):
-        return MetadataItem(product, version, self.metadata_dir)
-    
+        return MetadataItem(product, version, self)
+
+    def set(self, product, version, metadata, volume=None):
+        with self._connect() as db:
+            self._insert(db, product, version, metadata, volume)
+
+    def load(self, product, version):
+        with self._connect() as db:
+            row = db.execute(
+                'SELECT metadata FROM items WHERE product = ? AND version = ?',
+                (product, version)
+            ).fetchone()
+        if row is None:
+            raise KeyError((product, version))
+        return json.loads(row[0])
+
     def delete(self, product, version):
-        self.get(product, version).delete()
-    
+        with self._connect() as db:
+            db.execute(
+                'DELETE FROM items WHERE product = ? AND version = ?',
+                (product, version)
+            )
+
     def has(self, product, version):
-        return self.get(product, version).exists()
-    
+        with self._connect() as db:
+            return db.execute(
+                'SELECT 1 FROM items WHERE product = ? AND version = ?',
+                (product, version)
+            ).fetchone() is not None
+
     def contains(self, name):
+        if name.startswith(CONTENT_PREFIX):
+            return self.references(name) > 0
         product, version = _decode_libvirt_pool_name(name)
         return self.has(product, version)
 
+    def volume(self, product, version):
+        """Return the volume recorded for an entry, or None."""
+        with self._connect() as db:
+            row = db.execute(
+                'SELECT volume FROM items WHERE product = ? AND version = ?',
+                (product, version)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def volumes(self):
+        """Return (product, version, volume) tuples for every entry."""
+        with self._connect() as db:
+            return db.execute(
+                'SELECT product, version, volume FROM items').fetchall()
+
+    def references(self, volume):
+        """Return the number of entries whose image is held in volume."""
+        with self._connect() as db:
+            return db.execute(
+                'SELECT COUNT(*) FROM items WHERE volume = ?', (volume,)
+            ).fetchone()[0]
+
+    def keys(self):
+        """Return (product, version) tuples for every entry."""
+        with self._connect() as db:
+            return db.execute('SELECT product, version FROM items').fetchall()
+
     def items(self):
-        return [self.get(*_decode_libvirt_pool_name(metafile)) for metafile in self._metadata_files()]
-    
+        with self._connect() as db:
+            return [
+                self.get(product, version) for product, version in
+                db.execute('SELECT product, version FROM items')
+            ]
+
+    def entries(self, **fields):
+        """Return (metadata, volume) of entries matching all fields exactly.
+
+        Only fields in INDEXED_FIELDS may be used. With no fields, all
+        entries are returned.
+
+        """
+        clauses = []
+        values = []
+        for field, value in fields.items():
+            clauses.append('%s = ?' % self.INDEXED_FIELDS[field])
+            values.append(value)
+        statement = 'SELECT metadata, volume FROM items'
+        if clauses:
+            statement += ' WHERE ' + ' AND '.join(clauses)
+        with self._connect() as db:
+            return [
+                (json.loads(metadata), volume)
+                for metadata, volume in db.execute(statement, values)
+            ]
+
+    def find(self, **fields):
+        """Return the metadata of entries matching all fields exactly."""
+        return [metadata for metadata, _ in self.entries(**fields)]
+
     def clear(self):
-        for metafile in self._metadata_files():
-            os.unlink(metafile)
+        with self._connect() as db:
+            db.execute('DELETE FROM items')
+
+
+class MetadataCache(_SqliteStore):
+    """Cache of simplestreams index and products files read from sources.
+
+    Responses are kept with their validators, so that an unchanged file is
+    revalidated with a conditional request rather than downloaded again.
+    The result of verifying a signed file is kept by content hash and
+    keyring, so that unchanged content is not verified again. The files
+    read by the last complete sync from each source are also recorded, so
+    that a sync can tell when there is nothing to do.
+
+    """
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            content TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS verified (
+            content_sha256 TEXT NOT NULL,
+            keyring TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            PRIMARY KEY (content_sha256, keyring)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS syncs (
+            source TEXT PRIMARY KEY,
+            stamp TEXT NOT NULL
+        )''',
+    ]
+
+    def __init__(self, metadata_dir=METADATA_DIR):
+        super(MetadataCache, self).__init__(metadata_dir, METADATA_CACHE_NAME)
+
+    def fetch(self, url):
+        """Return the content of url as text, revalidating any cached copy."""
+        with self._connect() as db:
+            cached = db.execute(
+                'SELECT etag, last_modified, content FROM responses '
+                'WHERE url = ?',
+                (url,)
+            ).fetchone()
+        request = urllib2.Request(url)
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                request.add_header('If-None-Match', etag)
+            if last_modified:
+                request.add_header('If-Modified-Since', last_modified)
+        try:
+            response = urllib2.urlopen(request, timeout=METADATA_TIMEOUT)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                return cached[2]
+            raise
+        try:
+            content = response.read().decode('utf-8')
+            etag = response.info().getheader('etag')
+            last_modified = response.info().getheader('last-modified')
+        finally:
+            response.close()
+        if etag or last_modified:
+            with self._connect() as db:
+                db.execute(
+                    '''INSERT OR REPLACE INTO responses
+                        (url, etag, last_modified, content)
+                        VALUES (?, ?, ?, ?)''',
+                    (url, etag, last_modified, content)
+                )
+        return content
+
+    def verified(self, content, keyring, verify):
+        """Return verify(), or its earlier result for the same content.
+
+        keyring must identify the keyring verify uses, including its
+        version; see _keyring_identity. If it is None, nothing is cached.
+
+        """
+        if keyring is None:
+            return verify()
+        content_sha256 = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        with self._connect() as db:
+            row = db.execute(
+                'SELECT payload FROM verified '
+                'WHERE content_sha256 = ? AND keyring = ?',
+                (content_sha256, keyring)
+            ).fetchone()
+        if row is not None:
+            return row[0]
+        payload = verify()
+        with self._connect() as db:
+            db.execute(
+                '''INSERT OR REPLACE INTO verified
+                    (content_sha256, keyring, payload) VALUES (?, ?, ?)''',
+                (content_sha256, keyring, payload)
+            )
+        return payload
+
+    def get_stamp(self, source):
+        with self._connect() as db:
+            row = db.execute(
+                'SELECT stamp FROM syncs WHERE source = ?', (source,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set_stamp(self, source, stamp):
+        with self._connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO syncs (source, stamp) VALUES (?, ?)',
+                (source, json.dumps(stamp))
+            )
+
+
+def _keyring_identity(keyring):
+    """Identify a keyring file and its current version, or return None."""
+    if keyring is None:
+        return None
+    try:
+        st = os.stat(keyring)
+    except OSError:
+        return None
+    return '%s:%d:%d' % (os.path.abspath(keyring), st.st_mtime, st.st_size)
 
 
 pool_metadata = Metadata(METADATA_DIR)
+metadata_cache = MetadataCache(METADATA_DIR)
 
 BASE64_PREFIX = 'x-uvt-b64-'
 PLAIN_PREFIX = 'x-uvt-plain-'
+CONTENT_PREFIX = 'x-uvt-sha256-'
 
 def _encode_libvirt_pool_name(product_name, version_name, encoding_type='b64'):
     if encoding_type == 'plain':
@@ -148,12 +490,29 @@ def _decode_libvirt_pool_name(encoded_pool_name):
     )
 
 
-def get_libvirt_pool_name(product_name, version_name, pool_name):
-    encoding_type = _libvirt_pool_name_encode_type(pool_name)
+def _content_volume_name(sha256):
+    """Return the name of the volume holding the image with sha256."""
+    return str(CONTENT_PREFIX + sha256.lower())
+
+
+def _entry_volume_name(product_name, version_name, volume, encoding_type):
+    """Return the volume holding a catalog entry, given its recorded volume."""
+    if volume:
+        return volume
+    return _encode_libvirt_pool_name(product_name, version_name, encoding_type)
+
+
+def get_libvirt_pool_name(product_name, version_name, pool_name,
+        session=None):
+    """Return the name of the pool volume holding an image in the catalog."""
+    volume = pool_metadata.volume(product_name, version_name)
+    if volume:
+        return volume
+    encoding_type = _libvirt_pool_name_encode_type(pool_name, session=session)
     return _encode_libvirt_pool_name(product_name, version_name, encoding_type)
 
 
-def purge_pool(conn=None, pool_name=LIBVIRT_POOL_NAME):
+def purge_pool(session=None, pool_name=LIBVIRT_POOL_NAME):
     '''Delete all volumes and metadata with prejudice.
 
     This removes images from the pool whether they are in use or not.
@@ -164,85 +523,244 @@ def purge_pool(conn=None, pool_name=LIBVIRT_POOL_NAME):
     pool_metadata.clear()
 
     # Remove actual volumes themselves
-    if conn is None:
-        conn = libvirt.open('qemu:///system')
-    pool = uvtool.libvirt.get_libvirt_pool_object(conn, pool_name)
-    for volume_name in pool.listVolumes():
-        volume = pool.storageVolLookupByName(volume_name)
-        volume.delete(0)
-
-
-def clean_extraneous_images(pool_name=LIBVIRT_POOL_NAME):
-    conn = libvirt.open('qemu:///system')
-    pool = uvtool.libvirt.get_libvirt_pool_object(conn, pool_name)
+    if session is None:
+        session = uvtool.libvirt.get_session()
+    for volume_name in uvtool.libvirt.volume_names_in_pool(
+            pool_name, session=session):
+        uvtool.libvirt.delete_volume_by_name(
+            volume_name, pool_name=pool_name, session=session)
+
+
+def clean_extraneous_images(pool_name=LIBVIRT_POOL_NAME, session=None,
+        index=None):
+    if session is None:
+        session = uvtool.libvirt.get_session()
     encoded_libvirt_pool_names = uvtool.libvirt.volume_names_in_pool(
-        pool_name)
+        pool_name, session=session)
     volume_names_in_use = frozenset(
         uvtool.libvirt.get_all_domain_volume_names(
-            filter_by_dir=IMAGE_DIR)
+            session=session, pool_name=pool_name, index=index)
+    )
+    encoding_type = _libvirt_pool_name_encode_type(pool_name, session=session)
+    # A volume is kept while any catalog entry refers to it
+    volume_names_with_metadata = frozenset(
+        _entry_volume_name(product_name, version_name, volume, encoding_type)
+        for product_name, version_name, volume in pool_metadata.volumes()
     )
     for encoded_libvirt_name in encoded_libvirt_pool_names:
         if (encoded_libvirt_name not in volume_names_in_use and
-                not pool_metadata.contains(encoded_libvirt_name)):
+                encoded_libvirt_name not in volume_names_with_metadata):
             uvtool.libvirt.delete_volume_by_name(
-                encoded_libvirt_name, pool_name=pool_name)
+                encoded_libvirt_name, pool_name=pool_name, session=session)
 
 
-def _load_products(path=None, content_id=None, clean=False, pool_name=LIBVIRT_POOL_NAME):
+def _load_products(path=None, content_id=None, clean=False,
+        pool_name=LIBVIRT_POOL_NAME, session=None):
     # If clean evaluates to True, then remove any metadata files for which
     # the corresponding volume is missing.
     def new_product():
         return {'versions': {}}
     products = collections.defaultdict(new_product)
-    for metadata_item in pool_metadata.items():
-        encoded_libvirt_name = get_libvirt_pool_name(
-            metadata_item.product, metadata_item.version, pool_name)
-        if not uvtool.libvirt.have_volume_by_name(
-                encoded_libvirt_name, pool_name=pool_name):
+    # Take one snapshot of the pool rather than looking up each volume
+    encoding_type = _libvirt_pool_name_encode_type(pool_name, session=session)
+    volume_names = frozenset(
+        uvtool.libvirt.volume_names_in_pool(pool_name, session=session))
+    for metadata, volume in pool_metadata.entries():
+        product_name = metadata['product_name']
+        version_name = metadata['version_name']
+        encoded_libvirt_name = _entry_volume_name(
+            product_name, version_name, volume, encoding_type)
+        if encoded_libvirt_name not in volume_names:
             if clean:
-                metadata_item.delete()
+                pool_metadata.delete(product_name, version_name)
             continue
-        metadata = metadata_item.get()
-        assert(metadata_item.product == metadata['product_name'])
-        assert(metadata_item.version == metadata['version_name'])
-        products[metadata_item.product]['versions'][metadata_item.version] = {
+        products[product_name]['versions'][version_name] = {
             'items': { 'disk1.img': metadata }
         }
     return {'content_id': content_id, 'products': products}
 
 
-class LibvirtQuery(simplestreams.mirrors.BasicMirrorWriter):
-    def __init__(self, filters):
-        super(LibvirtQuery, self).__init__()
-        self.filters = filters
-        self.result = []
-
-    def load_products(self, path=None, content_id=None):
-        return {'content_id': content_id, 'products': {}}
-
-    def filter_item(self, data, src, target, pedigree):
-        return simplestreams.filters.filter_item(
-            self.filters, data, src, pedigree)
-
-    def insert_item(self, data, src, target, pedigree, contentsource):
-        product_name, version_name, item_name = pedigree
-        self.result.append((product_name, version_name))
-
+# A filter that requires a field to have an exact value
+EQUALITY_FILTER_RE = re.compile(r'^(\w+)=(.*)$')
+
+
+def query(filter_args, pool_name=LIBVIRT_POOL_NAME, session=None):
+    """Return (product_name, version_name) of pool images matching filters.
+
+    Exact matches on indexed fields are looked up in the metadata catalog,
+    and all filters are then applied to the metadata of the candidates
+    found, so the result is the same as filtering every image.
+
+    """
+    filters = simplestreams.filters.get_filters(filter_args)
+    indexed_fields = {}
+    for filter_arg in filter_args:
+        match = EQUALITY_FILTER_RE.match(filter_arg)
+        if match and match.group(1) in Metadata.INDEXED_FIELDS:
+            field, value = match.groups()
+            if indexed_fields.setdefault(field, value) != value:
+                # Contradictory filters match nothing
+                return []
+
+    candidates = [
+        (metadata, volume)
+        for metadata, volume in pool_metadata.entries(**indexed_fields)
+        if all(f.matches(metadata) for f in filters)
+    ]
+    if not candidates:
+        return []
+
+    encoding_type = _libvirt_pool_name_encode_type(pool_name, session=session)
+    volume_names = frozenset(
+        uvtool.libvirt.volume_names_in_pool(pool_name, session=session))
+    result = []
+    for metadata, volume in candidates:
+        product_name = metadata['product_name']
+        version_name = metadata['version_name']
+        encoded_libvirt_name = _entry_volume_name(
+            product_name, version_name, volume, encoding_type)
+        if encoded_libvirt_name in volume_names:
+            result.append((product_name, version_name))
+    return result
+
+
+def _contentsource_url(contentsource):
+    """Return the URL behind a simplestreams content source, if any.
+
+    Depending on the version of simplestreams, the source may be wrapped in
+    a checksumming content source.
+
+    """
+    while contentsource is not None:
+        url = getattr(contentsource, 'url', None)
+        if url:
+            return url
+        contentsource = getattr(contentsource, 'cs', None)
+    return None
+
+
+class CachingUrlMirrorReader(simplestreams.mirrors.UrlMirrorReader):
+    """A UrlMirrorReader that revalidates metadata files through the cache.
+
+    Each file is read at most once per instance. self.fetched lists the path
+    and content hash of every file read, in the order first read.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super(CachingUrlMirrorReader, self).__init__(*args, **kwargs)
+        self._read = {}
+        self.fetched = []
+
+    def read_json(self, path):
+        if path not in self._read:
+            url = _contentsource_url(self.source(path))
+            if url and uvtool.download.supports(url):
+                raw = metadata_cache.fetch(url)
+                payload = self.policy(content=raw, path=path)
+            else:
+                raw, payload = super(CachingUrlMirrorReader, self).read_json(
+                    path)
+            self._read[path] = (raw, payload)
+            self.fetched.append(
+                [path, hashlib.sha256(raw.encode('utf-8')).hexdigest()])
+        return self._read[path]
+
+
+def _sync_stamp(reader):
+    """Describe the source files read and the resulting local catalog."""
+    return {
+        'fetched': reader.fetched,
+        'catalog': sorted(list(key) for key in pool_metadata.keys()),
+    }
+
+
+def _unchanged_since_last_sync(reader, source, pool_name, session=None):
+    """Return True if a sync from source would find nothing to do.
+
+    This is the case if the source files read by the last complete sync
+    from source are unchanged, and the local catalog and pool still match
+    what that sync left behind.
+
+    """
+    stamp = metadata_cache.get_stamp(source)
+    if stamp is None:
+        return False
+    for path, content_sha256 in stamp['fetched']:
+        raw, _ = reader.read_json(path)
+        if hashlib.sha256(raw.encode('utf-8')).hexdigest() != content_sha256:
+            return False
+    if _sync_stamp(reader)['catalog'] != stamp['catalog']:
+        return False
+    encoding_type = _libvirt_pool_name_encode_type(pool_name, session=session)
+    volume_names = frozenset(
+        uvtool.libvirt.volume_names_in_pool(pool_name, session=session))
+    return all(
+        _entry_volume_name(product_name, version_name, volume, encoding_type)
+        in volume_names
+        for product_name, version_name, volume in pool_metadata.volumes()
+    )
 
-def query(filter_args, pool_name=LIBVIRT_POOL_NAME):
-    query = LibvirtQuery(simplestreams.filters.get_filters(filter_args))
-    query.sync_products(None, src=_load_products(pool_name=pool_name))
-    return query.result
 
 class LibvirtMirror(simplestreams.mirrors.BasicMirrorWriter):
-    def __init__(self, filters, verbose=False, pool_name=LIBVIRT_POOL_NAME):
+    def __init__(self, filters, verbose=False, pool_name=LIBVIRT_POOL_NAME,
+            session=None, jobs=1, download_dir=DOWNLOAD_DIR,
+            download_connections=uvtool.download.DEFAULT_CONNECTIONS):
         super(LibvirtMirror, self).__init__({'max_items': 1})
         self.filters = filters
         self.verbose = verbose
         self.pool_name = pool_name
+        if session is None:
+            session = uvtool.libvirt.get_session()
+        self.session = session
+        self.jobs = jobs
+        self.download_dir = download_dir
+        self.download_connections = download_connections
+        # Only used when jobs > 1; see sync().
+        self._reader = None
+        self._workers = None
+        self._inserts = []
+        self._removals = []
+        self.failures = []
+        self._volume_locks = {}
+        self._volume_locks_lock = threading.Lock()
+
+    def sync(self, reader, path):
+        """Sync from reader, fetching up to self.jobs images concurrently.
+
+        In concurrent mode, items are queued as simplestreams visits them and
+        removals of superseded versions are held back until every queued item
+        has finished. A failed item does not stop the others: it is recorded
+        in self.failures, and the versions it was meant to supersede are kept.
+
+        """
+        if self.jobs <= 1:
+            return super(LibvirtMirror, self).sync(reader, path)
+
+        self._reader = reader
+        self._inserts = []
+        self._removals = []
+        self.failures = []
+        with uvtool.parallel.WorkerPool(self.jobs) as workers:
+            self._workers = workers
+            try:
+                result = super(LibvirtMirror, self).sync(reader, path)
+            finally:
+                self._workers = None
+
+        failed_products = set()
+        for pedigree, job in self._inserts:
+            if job.exception is not None:
+                self.failures.append((pedigree, job.exception))
+                failed_products.add(pedigree[0])
+        for pedigree in self._removals:
+            if pedigree[0] not in failed_products:
+                self._remove_version(pedigree)
+        return result
 
     def load_products(self, path=None, content_id=None):
-        return _load_products(path=path, content_id=content_id, clean=True, pool_name=self.pool_name)
+        return _load_products(
+            path=path, content_id=content_id, clean=True,
+            pool_name=self.pool_name, session=self.session)
 
     def filter_index_entry(self, data, src, pedigree):
         return data['datatype'] == 'image-downloads'
@@ -256,27 +774,110 @@ class LibvirtMirror(simplestreams.mirrors.BasicMirrorWriter):
         assert(item_name == 'disk1.img')
         if self.verbose:
             print("Adding: %s %s" % (product_name, version_name))
-        encoded_libvirt_name = get_libvirt_pool_name(
-            product_name, version_name, self.pool_name)
-        if not uvtool.libvirt.have_volume_by_name(
-                encoded_libvirt_name, pool_name=self.pool_name):
-            uvtool.libvirt.create_volume_from_fobj(
-                encoded_libvirt_name, contentsource, image_type='qcow2',
-                pool_name=self.pool_name
+        # simplestreams owns contentsource and may close it as soon as we
+        # return, so a queued item opens its own source when it starts.
+        exdata = simplestreams.util.products_exdata(src, pedigree)
+        if self._workers is None:
+            self._insert_item(data, exdata, pedigree, contentsource)
+        else:
+            job = self._workers.submit(
+                self._insert_queued_item, data, exdata, pedigree)
+            self._inserts.append((pedigree, job))
+
+    def _insert_queued_item(self, data, exdata, pedigree):
+        contentsource = self._reader.source(data['path'])
+        try:
+            self._insert_item(data, exdata, pedigree, contentsource)
+        finally:
+            contentsource.close()
+
+    def _volume_lock(self, volume_name):
+        with self._volume_locks_lock:
+            return self._volume_locks.setdefault(
+                volume_name, threading.Lock())
+
+    def _insert_item(self, data, exdata, pedigree, contentsource):
+        product_name, version_name, item_name = pedigree
+        sha256 = data.get('sha256')
+        if sha256:
+            # Identical images published under several names share a volume
+            volume_name = _content_volume_name(sha256)
+        else:
+            volume_name = _encode_libvirt_pool_name(
+                product_name, version_name,
+                _libvirt_pool_name_encode_type(
+                    self.pool_name, session=self.session)
             )
+        # Concurrent items with the same content must not both upload it
+        with self._volume_lock(volume_name):
+            if uvtool.libvirt.have_volume_by_name(
+                    volume_name, pool_name=self.pool_name,
+                    session=self.session):
+                if self.verbose:
+                    print(
+                        "Reusing identical image: %s %s" %
+                        (product_name, version_name)
+                    )
+            else:
+                url = _contentsource_url(contentsource)
+                if url and uvtool.download.supports(url):
+                    self._create_volume_from_url(volume_name, url, data)
+                else:
+                    uvtool.libvirt.create_volume_from_fobj(
+                        volume_name, contentsource, image_type='qcow2',
+                        pool_name=self.pool_name,
+                        expected_sha256=sha256,
+                        session=self.session,
+                    )
+        # Only record the image once its volume is complete, so that an
+        # interrupted or failed upload never leaves metadata behind.
         pool_metadata.get(product_name, version_name).set(
-            simplestreams.util.products_exdata(src, pedigree)
+            exdata, volume=volume_name)
+
+    def _create_volume_from_url(self, new_volume_name, url, data):
+        """Download url resumably, then create a volume from the result.
+
+        The partial download is kept in self.download_dir if anything
+        fails, so that the next sync resumes it instead of starting again.
+
+        """
+        sha256 = data.get('sha256')
+        if sha256:
+            download_name = sha256
+        else:
+            download_name = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        mkdir_p(self.download_dir)
+        download = uvtool.download.Download(
+            url, os.path.join(self.download_dir, download_name),
+            size=int(data['size']) if 'size' in data else None,
+            sha256=sha256,
+            connections=self.download_connections,
         )
+        path = download.fetch()
+        with open(path, 'rb') as f:
+            # Already verified by the download
+            uvtool.libvirt.create_volume_from_fobj(
+                new_volume_name, f, image_type='qcow2',
+                pool_name=self.pool_name, session=self.session,
+            )
+        download.discard()
 
     def remove_version(self, data, src, target, pedigree):
+        if self._workers is None:
+            self._remove_version(pedigree)
+        else:
+            self._removals.append(pedigree)
+
+    def _remove_version(self, pedigree):
         product_name, version_name = pedigree
         if self.verbose:
             print("Removing: %s %s" % (product_name, version_name))
         pool_metadata.get(product_name, version_name).delete()
 
 
-def _libvirt_pool_name_encode_type(pool_name):
-    return 'b64' if uvtool.libvirt.pool_type(pool_name) == 'dir' else 'plain'
+def _libvirt_pool_name_encode_type(pool_name, session=None):
+    pool_type = uvtool.libvirt.pool_type(pool_name, session=session)
+    return 'b64' if pool_type == 'dir' else 'plain'
 
 def main_sync(args):
     (mirror_url, initial_path) = simplestreams.util.path_from_mirror_url(
@@ -284,20 +885,43 @@ def main_sync(args):
 
     def policy(content, path):
         if initial_path.endswith('sjson') and not args.no_authentication:
-            return simplestreams.util.read_signed(
-                content, keyring=args.keyring)
+            return metadata_cache.verified(
+                content, _keyring_identity(args.keyring),
+                lambda: simplestreams.util.read_signed(
+                    content, keyring=args.keyring)
+            )
         else:
             return content
 
-    smirror = simplestreams.mirrors.UrlMirrorReader(
-        mirror_url, policy=policy)
+    smirror = CachingUrlMirrorReader(mirror_url, policy=policy)
 
     filter_list = simplestreams.filters.get_filters(
         ['datatype=image-downloads', 'ftype=disk1.img'] + args.filters
     )
-    tmirror = LibvirtMirror(filter_list, verbose=args.verbose, pool_name=args.pool)
+    session = uvtool.libvirt.get_session()
+    source = json.dumps([mirror_url, initial_path, args.pool, args.filters])
+    if _unchanged_since_last_sync(smirror, source, args.pool, session=session):
+        # Nothing was added or removed, so there is nothing new to clean up
+        # either; leave that to the next sync that changes something rather
+        # than look at every volume in the pool
+        if args.verbose:
+            print("Source unchanged since last sync")
+        return
+    tmirror = LibvirtMirror(
+        filter_list, verbose=args.verbose, pool_name=args.pool,
+        session=session, jobs=args.jobs,
+        download_connections=args.download_connections)
     tmirror.sync(smirror, initial_path)
-    clean_extraneous_images(pool_name=args.pool)
+    failures = tmirror.failures
+    clean_extraneous_images(pool_name=args.pool, session=session)
+    if failures:
+        for (product_name, version_name, item_name), e in failures:
+            print(
+                "Failed: %s %s: %s" % (product_name, version_name, e),
+                file=sys.stderr
+            )
+        sys.exit(1)
+    metadata_cache.set_stamp(source, _sync_stamp(smirror))
 
 
 def metadata_to_useful_description_string(product, version):
@@ -306,6 +930,30 @@ def metadata_to_useful_description_string(product, version):
     return ' '.join([filters, '(%s)' % volume_metadata['version_name']])
 
 
+def volume_descriptions(volume_names):
+    """Return a useful description of the image in each of volume_names.
+
+    Volumes that do not hold a catalog image are left out.
+
+    """
+    volume_names = set(volume_names)
+    entries = {}
+    for product, version, volume in pool_metadata.volumes():
+        if volume in volume_names:
+            entries.setdefault(volume, (product, version))
+    for volume_name in volume_names - set(entries):
+        try:
+            product, version = _decode_libvirt_pool_name(volume_name)
+        except (TypeError, ValueError, binascii.Error):
+            continue
+        if pool_metadata.has(product, version):
+            entries[volume_name] = (product, version)
+    return dict(
+        (volume_name, metadata_to_useful_description_string(*entry))
+        for volume_name, entry in entries.items()
+    )
+
+
 def main_query(args):
     result = query(args.filters, pool_name=args.pool)
     useful_result = sorted(metadata_to_useful_description_string(*r) for r in result)
@@ -315,7 +963,55 @@ def main_query(args):
         print(*useful_result, sep="\n")
 
 
+def image_users(filter_args, pool_name=LIBVIRT_POOL_NAME, session=None,
+        index=None):
+    """Return the domains that need each pool image matching filter_args.
+
+    The result is a list of ((product_name, version_name), domain_names)
+    tuples. Domains count if they use the image through any backing chain.
+
+    """
+    if index is None:
+        index = uvtool.libvirt.VolumeDependencyIndex(session=session)
+    return [
+        (
+            (product_name, version_name),
+            index.users_of_volume(
+                get_libvirt_pool_name(
+                    product_name, version_name, pool_name, session=session),
+                pool_name
+            )
+        )
+        for product_name, version_name in query(
+            filter_args, pool_name=pool_name, session=session)
+    ]
+
+
+def main_users(args):
+    result = image_users(args.filters, pool_name=args.pool)
+    useful_result = sorted(
+        '%s: %s' % (
+            metadata_to_useful_description_string(*image),
+            ' '.join(sorted(domain_names))
+        )
+        for image, domain_names in result
+        if domain_names or args.all
+    )
+    if useful_result:
+        print(*useful_result, sep="\n")
+
+
 def main_purge(args):
+    index = uvtool.libvirt.VolumeDependencyIndex()
+    domain_names = set()
+    for info in index.volumes_in_use(pool_name=args.pool):
+        domain_names.update(index.users(info.path))
+    if domain_names:
+        print(
+            "Warning: purging images in use by: %s" %
+                ' '.join(sorted(domain_names)),
+            file=sys.stderr
+        )
     purge_pool(pool_name=args.pool)
 
 
@@ -328,6 +1024,9 @@ def main(argv=None):
         ['dpkg', '--print-architecture']).decode().strip()
     parser = argparse.ArgumentParser()
     parser.add_argument('--verbose', '-v', action='store_true')
+    parser.add_argument(
+        '--connect', '-c', default=uvtool.libvirt.DEFAULT_LIBVIRT_URI,
+        help='libvirt connection URI', metavar='URI')
     subparsers = parser.add_subparsers()
 
     sync_subparser = subparsers.add_parser('sync')
@@ -345,6 +1044,10 @@ def main(argv=None):
         default='https://cloud-images.ubuntu.com/releases/')
     sync_subparser.add_argument('--no-authentication', action='store_true')
     sync_subparser.add_argument('--pool', default=LIBVIRT_POOL_NAME)
+    sync_subparser.add_argument('--jobs', '-j', type=int, default=1)
+    sync_subparser.add_argument(
+        '--download-connections', type=int,
+        default=uvtool.download.DEFAULT_CONNECTIONS)
     sync_subparser.add_argument('filters', nargs='*', metavar='filter',
         default=["arch=%s" % system_arch])
 
@@ -354,11 +1057,21 @@ def main(argv=None):
     query_subparser.add_argument(
         'filters', nargs='*', default=[], metavar='filter')
 
+    users_subparser = subparsers.add_parser('users')
+    users_subparser.set_defaults(func=main_users)
+    users_subparser.add_argument('--pool', default=LIBVIRT_POOL_NAME)
+    users_subparser.add_argument(
+        '--all', action='store_true',
+        help='also list images that no domain uses')
+    users_subparser.add_argument(
+        'filters', nargs='*', default=[], metavar='filter')
+
     purge_subparser = subparsers.add_parser('purge')
     purge_subparser.set_defaults(func=main_purge)
     purge_subparser.add_argument('--pool', default=LIBVIRT_POOL_NAME)
 
     args = parser.parse_args(argv)
+    uvtool.libvirt.set_default_uri(args.connect)
     args.func(args)
 
 
@@ -0,0 +1,258 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A minimal bounded thread pool, task graphs and background processes.
+
+Python 2 has no concurrent.futures, and uvtool's concurrency needs are
+simple: run blocking libvirt, subprocess and network calls side by side,
+keep going when one of them fails, and find out afterwards what happened to
+each.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import os
+import Queue
+import subprocess
+import sys
+import threading
+
+import uvtool.timing
+
+
+class Job(object):
+    """The eventual outcome of a function submitted to a WorkerPool."""
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.exception = None
+        self._result = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self._result = self.fn(*self.args, **self.kwargs)
+        except BaseException as e:
+            # Including SystemExit, which would otherwise end the worker
+            # thread and leave the jobs queued behind it never run
+            self.exception = e
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish and return True if it has."""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def result(self):
+        """Wait for the job, then return its result or raise its exception."""
+        self.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self._result
+
+
+class WorkerPool(object):
+    """Run submitted functions on at most jobs threads at a time.
+
+    Use as a context manager: leaving the context waits for every submitted
+    job to finish, whether or not the block itself raised.
+
+    """
+
+    def __init__(self, jobs):
+        if jobs < 1:
+            raise ValueError("jobs must be at least 1")
+        self._queue = Queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._worker) for _ in range(jobs)
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def submit(self, fn, *args, **kwargs):
+        job = Job(fn, args, kwargs)
+        self._queue.put(job)
+        return job
+
+    def wait_for(self, jobs):
+        """Wait for jobs submitted to this pool, running queued ones here.
+
+        A job running on the pool can submit more jobs and wait for them
+        this way without holding up a thread that they need, however many
+        jobs do the same at once.
+
+        """
+        sentinels = 0
+        try:
+            while not all(job.done() for job in jobs):
+                try:
+                    job = self._queue.get_nowait()
+                except Queue.Empty:
+                    # The rest have been taken by other threads
+                    for job in jobs:
+                        job.wait()
+                    break
+                if job is None:
+                    # Jobs submitted after close() queue up behind these
+                    sentinels += 1
+                else:
+                    job.run()
+        finally:
+            for _ in range(sentinels):
+                self._queue.put(None)
+
+    def close(self):
+        """Wait for all submitted jobs to finish and stop the threads."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def run_all(fn, items, jobs):
+    """Call fn(item) for every item, at most jobs at a time.
+
+    Return the finished Job for each item, in the order of items. Failures
+    are recorded in each Job rather than raised.
+
+    """
+    with WorkerPool(jobs) as pool:
+        submitted = [pool.submit(fn, item) for item in items]
+    return submitted
+
+
+def start_job(fn, *args, **kwargs):
+    """Start calling fn in a background thread, and return its Job."""
+    job = Job(fn, args, kwargs)
+    thread = threading.Thread(target=job.run)
+    thread.daemon = True
+    thread.start()
+    return job
+
+
+class TaskGraph(object):
+    """Named tasks run concurrently, each as soon as those it requires are done.
+
+    Each task function is called with the results of the tasks it requires,
+    in the order they were given. Tasks can only require tasks added before
+    them, so the graph has no cycles.
+
+    """
+
+    def __init__(self):
+        self._tasks = collections.OrderedDict()
+
+    def add(self, name, fn, requires=()):
+        if name in self._tasks:
+            raise ValueError("Duplicate task %s" % name)
+        for required in requires:
+            if required not in self._tasks:
+                raise ValueError(
+                    "Task %s requires unknown task %s" % (name, required))
+        self._tasks[name] = (fn, tuple(requires))
+
+    def run(self, jobs=None, timings=None):
+        """Run every task and return a dict of their results by name.
+
+        Once a task fails, no further tasks are started. Those already
+        running are waited for, and then the first failure is raised. If
+        timings, a uvtool.timing.Timings, is given, each task is recorded
+        in it as a phase of the same name.
+
+        """
+        if jobs is None:
+            jobs = len(self._tasks)
+        pending = collections.OrderedDict(self._tasks)
+        running = {}
+        finished = Queue.Queue()
+        results = {}
+        failure = None
+
+        def run_task(name, fn, args):
+            try:
+                with uvtool.timing.phase(timings, name):
+                    return fn(*args)
+            finally:
+                finished.put(name)
+
+        with WorkerPool(max(1, jobs)) as pool:
+            while pending or running:
+                if failure is None:
+                    for name, (fn, requires) in list(pending.items()):
+                        if all(required in results for required in requires):
+                            del pending[name]
+                            args = [results[required] for required in requires]
+                            running[name] = pool.submit(
+                                run_task, name, fn, args)
+                if not running:
+                    break
+                name = finished.get()
+                job = running.pop(name)
+                job.wait()
+                if job.exception is not None:
+                    if failure is None:
+                        failure = job.exception
+                else:
+                    results[name] = job.result()
+        if failure is not None:
+            raise failure
+        return results
+
+
+def start_detached(module, args):
+    """Run "python -m module args" in the background, outliving this process.
+
+    The child gets its own session and no standard streams, and finds this
+    copy of uvtool wherever it is installed.
+
+    """
+    env = dict(os.environ)
+    package_parent = os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package_parent] +
+        [path for path in [env.get('PYTHONPATH')] if path]
+    )
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen(
+            [sys.executable, '-m', module] + list(args),
+            stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True,
+            preexec_fn=os.setsid, env=env,
+        )
@@ -0,0 +1,505 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Build cloud-init NoCloud seed images in memory.
+
+A NoCloud seed is a filesystem labelled "cidata" holding user-data and
+meta-data files at its root. This writes one as a minimal ISO 9660 image
+with a single root directory, the same layout "cloud-localds" produces
+through genisoimage, but without any temporary files or subprocesses.
+
+The primary volume descriptor carries file names as "USER-DATA;1", which
+Linux presents as "user-data", and a Joliet supplementary volume
+descriptor carries the exact names for readers that use it.
+
+Alternatively, a seed can be served over HTTP to cloud-init's "nocloud-net"
+datasource, so that no seed volume is needed at all. Seeds are stored in a
+per-user directory under an unguessable token, and a small seed server
+started on demand serves each as http://address:port/token/. Each user has
+their own port, and the server started on demand stops again once no seed
+is waiting to be fetched.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import BaseHTTPServer
+import errno
+import os
+import re
+import shutil
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import time
+import urllib2
+import urlparse
+import uuid
+
+import uvtool.parallel
+
+SECTOR_SIZE = 2048
+VOLUME_ID = 'cidata'
+
+SEED_SERVER_PORT = 8910
+# Each user's seed server listens on one of this many ports from
+# SEED_SERVER_PORT up; see default_seed_port
+SEED_SERVER_PORTS = 1009
+SEED_SERVER_START_TIMEOUT = 10
+SEED_FILES = ['meta-data', 'user-data', 'vendor-data']
+# A seed waits to be fetched until its user-data has been served, or for
+# this long after it was stored
+SEED_PENDING_TIMEOUT = 3600
+# A seed server started on demand stops once no seed has been waiting for
+# this long, so that guests can still fetch whatever they read after
+# user-data
+SEED_IDLE_TIMEOUT = 60
+SEED_IDLE_CHECK_INTERVAL = 10
+# Created in a seed's directory once its user-data has been served
+FETCHED_MARKER = '.fetched'
+TOKEN_RE = re.compile(r'^[0-9a-f]{32}$')
+
+# Sector numbers of the fixed part of the image
+_PRIMARY_DESCRIPTOR = 16
+_JOLIET_DESCRIPTOR = 17
+_TERMINATOR = 18
+_PRIMARY_PATH_TABLES = 19  # L then M
+_JOLIET_PATH_TABLES = 21  # L then M
+_PRIMARY_ROOT = 23
+_JOLIET_ROOT = 24
+_FIRST_FILE = 25
+
+
+def _both16(n):
+    return struct.pack('<H', n) + struct.pack('>H', n)
+
+
+def _both32(n):
+    return struct.pack('<I', n) + struct.pack('>I', n)
+
+
+def _pad(data, length, fill=b'\0'):
+    assert len(data) <= length
+    return (data + fill * length)[:length]
+
+
+def _sectors(length):
+    return (length + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+def _a_string(text, length):
+    return _pad(text.encode('ascii'), length, b' ')
+
+
+def _ucs2_string(text, length):
+    # Joliet text fields are UCS-2 big-endian, padded with spaces
+    return _pad(text.encode('utf-16-be'), length, b'\0 ')
+
+
+def _record_date(t):
+    return struct.pack(
+        'BBBBBBb', t.tm_year - 1900, t.tm_mon, t.tm_mday,
+        t.tm_hour, t.tm_min, t.tm_sec, 0)
+
+
+def _volume_date(t):
+    return time.strftime('%Y%m%d%H%M%S00', t).encode('ascii') + b'\0'
+
+
+def _directory_record(identifier, extent, length, t, is_directory=False):
+    record = (
+        b'\0' +  # extended attribute record length
+        _both32(extent) +
+        _both32(length) +
+        _record_date(t) +
+        struct.pack('B', 2 if is_directory else 0) +
+        b'\0\0' +  # not interleaved
+        _both16(1) +  # volume sequence number
+        struct.pack('B', len(identifier)) +
+        identifier
+    )
+    if len(record) % 2 == 0:
+        # Padding keeps the record, including its length byte, even
+        record += b'\0'
+    return struct.pack('B', len(record) + 1) + record
+
+
+def _path_tables(root_extent):
+    """Return the L and M path tables for a lone root directory."""
+    return (
+        b'\1\0' + struct.pack('<I', root_extent) + struct.pack('<H', 1) +
+        b'\0\0',
+        b'\1\0' + struct.pack('>I', root_extent) + struct.pack('>H', 1) +
+        b'\0\0',
+    )
+
+
+def _directory(entries, extent, t):
+    """Return a root directory sector listing (identifier, extent, length)."""
+    records = [
+        _directory_record(b'\0', extent, SECTOR_SIZE, t, is_directory=True),
+        _directory_record(b'\1', extent, SECTOR_SIZE, t, is_directory=True),
+    ] + [
+        _directory_record(identifier, file_extent, length, t)
+        for identifier, file_extent, length in entries
+    ]
+    data = b''.join(records)
+    if len(data) > SECTOR_SIZE:
+        raise ValueError("Too many files for a seed image")
+    return _pad(data, SECTOR_SIZE)
+
+
+def _volume_descriptor(descriptor_type, volume_id, text, size, root_extent,
+        path_table_sector, path_table_size, t, escape_sequences=b''):
+    root_record = _directory_record(
+        b'\0', root_extent, SECTOR_SIZE, t, is_directory=True)
+    descriptor = (
+        struct.pack('B', descriptor_type) + b'CD001\1\0' +
+        text('', 32) +  # system identifier
+        text(volume_id, 32) +
+        b'\0' * 8 +
+        _both32(size) +
+        _pad(escape_sequences, 32) +
+        _both16(1) +  # volume set size
+        _both16(1) +  # volume sequence number
+        _both16(SECTOR_SIZE) +
+        _both32(path_table_size) +
+        struct.pack('<I', path_table_sector) + b'\0' * 4 +
+        struct.pack('>I', path_table_sector + 1) + b'\0' * 4 +
+        root_record +
+        text('', 128) +  # volume set identifier
+        text('', 128) +  # publisher identifier
+        text('', 128) +  # data preparer identifier
+        text('UVTOOL', 128) +  # application identifier
+        text('', 37) * 3 +  # copyright, abstract and bibliographic files
+        _volume_date(t) * 2 +  # creation and modification
+        b'0' * 16 + b'\0' +  # no expiry
+        _volume_date(t) +  # effective
+        b'\1\0'  # file structure version
+    )
+    return _pad(descriptor, SECTOR_SIZE)
+
+
+def build_iso(files, volume_id=VOLUME_ID, timestamp=None):
+    """Return an ISO 9660 image holding files in its root directory.
+
+    files maps each file name to its content as bytes. Names should be
+    short, and use only lower case letters, digits, "-" and "_".
+
+    """
+    t = time.gmtime(timestamp)
+    names = sorted(files)
+
+    extent = _FIRST_FILE
+    primary_entries = []
+    joliet_entries = []
+    file_data = []
+    for name in names:
+        content = files[name]
+        primary_entries.append(
+            ((name.upper() + ';1').encode('ascii'), extent, len(content)))
+        joliet_entries.append(
+            (name.encode('utf-16-be'), extent, len(content)))
+        file_data.append(_pad(content, _sectors(len(content)) * SECTOR_SIZE))
+        extent += _sectors(len(content))
+    size = extent
+
+    primary_l, primary_m = _path_tables(_PRIMARY_ROOT)
+    joliet_l, joliet_m = _path_tables(_JOLIET_ROOT)
+    sectors = [
+        b'\0' * (SECTOR_SIZE * _PRIMARY_DESCRIPTOR),
+        _volume_descriptor(
+            1, volume_id, _a_string, size,
+            _PRIMARY_ROOT, _PRIMARY_PATH_TABLES, len(primary_l), t),
+        _volume_descriptor(
+            2, volume_id, _ucs2_string, size, _JOLIET_ROOT,
+            _JOLIET_PATH_TABLES, len(joliet_l), t,
+            escape_sequences=b'%/E'),  # UCS-2 level 3
+        _pad(b'\xffCD001\1', SECTOR_SIZE),
+        _pad(primary_l, SECTOR_SIZE),
+        _pad(primary_m, SECTOR_SIZE),
+        _pad(joliet_l, SECTOR_SIZE),
+        _pad(joliet_m, SECTOR_SIZE),
+        _directory(primary_entries, _PRIMARY_ROOT, t),
+        _directory(joliet_entries, _JOLIET_ROOT, t),
+    ] + file_data
+    return b''.join(sectors)
+
+
+def build_nocloud_seed(user_data, meta_data, timestamp=None):
+    """Return a NoCloud seed image for the given user-data and meta-data."""
+    return build_iso(
+        {'user-data': user_data, 'meta-data': meta_data},
+        timestamp=timestamp,
+    )
+
+
+def default_seed_dir():
+    data_home = os.environ.get(
+        'XDG_DATA_HOME', os.path.expanduser('~/.local/share'))
+    return os.path.join(data_home, 'uvtool', 'seeds')
+
+
+def store_seed(user_data, meta_data, seed_dir=None):
+    """Store a seed for serving over HTTP and return its token."""
+    if seed_dir is None:
+        seed_dir = default_seed_dir()
+    try:
+        os.makedirs(seed_dir, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    token = uuid.uuid4().hex
+    tmp_dir = os.path.join(seed_dir, '.tmp-%s' % token)
+    os.mkdir(tmp_dir, 0o700)
+    try:
+        for name, content in [
+                ('user-data', user_data), ('meta-data', meta_data)]:
+            with open(os.path.join(tmp_dir, name), 'wb') as f:
+                f.write(content)
+        os.rename(tmp_dir, os.path.join(seed_dir, token))
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return token
+
+
+def remove_seed(token, seed_dir=None):
+    if seed_dir is None:
+        seed_dir = default_seed_dir()
+    if TOKEN_RE.match(token):
+        shutil.rmtree(os.path.join(seed_dir, token), ignore_errors=True)
+
+
+def pending_seeds(seed_dir=None, now=None):
+    """Return the tokens of the seeds that are still waiting to be fetched."""
+    if seed_dir is None:
+        seed_dir = default_seed_dir()
+    if now is None:
+        now = time.time()
+    try:
+        names = os.listdir(seed_dir)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+    result = []
+    for name in names:
+        if not TOKEN_RE.match(name):
+            continue
+        token_dir = os.path.join(seed_dir, name)
+        try:
+            stored = os.stat(token_dir).st_mtime
+        except OSError:
+            continue
+        if (now - stored < SEED_PENDING_TIMEOUT and
+                not os.path.exists(os.path.join(token_dir, FETCHED_MARKER))):
+            result.append(name)
+    return result
+
+
+def default_seed_port(uid=None):
+    """Return the port that the seed server of uid listens on by default.
+
+    Seeds, and so seed servers, are per user, so each user gets their own
+    port. Users whose uids differ by a multiple of SEED_SERVER_PORTS share
+    one; ensure_seed_server refuses to use a port that another user's
+    server holds.
+
+    """
+    if uid is None:
+        uid = os.getuid()
+    return SEED_SERVER_PORT + uid % SEED_SERVER_PORTS
+
+
+class SeedRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path).path.strip('/').split('/')
+        if (len(parts) != 2 or not TOKEN_RE.match(parts[0]) or
+                parts[1] not in SEED_FILES):
+            self.send_error(404)
+            return
+        token_dir = os.path.join(self.server.seed_dir, parts[0])
+        try:
+            with open(os.path.join(token_dir, parts[1]), 'rb') as f:
+                content = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            if parts[1] != 'vendor-data' or not os.path.isdir(token_dir):
+                self.send_error(404)
+                return
+            content = b''
+        if parts[1] == 'user-data':
+            try:
+                open(os.path.join(token_dir, FETCHED_MARKER), 'ab').close()
+            except IOError:
+                # Removed meanwhile
+                pass
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, seed_dir):
+        self.seed_dir = seed_dir
+        BaseHTTPServer.HTTPServer.__init__(self, address, SeedRequestHandler)
+
+
+def _stop_when_idle(server, seed_dir):
+    idle_since = None
+    while True:
+        time.sleep(SEED_IDLE_CHECK_INTERVAL)
+        if pending_seeds(seed_dir):
+            idle_since = None
+        elif idle_since is None:
+            idle_since = time.time()
+        elif time.time() - idle_since >= SEED_IDLE_TIMEOUT:
+            server.shutdown()
+            idle_since = None
+
+
+def serve(address, port=None, seed_dir=None, stop_when_idle=False):
+    """Serve stored seeds on address and port.
+
+    Serve until interrupted or, with stop_when_idle, until no seed has been
+    waiting to be fetched for SEED_IDLE_TIMEOUT seconds.
+
+    """
+    if port is None:
+        port = default_seed_port()
+    if seed_dir is None:
+        seed_dir = default_seed_dir()
+    server = SeedServer((address, port), seed_dir)
+    try:
+        if not stop_when_idle:
+            server.serve_forever()
+            return
+        checker = threading.Thread(
+            target=_stop_when_idle, args=(server, seed_dir))
+        checker.daemon = True
+        checker.start()
+        while True:
+            server.serve_forever()
+            # Nothing is accepted now. A seed is stored before
+            # ensure_seed_server checks that it is served, so one whose
+            # check got through just before is seen here.
+            if not pending_seeds(seed_dir):
+                break
+    finally:
+        server.server_close()
+
+
+def _is_serving(url):
+    # Never go through a proxy to reach a local seed server
+    opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+    try:
+        opener.open(url, timeout=1).close()
+    except (urllib2.URLError, socket.error):
+        return False
+    return True
+
+
+def seed_url(base_url, token):
+    """Return the URL that cloud-init should read the seed token from."""
+    return '%s/%s/' % (base_url.rstrip('/'), token)
+
+
+def _port_is_free(address, port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        # As SeedServer does, so that connections in TIME_WAIT do not count
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((address, port))
+    except socket.error as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+        return False
+    finally:
+        s.close()
+    return True
+
+
+def ensure_seed_server(base_url, token, seed_dir=None,
+        timeout=SEED_SERVER_START_TIMEOUT):
+    """Make sure the seed token is being served under base_url.
+
+    If nothing serves it yet, start a seed server for this user in the
+    background, listening on the address and port of base_url, that stops
+    once no seed is waiting to be fetched. Fail if something else, such as
+    another user's seed server, holds the port.
+
+    """
+    if seed_dir is None:
+        seed_dir = default_seed_dir()
+    probe_url = seed_url(base_url, token) + 'meta-data'
+    parts = urlparse.urlsplit(base_url)
+    port = parts.port or 80
+    deadline = time.time() + timeout
+    started = False
+    while True:
+        if _is_serving(probe_url):
+            return
+        if not started and _port_is_free(parts.hostname, port):
+            uvtool.parallel.start_detached('uvtool.seed', [
+                'serve',
+                '--address', parts.hostname,
+                '--port', str(port),
+                '--seed-dir', seed_dir,
+                '--stop-when-idle',
+            ])
+            started = True
+        if time.time() >= deadline:
+            break
+        # Our own server may also be stopping just now; give it time
+        time.sleep(0.1)
+    if started:
+        raise RuntimeError("Seed server for %s did not start." % base_url)
+    raise RuntimeError(
+        "Port %d on %s is used by something other than this user's seed "
+        "server; choose another with --seed-url." % (port, parts.hostname)
+    )
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+    serve_subparser = subparsers.add_parser('serve')
+    serve_subparser.set_defaults(func=serve)
+    serve_subparser.add_argument('--address', required=True)
+    serve_subparser.add_argument('--port', type=int)
+    serve_subparser.add_argument('--seed-dir', default=default_seed_dir())
+    serve_subparser.add_argument('--stop-when-idle', action='store_true')
+    args = parser.parse_args(args)
+    args.func(args.address, args.port, args.seed_dir, args.stop_when_idle)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -16,12 +16,36 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+"""SSH host keys for new guests.
+
+Generating a full set of host keys takes a noticeable part of the time
+"uvt-kvm create" needs, so ready-made sets are kept in a pool directory
+private to the user, and the pool is refilled by a background process after
+each set is taken. A set is published into the pool and taken out of it
+with a single rename, so concurrent creates never share a set.
+
+"""
+
+from __future__ import print_function
+
 KEY_TYPES = ['rsa', 'dsa', 'ecdsa', 'ed25519']
+HOST_KEY_POOL_SIZE = 4
+
+# Leftovers of interrupted fills and takes older than this are removed
+STALE_AGE = 3600
 
+import argparse
+import errno
+import fcntl
 import os
 import shutil
 import subprocess
+import sys
 import tempfile
+import time
+import uuid
+
+import uvtool.parallel
 
 
 def _keygen(key_type, private_path):
@@ -40,30 +64,184 @@ def read_file(path):
         return f.read()
 
 
-def generate_ssh_host_keys():
+def _generate_key_set(key_types, directory):
+    """Generate one key of each type into directory, concurrently."""
+    jobs = uvtool.parallel.run_all(
+        lambda key_type: _keygen(key_type, os.path.join(directory, key_type)),
+        key_types, len(key_types)
+    )
+    for job in jobs:
+        job.result()
+
+
+def _read_key_set(key_types, directory):
     cloud_init_result = {}
     known_hosts_result = []
-    tmp_dir = tempfile.mkdtemp(prefix='uvt-kvm.sshtmp')
-    try:
-        for key_type in KEY_TYPES:
-            private_path = os.path.join(tmp_dir, key_type)
-            _keygen(key_type, private_path)
+    for key_type in key_types:
+        private_path = os.path.join(directory, key_type)
+
+        # ssh-keygen(1) defines that ".pub" is appended
+        public_path = private_path + ".pub"
 
-            # ssh-keygen(1) defines that ".pub" is appended
-            public_path = private_path + ".pub"
+        key_type_utf8 = key_type.encode('utf-8')
+        private_ci_key = key_type_utf8 + b'_private'
+        public_ci_key = key_type_utf8 + b'_public'
 
-            key_type_utf8 = key_type.encode('utf-8')
-            private_ci_key = key_type_utf8 + b'_private'
-            public_ci_key = key_type_utf8 + b'_public'
+        private_key = read_file(private_path)
+        public_key = read_file(public_path)
 
-            private_key = read_file(private_path)
-            public_key = read_file(public_path)
+        cloud_init_result[private_ci_key] = private_key
+        cloud_init_result[public_ci_key] = public_key
 
-            cloud_init_result[private_ci_key] = private_key
-            cloud_init_result[public_ci_key] = public_key
+        known_hosts_result.append(public_key)
 
-            known_hosts_result.append(public_key)
+    return cloud_init_result, b''.join(known_hosts_result)
+
+
+def generate_ssh_host_keys(key_types=KEY_TYPES):
+    tmp_dir = tempfile.mkdtemp(prefix='uvt-kvm.sshtmp')
+    try:
+        _generate_key_set(key_types, tmp_dir)
+        return _read_key_set(key_types, tmp_dir)
     finally:
         shutil.rmtree(tmp_dir)
 
-    return cloud_init_result, b''.join(known_hosts_result)
+
+def default_host_key_pool_dir():
+    cache_dir = (
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'))
+    return os.path.join(cache_dir, 'uvtool', 'ssh-host-keys')
+
+
+def _prepare_pool_dir(pool_dir):
+    try:
+        os.makedirs(pool_dir, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # The pool holds private keys
+    os.chmod(pool_dir, 0o700)
+
+
+def _pool_prefix(key_types):
+    return '-'.join(key_types) + '.'
+
+
+def _ready_key_sets(key_types, pool_dir):
+    prefix = _pool_prefix(key_types)
+    return sorted(
+        name for name in os.listdir(pool_dir) if name.startswith(prefix))
+
+
+def _remove_stale(pool_dir):
+    now = time.time()
+    for name in os.listdir(pool_dir):
+        if not name.startswith(('.tmp-', '.taken-')):
+            continue
+        path = os.path.join(pool_dir, name)
+        try:
+            if now - os.lstat(path).st_mtime > STALE_AGE:
+                shutil.rmtree(path)
+        except OSError:
+            pass
+
+
+def fill_host_key_pool(key_types=KEY_TYPES, pool_dir=None,
+        size=HOST_KEY_POOL_SIZE):
+    """Generate key sets until the pool holds size sets of key_types.
+
+    Only one fill runs in a pool at a time. If another is already running,
+    return at once and leave the work to it.
+
+    """
+    if pool_dir is None:
+        pool_dir = default_host_key_pool_dir()
+    _prepare_pool_dir(pool_dir)
+    with open(os.path.join(pool_dir, '.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in [errno.EACCES, errno.EAGAIN]:
+                return
+            raise
+        _remove_stale(pool_dir)
+        while len(_ready_key_sets(key_types, pool_dir)) < size:
+            tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=pool_dir)
+            try:
+                _generate_key_set(key_types, tmp_dir)
+            except:
+                shutil.rmtree(tmp_dir)
+                raise
+            os.rename(tmp_dir, os.path.join(
+                pool_dir, _pool_prefix(key_types) + uuid.uuid4().hex))
+
+
+def _start_background_fill(key_types, pool_dir, size):
+    uvtool.parallel.start_detached('uvtool.ssh', [
+        'fill',
+        '--pool-dir', pool_dir,
+        '--size', str(size),
+        '--key-types', ','.join(key_types),
+    ])
+
+
+def _take_key_set(key_types, pool_dir):
+    for name in _ready_key_sets(key_types, pool_dir):
+        taken_dir = os.path.join(pool_dir, '.taken-' + uuid.uuid4().hex)
+        try:
+            os.rename(os.path.join(pool_dir, name), taken_dir)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                # Someone else took this one first
+                continue
+            raise
+        try:
+            return _read_key_set(key_types, taken_dir)
+        finally:
+            shutil.rmtree(taken_dir)
+    return None
+
+
+def take_ssh_host_keys(key_types=KEY_TYPES, pool_dir=None,
+        pool_size=HOST_KEY_POOL_SIZE):
+    """Return a new set of host keys, as generate_ssh_host_keys does.
+
+    Take the set from the pool if one is ready, and start refilling the
+    pool in the background. If the pool is empty or unusable, generate the
+    set here. A pool_size of 0 disables the pool.
+
+    """
+    result = None
+    if pool_size > 0:
+        if pool_dir is None:
+            pool_dir = default_host_key_pool_dir()
+        try:
+            _prepare_pool_dir(pool_dir)
+            result = _take_key_set(key_types, pool_dir)
+            _start_background_fill(key_types, pool_dir, pool_size)
+        except (IOError, OSError) as e:
+            print(
+                "Warning: cannot use ssh host key pool %s: %s" %
+                (pool_dir, e),
+                file=sys.stderr
+            )
+    if result is None:
+        result = generate_ssh_host_keys(key_types)
+    return result
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+    fill_subparser = subparsers.add_parser('fill')
+    fill_subparser.add_argument('--pool-dir')
+    fill_subparser.add_argument(
+        '--size', type=int, default=HOST_KEY_POOL_SIZE)
+    fill_subparser.add_argument('--key-types', default=','.join(KEY_TYPES))
+    args = parser.parse_args(args)
+    fill_host_key_pool(
+        args.key_types.split(','), pool_dir=args.pool_dir, size=args.size)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
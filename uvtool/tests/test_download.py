@@ -0,0 +1,161 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import re
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+import mock
+
+import uvtool.download
+
+SEGMENT_SIZE = 1024
+PAYLOAD = os.urandom(10 * SEGMENT_SIZE + 123)
+PAYLOAD_SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+RANGE_RE = re.compile(r'^bytes=(\d+)-(\d+)$')
+
+
+class RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('Range'))
+        payload = self.server.payload
+        match = RANGE_RE.match(self.headers.get('Range', ''))
+        if match and self.server.ranges:
+            start, end = int(match.group(1)), int(match.group(2))
+            body = payload[start:end + 1]
+            self.send_response(206)
+            self.send_header(
+                'Content-Range',
+                'bytes %d-%d/%d' % (start, end, len(payload))
+            )
+        else:
+            body = payload
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        if match and int(match.group(1)) > 0 and self.server.cut_short:
+            # Hang up cleanly half way through a range other than the probe
+            self.server.cut_short -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = 1
+            return
+        self.wfile.write(body)
+
+
+class ThreadingHTTPServer(
+        SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), RangeRequestHandler)
+        self.server.payload = PAYLOAD
+        self.server.ranges = True
+        self.server.cut_short = 0
+        self.server.requests = []
+        thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/disk1.img' % self.server.server_port
+
+        self.tmpdir = tempfile.mkdtemp(prefix='uvtool-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'disk1.img')
+
+    def download(self, **kwargs):
+        kwargs.setdefault('size', len(PAYLOAD))
+        kwargs.setdefault('sha256', PAYLOAD_SHA256)
+        return uvtool.download.Download(
+            self.url, self.path, connections=3, segment_size=SEGMENT_SIZE,
+            **kwargs)
+
+    def read_result(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def testParallelRanges(self):
+        self.assertEqual(self.download().fetch(), self.path)
+        self.assertEqual(self.read_result(), PAYLOAD)
+        # One probe, then one request per segment
+        self.assertEqual(len(self.server.requests), 1 + 11)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.assertFalse(os.path.exists(self.path + '.state'))
+
+    def testResume(self):
+        # Pretend that an earlier run fetched the first four segments
+        with open(self.path + '.part', 'wb') as f:
+            f.write(PAYLOAD[:4 * SEGMENT_SIZE])
+            f.truncate(len(PAYLOAD))
+        with open(self.path + '.state', 'wb') as f:
+            json.dump({
+                'url': self.url,
+                'size': len(PAYLOAD),
+                'validator': '"v1"',
+                'segment_size': SEGMENT_SIZE,
+                'done': [0, 1, 2, 3],
+            }, f)
+        self.download().fetch()
+        self.assertEqual(self.read_result(), PAYLOAD)
+        self.assertEqual(len(self.server.requests), 1 + 7)
+        self.assertNotIn(
+            'bytes=0-%d' % (SEGMENT_SIZE - 1), self.server.requests)
+
+    @mock.patch('uvtool.download.RETRY_DELAY', 0)
+    def testRetryShortRange(self):
+        self.server.cut_short = 1
+        self.download().fetch()
+        self.assertEqual(self.read_result(), PAYLOAD)
+        # The range cut short is asked for again
+        self.assertEqual(len(self.server.requests), 1 + 11 + 1)
+
+    def testSequentialWithoutRangeSupport(self):
+        self.server.ranges = False
+        self.download().fetch()
+        self.assertEqual(self.read_result(), PAYLOAD)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def testChecksumMismatch(self):
+        download = self.download(sha256='0' * 64)
+        self.assertRaises(uvtool.download.DownloadError, download.fetch)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.assertFalse(os.path.exists(self.path + '.state'))
+
+    def testSizeMismatch(self):
+        download = self.download(size=len(PAYLOAD) + 1)
+        self.assertRaises(uvtool.download.DownloadError, download.fetch)
+
+    def testSupports(self):
+        self.assertTrue(uvtool.download.supports(self.url))
+        self.assertFalse(uvtool.download.supports('/srv/streams/disk1.img'))
@@ -14,11 +14,47 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import StringIO
+import argparse
+import io
+import os
+import sys
+import tempfile
+import threading
 import unittest
 
 import mock
+from lxml import etree
 
-from uvtool.libvirt.kvm import main_ssh
+import uvtool.libvirt
+import uvtool.libvirt.simplestreams
+import uvtool.parallel
+import uvtool.watchd
+
+from uvtool.libvirt.kvm import (
+    CLIError,
+    LIBVIRT_QEMU_RUN_DIR,
+    READY_NOTIFY_PATH,
+    _base_image_path,
+    _domain_uptime,
+    _local_qemu_run_dir,
+    apply_fleet,
+    compose_domain_xml,
+    create,
+    create_cow_volume_by_path,
+    create_default_user_data,
+    create_many,
+    create_new_volume,
+    delete_domain_volumes,
+    fleet_spec_hash,
+    list_domains,
+    load_fleet_spec,
+    macs_to_ips,
+    main_ssh,
+    main_wait,
+    plan_fleet,
+    select_domains,
+)
 
 
 class TestKVM(unittest.TestCase):
@@ -57,3 +93,532 @@ class TestKVM(unittest.TestCase):
         # In this obtuse case, the hostname has an '@' in it, so this should be
         # passed through.
         self.check_ssh('bar@foo', 'baz', 'bar@foo', 'baz')
+
+
+class TestDefaultUserData(unittest.TestCase):
+    def args(self):
+        args = mock.Mock()
+        args.hostname = 'foo'
+        args.password = None
+        args.run_script_once = None
+        args.packages = None
+        args.ready_channel = False
+        return args
+
+    @mock.patch('uvtool.libvirt.kvm.get_ssh_authorized_keys', return_value=[])
+    @mock.patch('uvtool.ssh.generate_ssh_host_keys')
+    def test_given_host_keys_are_not_generated_again(
+            self, generate_ssh_host_keys, get_ssh_authorized_keys):
+        fobj = mock.Mock()
+        create_default_user_data(
+            fobj, self.args(), ssh_host_keys={b'rsa_private': b'key'})
+        self.assertFalse(generate_ssh_host_keys.called)
+        self.assertIn(b'rsa_private: key', fobj.write.call_args[0][0])
+
+    @mock.patch('uvtool.libvirt.kvm.get_ssh_authorized_keys', return_value=[])
+    @mock.patch('uvtool.ssh.generate_ssh_host_keys')
+    def test_host_keys_generated_once_if_not_given(
+            self, generate_ssh_host_keys, get_ssh_authorized_keys):
+        generate_ssh_host_keys.return_value = ({b'rsa_private': b'key'}, b'')
+        create_default_user_data(mock.Mock(), self.args())
+        self.assertEqual(generate_ssh_host_keys.call_count, 1)
+
+    @mock.patch('uvtool.libvirt.kvm.get_ssh_authorized_keys', return_value=[])
+    def test_ready_channel_installs_notify_script(
+            self, get_ssh_authorized_keys):
+        args = self.args()
+        for ready_channel in [False, True]:
+            args.ready_channel = ready_channel
+            fobj = mock.Mock()
+            create_default_user_data(fobj, args, ssh_host_keys={})
+            user_data = ''.join(c[0][0] for c in fobj.write.call_args_list)
+            self.assertEqual(READY_NOTIFY_PATH in user_data, ready_channel)
+
+
+class TestComposeDomainXML(unittest.TestCase):
+    TEMPLATE = os.path.join(
+        os.path.dirname(__file__), os.pardir, os.pardir, 'template.xml')
+
+    def test_base_image_recorded(self):
+        volume = mock.Mock()
+        volume.path.return_value = '/pool/foo.qcow'
+        volume.XMLDesc.return_value = (
+            "<volume><target><format type='qcow2'/></target>"
+            "<backingStore><path>/pool/base</path></backingStore></volume>"
+        )
+        xml = etree.fromstring(
+            compose_domain_xml('foo', [volume], self.TEMPLATE))
+        self.assertEqual(_base_image_path(xml), '/pool/base')
+
+    def test_ready_channel(self):
+        for ready_channel in [False, True]:
+            xml = compose_domain_xml(
+                'foo', [], self.TEMPLATE, ready_channel=ready_channel)
+            self.assertEqual(
+                uvtool.libvirt.has_ready_channel(
+                    None, xml=etree.fromstring(xml)),
+                ready_channel
+            )
+
+
+@mock.patch('libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA', 1,
+    create=True)
+class TestVolumeCreation(unittest.TestCase):
+    def created(self, session):
+        xml, flags = session.pool.return_value.createXML.call_args[0]
+        return etree.fromstring(xml), flags
+
+    def test_new_volume_uses_given_pool(self):
+        session = mock.Mock()
+        create_new_volume('foo', 4, session=session, pool_name='bar')
+        session.pool.assert_called_once_with('bar')
+        volume, flags = self.created(session)
+        self.assertEqual(volume.findtext('capacity'), '4')
+        self.assertEqual(volume.findtext('allocation'), '0')
+        self.assertEqual(volume.find('target/format').get('type'), 'qcow2')
+        self.assertEqual(flags, 0)
+
+    def test_metadata_preallocation(self):
+        session = mock.Mock()
+        create_cow_volume_by_path(
+            '/backing', 'foo', 4, session=session,
+            preallocation='metadata', cluster_size=2048)
+        volume, flags = self.created(session)
+        self.assertEqual(volume.findtext('allocation'), '0')
+        self.assertEqual(volume.findtext('backingStore/path'), '/backing')
+        self.assertEqual(volume.findtext('target/clusterSize'), '2048')
+        self.assertEqual(flags, 1)
+
+    def test_falloc_preallocation(self):
+        session = mock.Mock()
+        create_new_volume('foo', 4, session=session, preallocation='falloc')
+        volume, flags = self.created(session)
+        self.assertEqual(volume.findtext('allocation'), '4')
+        self.assertEqual(flags, 1)
+
+
+class TestCreate(unittest.TestCase):
+    @mock.patch('uvtool.libvirt.kvm.compose_domain_xml')
+    @mock.patch('uvtool.libvirt.kvm.create_new_volume')
+    @mock.patch('uvtool.libvirt.kvm.create_ds_volume')
+    @mock.patch('uvtool.libvirt.kvm.create_cow_volume')
+    @mock.patch('uvtool.libvirt.kvm.get_base_image')
+    def test_volumes_are_removed_if_any_step_fails(self, get_base_image,
+            create_cow_volume, create_ds_volume, create_new_volume,
+            compose_domain_xml):
+        session = mock.Mock()
+        main_volume = mock.Mock()
+        main_volume_created = threading.Event()
+
+        def create_main_volume(*args, **kwargs):
+            main_volume_created.set()
+            return main_volume
+
+        def fail_after_main_volume(*args, **kwargs):
+            main_volume_created.wait(5)
+            raise RuntimeError
+
+        create_cow_volume.side_effect = create_main_volume
+        create_new_volume.side_effect = fail_after_main_volume
+        with self.assertRaises(RuntimeError):
+            create(
+                'foo', [], mock.Mock(), mock.Mock(), '/template',
+                ephemeral_disks=[1], session=session,
+                ssh_known_hosts=lambda: 'known hosts',
+            )
+        main_volume.delete.assert_called_once_with(0)
+        create_ds_volume.return_value.delete.assert_called_once_with(0)
+        self.assertFalse(session.conn.defineXML.called)
+
+    @mock.patch('uvtool.libvirt.record_domain_timings')
+    @mock.patch('uvtool.libvirt.kvm.compose_domain_xml')
+    @mock.patch('uvtool.libvirt.kvm.create_ds_volume')
+    @mock.patch('uvtool.libvirt.kvm.create_cow_volume')
+    @mock.patch('uvtool.libvirt.kvm.get_base_image')
+    def test_lazy_arguments_are_resolved(self, get_base_image,
+            create_cow_volume, create_ds_volume, compose_domain_xml,
+            record_domain_timings):
+        user_data = mock.Mock()
+        create(
+            'foo', [], lambda: user_data, mock.Mock(), '/template',
+            session=mock.Mock(), start=False,
+            ssh_known_hosts=lambda: 'known hosts',
+        )
+        self.assertIs(create_ds_volume.call_args[0][2], user_data)
+        self.assertEqual(
+            compose_domain_xml.call_args[1]['ssh_known_hosts'],
+            'known hosts'
+        )
+        self.assertEqual(
+            compose_domain_xml.call_args[1]['volumes'],
+            [create_cow_volume.return_value, create_ds_volume.return_value]
+        )
+
+    @mock.patch('uvtool.libvirt.record_domain_timings')
+    @mock.patch('uvtool.libvirt.kvm.compose_domain_xml')
+    @mock.patch('uvtool.libvirt.kvm.create_ds_volume')
+    @mock.patch('uvtool.libvirt.kvm.create_cow_volume')
+    @mock.patch('uvtool.libvirt.kvm.get_base_image')
+    def test_timings_are_recorded(self, get_base_image, create_cow_volume,
+            create_ds_volume, compose_domain_xml, record_domain_timings):
+        session = mock.Mock()
+        create(
+            'foo', [], mock.Mock(), mock.Mock(), '/template',
+            session=session, ssh_known_hosts='known hosts',
+        )
+        domain, operation, timings = record_domain_timings.call_args[0]
+        self.assertIs(domain, session.conn.defineXML.return_value)
+        self.assertEqual(operation, 'create')
+        self.assertEqual(
+            sorted(phase['name'] for phase in timings['phases']),
+            ['base-image', 'define', 'main-volume', 'seed',
+             'ssh-known-hosts', 'start']
+        )
+
+
+class TestCreateMany(unittest.TestCase):
+    @mock.patch('uvtool.libvirt.kvm.create')
+    @mock.patch('uvtool.libvirt.kvm.get_base_image', return_value='base')
+    def test_base_image_resolved_once_and_failures_isolated(
+            self, get_base_image, create):
+        def create_vm(hostname, *args, **kwargs):
+            if hostname == 'web-02':
+                raise RuntimeError(hostname)
+        create.side_effect = create_vm
+        instance_data = mock.Mock(return_value=(None, None, None))
+
+        jobs = create_many(
+            ['web-01', 'web-02', 'web-03'], ['release=trusty'],
+            instance_data, '/template', jobs=2, session=mock.Mock(),
+            memory=1024,
+        )
+
+        self.assertEqual(get_base_image.call_count, 1)
+        self.assertEqual(
+            [job.exception is None for job in jobs], [True, False, True])
+        self.assertEqual(
+            sorted(call[0][0] for call in instance_data.call_args_list),
+            ['web-01', 'web-02', 'web-03']
+        )
+        for call in create.call_args_list:
+            self.assertEqual(call[1]['base_image'], ('base', None))
+            self.assertEqual(call[1]['memory'], 1024)
+
+
+FLEET_SPEC = b"""
+name: web
+defaults:
+  memory: 1024
+  filters: [release=trusty, arch=amd64]
+vms:
+  - hostname: web-01
+  - hostname: web-02
+    cpu: 2
+    packages: nginx
+"""
+
+
+def fake_domain(name, fleet=None):
+    domain = mock.Mock()
+    domain.name.return_value = name
+    domain.fleet = fleet
+    return domain
+
+
+@mock.patch(
+    'uvtool.libvirt.get_domain_fleet', lambda domain: domain.fleet)
+class TestFleet(unittest.TestCase):
+    def specs(self):
+        return load_fleet_spec(io.BytesIO(FLEET_SPEC))[1]
+
+    def session(self, *domains):
+        session = mock.Mock()
+        session.conn.listAllDomains.return_value = list(domains)
+        return session
+
+    def test_load_applies_defaults(self):
+        name, specs = load_fleet_spec(io.BytesIO(FLEET_SPEC))
+        self.assertEqual(name, 'web')
+        self.assertEqual(list(specs), ['web-01', 'web-02'])
+        self.assertEqual(specs['web-01']['memory'], 1024)
+        self.assertEqual(specs['web-01']['cpu'], 1)
+        self.assertEqual(specs['web-02']['cpu'], 2)
+        self.assertEqual(specs['web-02']['packages'], ['nginx'])
+        self.assertEqual(
+            specs['web-02']['filters'], ['arch=amd64', 'release=trusty'])
+
+    def test_load_rejects_unknown_fields(self):
+        self.assertRaises(
+            CLIError, load_fleet_spec,
+            io.BytesIO(b"vms: [{hostname: a, colour: red}]"), 'x')
+
+    def test_plan(self):
+        specs = self.specs()
+        session = self.session(
+            fake_domain(
+                'web-01', ('web', fleet_spec_hash('web-01', specs['web-01']))),
+            fake_domain('web-02', ('web', 'old')),
+            fake_domain('web-03', ('web', 'old')),
+            fake_domain('db-01', ('db', 'old')),
+            fake_domain('other'),
+        )
+        self.assertEqual(
+            plan_fleet('web', specs, session=session), [
+                ('keep', 'web-01'),
+                ('replace', 'web-02'),
+                ('destroy', 'web-03'),
+            ]
+        )
+
+    def test_plan_refuses_unmanaged_domains(self):
+        session = self.session(fake_domain('web-01'))
+        self.assertRaises(
+            CLIError, plan_fleet, 'web', self.specs(), session=session)
+
+    @mock.patch('uvtool.libvirt.kvm.destroy')
+    @mock.patch('uvtool.libvirt.kvm.create')
+    @mock.patch('uvtool.libvirt.kvm.get_base_image', return_value='base')
+    def test_apply_only_touches_changes(self, get_base_image, create,
+            destroy):
+        specs = self.specs()
+        session = self.session(
+            fake_domain(
+                'web-01', ('web', fleet_spec_hash('web-01', specs['web-01']))),
+            fake_domain('web-03', ('web', 'old')),
+        )
+        instance_data = mock.Mock(return_value=(None, None, None))
+        steps = apply_fleet(
+            'web', specs, instance_data, '/template', ['release=trusty'],
+            session=session)
+        self.assertEqual(
+            [(action, hostname, job is None)
+                for action, hostname, job in steps],
+            [('keep', 'web-01', True), ('create', 'web-02', False),
+                ('destroy', 'web-03', False)]
+        )
+        destroy.assert_called_once_with('web-03', session=session)
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual(create.call_args[0][0], 'web-02')
+        self.assertEqual(create.call_args[1]['cpu'], 2)
+        self.assertEqual(
+            create.call_args[1]['fleet'],
+            ('web', fleet_spec_hash('web-02', specs['web-02']))
+        )
+
+
+class TestDestroy(unittest.TestCase):
+    @mock.patch(
+        'uvtool.libvirt.is_uvtool_domain', lambda domain: domain.fleet)
+    def test_select_domains(self):
+        session = mock.Mock()
+        session.conn.listAllDomains.return_value = [
+            fake_domain('web-01'),
+            fake_domain('web-02'),
+            fake_domain('db-01', True),
+            fake_domain('dbx'),
+        ]
+        self.assertEqual(
+            select_domains(['web-*', 'other'], session=session),
+            ['other', 'web-01', 'web-02']
+        )
+        self.assertEqual(
+            select_domains(['db-\\d+', 'web'], regex=True, session=session),
+            ['db-01']
+        )
+        self.assertEqual(
+            select_domains([], created_by_uvtool=True, session=session),
+            ['db-01']
+        )
+
+    @mock.patch('libvirt.VIR_STORAGE_VOL_WIPE_ALG_TRIM', 6, create=True)
+    def test_delete_domain_volumes_with_discard(self):
+        domain = mock.Mock()
+        domain.XMLDesc.return_value = (
+            "<domain><devices>"
+            "<disk><source file='/a'/></disk>"
+            "<disk><source file='/b'/></disk>"
+            "</devices></domain>"
+        )
+        volumes = {'/a': mock.Mock(), '/b': mock.Mock()}
+        for path, volume in volumes.items():
+            volume.name.return_value = path[1:]
+            volume.storagePoolLookupByVolume().name.return_value = 'uvtool'
+        for pool in [None, uvtool.parallel.WorkerPool(1)]:
+            session = uvtool.libvirt.Session()
+            session._conn = mock.Mock()
+            session._conn.storageVolLookupByKey.side_effect = volumes.get
+            for volume in volumes.values():
+                volume.reset_mock()
+            delete_domain_volumes(session, domain, discard=True, pool=pool)
+            if pool is not None:
+                pool.close()
+            for volume in volumes.values():
+                volume.wipePattern.assert_called_once_with(6, 0)
+                volume.delete.assert_called_once_with(flags=0)
+            # Deleted through the session, so it no longer has them
+            self.assertEqual(session._volumes, {})
+
+
+LIST_DOMAIN_XML = """
+<domain>
+  <name>%s</name>
+  <vcpu>2</vcpu>
+  <currentMemory>1048576</currentMemory>
+  <metadata>%s</metadata>
+  <devices>
+    <disk type='file' device='disk'>
+      <source file='/pool/%s.qcow'/>
+      <backingStore type='file'>
+        <source file='/pool/x-uvt-sha256-abc'/>
+      </backingStore>
+    </disk>
+    <interface type='network'><mac address='52:54:00:AA:00:01'/></interface>
+  </devices>
+</domain>
+"""
+
+
+class TestList(unittest.TestCase):
+    def domain(self, name, uvtool_created=True):
+        domain = mock.Mock()
+        domain.name.return_value = name
+        domain.XMLDesc.return_value = LIST_DOMAIN_XML % (
+            name,
+            '<uvt:ssh_known_hosts xmlns:uvt="%s"/>' %
+                uvtool.libvirt.LIBVIRT_METADATA_XMLNS
+                if uvtool_created else '',
+            name,
+        )
+        return domain
+
+    @mock.patch('uvtool.libvirt.simplestreams.volume_descriptions')
+    @mock.patch('uvtool.libvirt.kvm.macs_to_ips')
+    def test_details(self, macs_to_ips, volume_descriptions):
+        macs_to_ips.return_value = {'52:54:00:AA:00:01': '192.168.122.10'}
+        volume_descriptions.return_value = {
+            'x-uvt-sha256-abc': 'release=trusty arch=amd64'}
+        session = mock.Mock()
+        # Pid files on this host say nothing about a remote one
+        session.uri = 'qemu+ssh://elsewhere/system'
+        session.conn.getAllDomainStats.return_value = [
+            (self.domain('b'), {
+                'state.state': 1,
+                'block.0.capacity': 8 * 1024 ** 3,
+            }),
+            (self.domain('a'), {
+                'state.state': 5,
+                'vcpu.current': 4,
+                'balloon.current': 524288,
+            }),
+            (self.domain('other', uvtool_created=False), {}),
+        ]
+        vms = list_domains(session=session)
+        self.assertEqual(vms, [
+            {
+                'name': 'a', 'state': 'shut off',
+                'ips': ['192.168.122.10'], 'vcpus': 4, 'memory': 512,
+                'disk': None, 'uptime': None,
+                'base_image': 'release=trusty arch=amd64',
+            },
+            {
+                'name': 'b', 'state': 'running',
+                'ips': ['192.168.122.10'], 'vcpus': 2, 'memory': 1024,
+                'disk': 8.0, 'uptime': None,
+                'base_image': 'release=trusty arch=amd64',
+            },
+        ])
+        self.assertEqual(macs_to_ips.call_count, 1)
+        self.assertFalse(session.conn.storageVolLookupByKey.called)
+
+    def test_base_image_path(self):
+        def disk_xml(backing, metadata=''):
+            return etree.fromstring(
+                '<domain><metadata>%s</metadata><devices>'
+                '<disk device="disk"><source file="/pool/a.qcow"/>%s</disk>'
+                '</devices></domain>' % (metadata, backing)
+            )
+        recorded = '<uvt:base_image xmlns:uvt="%s" path="/pool/base"/>' % (
+            uvtool.libvirt.LIBVIRT_METADATA_XMLNS)
+        for element, path in [
+                (disk_xml(''), None),
+                (disk_xml('', recorded), '/pool/base'),
+                (disk_xml('<backingStore/>'), '/pool/a.qcow'),
+                ]:
+            self.assertEqual(_base_image_path(element), path)
+
+    def test_uptime_only_for_local_system_connection(self):
+        self.assertEqual(
+            _local_qemu_run_dir('qemu:///system'), LIBVIRT_QEMU_RUN_DIR)
+        for uri in ['qemu:///session', 'qemu+ssh://host/system']:
+            self.assertIsNone(_local_qemu_run_dir(uri))
+        self.assertIsNone(_domain_uptime(None, 'a', 0))
+
+    def test_all_names(self):
+        session = mock.Mock()
+        session.conn.listAllDomains.return_value = [
+            self.domain('b', uvtool_created=False), self.domain('a')]
+        self.assertEqual(
+            list_domains(include_all=True, details=False, session=session),
+            [{'name': 'a'}, {'name': 'b'}]
+        )
+
+
+class TestMacsToIps(unittest.TestCase):
+    @mock.patch('uvtool.libvirt.macs_to_ips')
+    @mock.patch('uvtool.watchd.macs_to_ips')
+    def test_falls_back_without_watchd(self, watchd_macs_to_ips,
+            libvirt_macs_to_ips):
+        libvirt_macs_to_ips.return_value = {'52:54:00:00:00:01': '10.0.0.1'}
+        for error in [
+                uvtool.watchd.NotRunningError('/tmp/watchd.sock'),
+                uvtool.watchd.WatchdError('watchd: timed out'),
+                ]:
+            watchd_macs_to_ips.side_effect = error
+            self.assertEqual(
+                macs_to_ips(['52:54:00:00:00:01'], session=mock.Mock()),
+                {'52:54:00:00:00:01': '10.0.0.1'}
+            )
+        self.assertEqual(libvirt_macs_to_ips.call_count, 2)
+
+
+class TestWait(unittest.TestCase):
+    def args(self, names):
+        script = tempfile.NamedTemporaryFile()
+        self.addCleanup(script.close)
+        return argparse.Namespace(
+            name=names, regex=False, all_created_by_uvtool=False, jobs=1,
+            timeout=10.0, interval=1.0, remote_wait_script=script.name,
+            remote_wait_user='ubuntu', insecure=False, without_ssh=False,
+            ssh_private_key_file=None, timings=None,
+        )
+
+    @mock.patch('uvtool.libvirt.kvm.record_timings')
+    @mock.patch('uvtool.wait.wait_for_open_ssh_port', return_value=True)
+    @mock.patch('uvtool.libvirt.has_ready_channel', return_value=False)
+    @mock.patch('uvtool.libvirt.get_domain_macs')
+    @mock.patch('uvtool.watchd.domain_watcher')
+    @mock.patch('uvtool.watchd.lease_watcher')
+    @mock.patch('uvtool.libvirt.get_session')
+    @mock.patch('uvtool.libvirt.start_event_loop')
+    @mock.patch('uvtool.libvirt.kvm.ssh')
+    def test_many_names_through_remote_wait(self, ssh, start_event_loop,
+            get_session, lease_watcher, domain_watcher,
+            get_domain_macs, has_ready_channel, wait_for_open_ssh_port,
+            record_timings):
+        def fake_ssh(name, *args, **kwargs):
+            # Like the real thing, which exits unless told not to
+            if kwargs.get('sysexit', True):
+                sys.exit(0)
+            return 0
+
+        ssh.side_effect = fake_ssh
+        get_domain_macs.return_value = [
+            {'type': 'network', 'address': '52:54:00:00:00:01'}]
+        lease_watcher.return_value.wait.return_value = '192.168.122.11'
+        domain_watcher.return_value.is_stopped.return_value = False
+        names = ['a', 'b', 'c']
+        with mock.patch('sys.stdout', new=StringIO.StringIO()) as stdout:
+            main_wait(mock.Mock(), self.args(names))
+        self.assertEqual(stdout.getvalue().split(), names)
+        self.assertEqual(
+            sorted(call[0][0] for call in ssh.call_args_list), names)
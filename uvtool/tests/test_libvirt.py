@@ -0,0 +1,379 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import hashlib
+import io
+import tempfile
+import unittest
+
+import libvirt
+import mock
+
+import uvtool.libvirt
+
+FAKE_IMAGE = b'fake image\n'
+FAKE_IMAGE_SHA256 = hashlib.sha256(FAKE_IMAGE).hexdigest()
+
+
+class TestSpoolFobj(unittest.TestCase):
+    def testStreamIsSpooled(self):
+        spool = uvtool.libvirt._spool_fobj(
+            io.BytesIO(FAKE_IMAGE), expected_sha256=FAKE_IMAGE_SHA256)
+        with contextlib.closing(spool):
+            self.assertEqual(spool.read(), FAKE_IMAGE)
+
+    def testRegularFileIsUsedInPlace(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(FAKE_IMAGE)
+            f.flush()
+            spool = uvtool.libvirt._spool_fobj(
+                f, expected_sha256=FAKE_IMAGE_SHA256)
+            with contextlib.closing(spool):
+                self.assertEqual(spool.read(), FAKE_IMAGE)
+
+    def testChecksumMismatch(self):
+        self.assertRaises(
+            uvtool.libvirt.ChecksumError,
+            uvtool.libvirt._spool_fobj,
+            io.BytesIO(FAKE_IMAGE), expected_sha256='0' * 64
+        )
+
+
+class FakeStream(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append((True, data))
+        return len(data)
+
+    def sendHole(self, length, flags):
+        self.sent.append((False, length))
+
+
+class TestSparseUpload(unittest.TestCase):
+    def send(self, fobj, size, sparse=True):
+        stream = FakeStream()
+        uvtool.libvirt._stream_send_chunks(
+            stream, uvtool.libvirt._read_chunks(fobj, size), sparse)
+        return stream.sent
+
+    def assertSentEqual(self, sent, data):
+        self.assertTrue(b''.join(
+            x if is_data else b'\0' * x for is_data, x in sent) == data)
+
+    def testZeroChunksBecomeOneHole(self):
+        data = (
+            b'\0' * (uvtool.libvirt.UPLOAD_BUFFER_SIZE * 2) +
+            FAKE_IMAGE
+        )
+        sent = self.send(io.BytesIO(data), len(data))
+        self.assertEqual(sent, [
+            (False, uvtool.libvirt.UPLOAD_BUFFER_SIZE * 2),
+            (True, FAKE_IMAGE),
+        ])
+
+    def testFileHolesAreNotRead(self):
+        size = 64 * 1024 * 1024
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(FAKE_IMAGE)
+            f.truncate(size)
+            f.flush()
+            f.seek(0)
+            sent = self.send(f, size)
+            f.seek(0)
+            self.assertSentEqual(sent, f.read())
+        self.assertEqual(sent[-1][0], False)
+        data_sent = sum(len(x) for is_data, x in sent if is_data)
+        self.assertTrue(data_sent <= uvtool.libvirt.UPLOAD_BUFFER_SIZE)
+
+    def testDenseSendsZeroes(self):
+        data = b'\0' * 1024
+        sent = self.send(io.BytesIO(data), len(data), sparse=False)
+        self.assertEqual(sent, [(True, data)])
+
+    @mock.patch('libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM', 1,
+        create=True)
+    def testSparseRefusedFallsBackOnNewStream(self):
+        conn = mock.Mock()
+        sparse_stream, dense_stream = mock.Mock(), mock.Mock()
+        conn.newStream.side_effect = [sparse_stream, dense_stream]
+        dense_stream.send.side_effect = lambda data: len(data)
+        vol = mock.Mock()
+        vol.upload.side_effect = [libvirt.libvirtError('unsupported'), None]
+        uvtool.libvirt._upload_fobj(conn, vol, io.BytesIO(b'x'), 1)
+        self.assertTrue(sparse_stream.abort.called)
+        self.assertEqual(vol.upload.call_args[0], (dense_stream, 0, 1, 0))
+        self.assertTrue(dense_stream.finish.called)
+
+
+@mock.patch('uvtool.libvirt.libvirt')
+class TestSession(unittest.TestCase):
+    def testConnectionIsOpenedOnce(self, libvirt):
+        session = uvtool.libvirt.Session('test:///default')
+        session.pool('foo')
+        session.pool('foo')
+        session.volume('bar', 'foo')
+        session.volume('bar', 'foo')
+        libvirt.open.assert_called_once_with('test:///default')
+        self.assertEqual(
+            libvirt.open().storagePoolLookupByName.call_count, 1)
+        self.assertEqual(
+            libvirt.open().storagePoolLookupByName().
+                storageVolLookupByName.call_count,
+            1
+        )
+
+    def testVolumeFoundByPathIsCached(self, libvirt):
+        volume = libvirt.open().storageVolLookupByKey.return_value
+        volume.name.return_value = 'bar'
+        volume.storagePoolLookupByVolume().name.return_value = 'foo'
+        session = uvtool.libvirt.Session()
+        self.assertEqual(session.volume_by_path('/foo/bar'), ('foo', 'bar'))
+        self.assertIs(session.volume('bar', 'foo'), volume)
+        session.delete_volume('bar', 'foo')
+        self.assertTrue(volume.delete.called)
+        self.assertIsNot(session.volume('bar', 'foo'), volume)
+
+    def testDeletedVolumeIsForgotten(self, libvirt):
+        session = uvtool.libvirt.Session()
+        session.delete_volume('bar', 'foo')
+        session.volume('bar', 'foo')
+        self.assertEqual(
+            libvirt.open().storagePoolLookupByName().
+                storageVolLookupByName.call_count,
+            2
+        )
+
+
+def fake_volume(name, path, backing_path=None):
+    volume = mock.Mock()
+    volume.name.return_value = name
+    backing = (
+        '<backingStore><path>%s</path></backingStore>' % backing_path
+        if backing_path else ''
+    )
+    volume.XMLDesc.return_value = (
+        '<volume><target><path>%s</path></target>%s</volume>' %
+        (path, backing)
+    )
+    return volume
+
+
+def fake_domain(name, paths):
+    domain = mock.Mock()
+    domain.name.return_value = name
+    domain.isActive.return_value = False
+    domain.XMLDesc.return_value = '<domain><devices>%s</devices></domain>' % (
+        ''.join(
+            "<disk type='file'><source file='%s'/></disk>" % path
+            for path in paths
+        )
+    )
+    return domain
+
+
+class TestVolumeDependencyIndex(unittest.TestCase):
+    def setUp(self):
+        pool = mock.Mock()
+        pool.name.return_value = 'uvtool'
+        pool.listAllVolumes.return_value = [
+            fake_volume('base', '/pool/base'),
+            fake_volume('foo.qcow', '/pool/foo.qcow', '/pool/base'),
+            fake_volume('bar.qcow', '/pool/bar.qcow', '/pool/foo.qcow'),
+            fake_volume('unused', '/pool/unused'),
+        ]
+        session = mock.Mock()
+        session.conn.listAllStoragePools.return_value = [pool]
+        session.conn.listAllDomains.return_value = [
+            fake_domain('foo', ['/pool/foo.qcow']),
+            fake_domain('bar', ['/pool/bar.qcow', '/elsewhere/disk']),
+        ]
+        self.index = uvtool.libvirt.VolumeDependencyIndex(session=session)
+
+    def testBackingChainIsFollowed(self):
+        self.assertEqual(
+            list(self.index.backing_chain('/pool/bar.qcow')),
+            ['/pool/bar.qcow', '/pool/foo.qcow', '/pool/base']
+        )
+        self.assertEqual(
+            self.index.users_of_volume('base', 'uvtool'),
+            frozenset(['foo', 'bar'])
+        )
+        self.assertEqual(
+            self.index.users('/pool/foo.qcow'), frozenset(['foo', 'bar']))
+
+    def testVolumesInUse(self):
+        self.assertEqual(
+            sorted(uvtool.libvirt.get_all_domain_volume_names(
+                index=self.index, pool_name='uvtool')),
+            ['bar.qcow', 'base', 'foo.qcow']
+        )
+        self.assertEqual(
+            self.index.users_of_volume('unused', 'uvtool'), frozenset())
+
+
+class TestDnsmasqLeases(unittest.TestCase):
+    def testBothFilesAreRead(self):
+        with tempfile.NamedTemporaryFile() as lease_file:
+            with tempfile.NamedTemporaryFile() as status_file:
+                lease_file.write(
+                    b'1400000000 52:54:00:AA:00:01 192.168.122.10 a *\n'
+                    b'1400000000 52:54:00:aa:00:02 192.168.122.11 b *\n'
+                )
+                lease_file.flush()
+                status_file.write(
+                    b'[{"mac-address": "52:54:00:aa:00:02", '
+                    b'"ip-address": "192.168.122.99"}, '
+                    b'{"mac-address": "52:54:00:aa:00:03", '
+                    b'"ip-address": "192.168.122.12"}, '
+                    b'{"mac-address": "52:54:00:AA:00:04", '
+                    b'"ip-address": "192.168.122.13"}]'
+                )
+                status_file.flush()
+                with mock.patch.multiple(
+                        uvtool.libvirt,
+                        LIBVIRT_DNSMASQ_LEASE_FILE=lease_file.name,
+                        LIBVIRT_DNSMASQ_STATUS_FILE=status_file.name):
+                    self.assertEqual(uvtool.libvirt.dnsmasq_leases(), {
+                        '52:54:00:aa:00:01': '192.168.122.10',
+                        '52:54:00:aa:00:02': '192.168.122.11',
+                        '52:54:00:aa:00:03': '192.168.122.12',
+                        '52:54:00:aa:00:04': '192.168.122.13',
+                    })
+
+    def testLeaseFileIsOnlyParsedWhenChanged(self):
+        with tempfile.NamedTemporaryFile() as lease_file:
+            lease_file.write(b'1 52:54:00:aa:00:01 192.168.122.10 a *\n')
+            lease_file.flush()
+            index = uvtool.libvirt._FileIndex(
+                mock.Mock(wraps=uvtool.libvirt._parse_dnsmasq_lease_file))
+            self.assertEqual(
+                index.get(lease_file.name),
+                {'52:54:00:aa:00:01': '192.168.122.10'}
+            )
+            index.get(lease_file.name)
+            self.assertEqual(index._parse.call_count, 1)
+            lease_file.write(b'1 52:54:00:aa:00:02 192.168.122.11 b *\n')
+            lease_file.flush()
+            self.assertEqual(len(index.get(lease_file.name)), 2)
+            self.assertEqual(index._parse.call_count, 2)
+
+    @mock.patch('libvirt.VIR_IP_ADDR_TYPE_IPV4', 0, create=True)
+    @mock.patch('libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE', 1, create=True)
+    @mock.patch('uvtool.libvirt.dnsmasq_leases')
+    def testMacsToIpsAsksLibvirtForTheRest(self, dnsmasq_leases):
+        dnsmasq_leases.return_value = {'52:54:00:aa:00:01': '192.168.122.10'}
+        network = mock.Mock()
+        network.DHCPLeases.return_value = [
+            {'mac': '52:54:00:aa:00:02', 'iptype': 1, 'ipaddr': 'fe80::1'},
+            {'mac': '52:54:00:aa:00:02', 'iptype': 0, 'ipaddr': '10.0.0.2'},
+        ]
+        session = mock.Mock()
+        session.conn.listAllNetworks.return_value = [network]
+        self.assertEqual(
+            uvtool.libvirt.macs_to_ips(
+                ['52:54:00:AA:00:01', '52:54:00:aa:00:02',
+                    '52:54:00:aa:00:03'],
+                session=session
+            ),
+            {'52:54:00:AA:00:01': '192.168.122.10',
+                '52:54:00:aa:00:02': '10.0.0.2'}
+        )
+        self.assertEqual(network.DHCPLeases.call_count, 1)
+
+
+class TestDomainLifecycleWatcher(unittest.TestCase):
+    def watcher(self, state, register_fails=False):
+        session = mock.Mock()
+        if register_fails:
+            session.conn.domainEventRegisterAny.side_effect = (
+                libvirt.libvirtError('no event loop'))
+        else:
+            session.conn.domainEventRegisterAny.return_value = 7
+        domain = mock.Mock()
+        domain.state.return_value = [state, 0]
+        return uvtool.libvirt.DomainLifecycleWatcher(domain, session=session)
+
+    def testEventsUpdateState(self):
+        watcher = self.watcher(libvirt.VIR_DOMAIN_SHUTOFF)
+        self.assertTrue(watcher.is_stopped())
+        self.assertFalse(watcher.wait_until_running(0))
+
+        callback = watcher.conn.domainEventRegisterAny.call_args[0][2]
+        callback(watcher.conn, watcher.domain,
+                 libvirt.VIR_DOMAIN_EVENT_STARTED, 0, None)
+        self.assertTrue(watcher.wait_until_running(0))
+        self.assertFalse(watcher.is_stopped())
+
+        callback(watcher.conn, watcher.domain,
+                 libvirt.VIR_DOMAIN_EVENT_CRASHED, 0, None)
+        self.assertTrue(watcher.is_stopped())
+        # Events are relied upon; the state is only read once
+        self.assertEqual(watcher.domain.state.call_count, 1)
+
+        watcher.close()
+        watcher.conn.domainEventDeregisterAny.assert_called_once_with(7)
+
+    def testFallsBackToQueryingState(self):
+        watcher = self.watcher(
+            libvirt.VIR_DOMAIN_RUNNING, register_fails=True)
+        self.assertTrue(watcher.wait_until_running(10))
+        watcher.domain.state.return_value = [libvirt.VIR_DOMAIN_SHUTOFF, 0]
+        self.assertTrue(watcher.is_stopped())
+        watcher.close()
+        self.assertFalse(watcher.conn.domainEventDeregisterAny.called)
+
+
+@mock.patch('libvirt.VIR_DOMAIN_METADATA_ELEMENT', 2, create=True)
+@mock.patch('libvirt.VIR_DOMAIN_AFFECT_CONFIG', 2, create=True)
+@mock.patch('libvirt.VIR_DOMAIN_AFFECT_LIVE', 1, create=True)
+class TestDomainTimings(unittest.TestCase):
+    def fake_domain(self):
+        domain = mock.Mock()
+        domain.isActive.return_value = True
+        stored = {}
+
+        def metadata(type, uri, flags):
+            try:
+                return stored[uri]
+            except KeyError:
+                raise libvirt.libvirtError('no metadata')
+
+        def set_metadata(type, xml, key, uri, flags):
+            stored[uri] = xml
+
+        domain.metadata.side_effect = metadata
+        domain.setMetadata.side_effect = set_metadata
+        return domain
+
+    def testOperationsAreKeptSeparately(self):
+        domain = self.fake_domain()
+        self.assertEqual(uvtool.libvirt.get_domain_timings(domain), {})
+        create = {
+            'started': 1400000000.25,
+            'phases': [{'name': 'seed', 'start': 0.5, 'duration': 1.25}],
+        }
+        wait = {'started': 1400000003.5, 'phases': []}
+        uvtool.libvirt.record_domain_timings(domain, 'create', create)
+        uvtool.libvirt.record_domain_timings(domain, 'wait', wait)
+        self.assertEqual(
+            uvtool.libvirt.get_domain_timings(domain),
+            {'create': create, 'wait': wait}
+        )
+        flags = domain.setMetadata.call_args[0][4]
+        self.assertEqual(flags, 3)
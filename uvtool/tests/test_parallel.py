@@ -0,0 +1,120 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import unittest
+
+import uvtool.parallel
+
+
+class TestWorkerPool(unittest.TestCase):
+    def testRunAllKeepsOrderAndIsolatesFailures(self):
+        def square(n):
+            if n == 3:
+                raise ValueError(n)
+            return n * n
+
+        jobs = uvtool.parallel.run_all(square, range(6), 3)
+        self.assertTrue(all(job.done() for job in jobs))
+        self.assertIsInstance(jobs[3].exception, ValueError)
+        self.assertRaises(ValueError, jobs[3].result)
+        self.assertEqual(
+            [job.result() for i, job in enumerate(jobs) if i != 3],
+            [0, 1, 4, 16, 25]
+        )
+
+    def testConcurrencyIsBounded(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+        release = threading.Event()
+
+        def work(n):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+                if state['running'] == 2:
+                    release.set()
+            # Hold every job until two are running at once
+            release.wait(5)
+            with lock:
+                state['running'] -= 1
+
+        with uvtool.parallel.WorkerPool(2) as pool:
+            for n in range(5):
+                pool.submit(work, n)
+        self.assertEqual(state['peak'], 2)
+
+    def testRejectsZeroJobs(self):
+        self.assertRaises(ValueError, uvtool.parallel.WorkerPool, 0)
+
+    def testJobsCanWaitForJobsTheySubmit(self):
+        # With one thread, the outer jobs would hold it forever if waiting
+        # for the inner ones did not run them
+        def outer(n):
+            inner = [pool.submit(lambda m: n * 10 + m, m) for m in range(3)]
+            pool.wait_for(inner)
+            return [job.result() for job in inner]
+
+        with uvtool.parallel.WorkerPool(1) as pool:
+            jobs = [pool.submit(outer, n) for n in range(3)]
+        self.assertEqual(
+            [job.result() for job in jobs],
+            [[0, 1, 2], [10, 11, 12], [20, 21, 22]]
+        )
+
+    def testSystemExitDoesNotStopWorkers(self):
+        def exit(n):
+            sys.exit(n)
+
+        jobs = uvtool.parallel.run_all(exit, range(5), 2)
+        self.assertTrue(all(job.done() for job in jobs))
+        self.assertEqual([job.exception.code for job in jobs], range(5))
+
+
+class TestTaskGraph(unittest.TestCase):
+    def testResultsFlowToDependents(self):
+        graph = uvtool.parallel.TaskGraph()
+        graph.add('a', lambda: 2)
+        graph.add('b', lambda: 3)
+        graph.add('c', lambda a, b: a * b, requires=['a', 'b'])
+        self.assertEqual(graph.run(), {'a': 2, 'b': 3, 'c': 6})
+
+    def testIndependentTasksRunConcurrently(self):
+        started = [threading.Event(), threading.Event()]
+
+        def task(n):
+            started[n].set()
+            # Fails unless the other task is running at the same time
+            if not started[1 - n].wait(5):
+                raise RuntimeError("tasks ran in sequence")
+
+        graph = uvtool.parallel.TaskGraph()
+        graph.add('a', lambda: task(0))
+        graph.add('b', lambda: task(1))
+        graph.run()
+
+    def testFailureStopsDependents(self):
+        ran = []
+        graph = uvtool.parallel.TaskGraph()
+        graph.add('a', lambda: 1 // 0)
+        graph.add('b', lambda a: ran.append('b'), requires=['a'])
+        self.assertRaises(ZeroDivisionError, graph.run)
+        self.assertEqual(ran, [])
+
+    def testUnknownRequirement(self):
+        graph = uvtool.parallel.TaskGraph()
+        self.assertRaises(ValueError, graph.add, 'a', int, requires=['b'])
@@ -0,0 +1,199 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
+import mock
+
+import uvtool.seed
+
+SECTOR_SIZE = uvtool.seed.SECTOR_SIZE
+
+
+def read_root_directory(image, descriptor_sector):
+    """Return {identifier: content} from the root directory of a volume."""
+    descriptor = image[
+        descriptor_sector * SECTOR_SIZE:(descriptor_sector + 1) * SECTOR_SIZE]
+    root_extent, root_length = struct.unpack('<I4xI', descriptor[158:170])
+    directory = image[
+        root_extent * SECTOR_SIZE:root_extent * SECTOR_SIZE + root_length]
+    result = {}
+    offset = 0
+    while offset < len(directory) and directory[offset] != b'\0':
+        length = ord(directory[offset])
+        record = directory[offset:offset + length]
+        extent, size = struct.unpack('<I4xI', record[2:14])
+        identifier = record[33:33 + ord(record[32])]
+        result[identifier] = image[
+            extent * SECTOR_SIZE:extent * SECTOR_SIZE + size]
+        offset += length
+    return result
+
+
+class TestSeed(unittest.TestCase):
+    def setUp(self):
+        self.image = uvtool.seed.build_nocloud_seed(
+            b'#cloud-config\nhostname: foo\n', b'instance-id: foo\n')
+
+    def testVolumeDescriptors(self):
+        self.assertEqual(len(self.image) % SECTOR_SIZE, 0)
+        primary = self.image[16 * SECTOR_SIZE:17 * SECTOR_SIZE]
+        self.assertEqual(primary[:7], b'\1CD001\1')
+        self.assertEqual(primary[40:72].rstrip(b' '), b'cidata')
+        self.assertEqual(
+            struct.unpack('<I', primary[80:84])[0],
+            len(self.image) // SECTOR_SIZE
+        )
+        joliet = self.image[17 * SECTOR_SIZE:18 * SECTOR_SIZE]
+        self.assertEqual(joliet[:7], b'\2CD001\1')
+        self.assertEqual(joliet[88:91], b'%/E')
+        self.assertEqual(
+            joliet[40:72].decode('utf-16-be').rstrip(' '), 'cidata')
+        terminator = self.image[18 * SECTOR_SIZE:19 * SECTOR_SIZE]
+        self.assertEqual(terminator[:7], b'\xffCD001\1')
+
+    def testPrimaryFiles(self):
+        files = read_root_directory(self.image, 16)
+        self.assertEqual(
+            files[b'USER-DATA;1'], b'#cloud-config\nhostname: foo\n')
+        self.assertEqual(files[b'META-DATA;1'], b'instance-id: foo\n')
+
+    def testJolietFiles(self):
+        files = read_root_directory(self.image, 17)
+        self.assertEqual(
+            files['user-data'.encode('utf-16-be')],
+            b'#cloud-config\nhostname: foo\n'
+        )
+        self.assertEqual(
+            files['meta-data'.encode('utf-16-be')], b'instance-id: foo\n')
+
+    def testReproducible(self):
+        self.assertEqual(
+            uvtool.seed.build_nocloud_seed(b'a', b'b', timestamp=0),
+            uvtool.seed.build_nocloud_seed(b'a', b'b', timestamp=0),
+        )
+
+
+class TestSeedServer(unittest.TestCase):
+    def setUp(self):
+        self.seed_dir = tempfile.mkdtemp(prefix='uvtool-test-')
+        self.addCleanup(shutil.rmtree, self.seed_dir)
+        self.server = uvtool.seed.SeedServer(('127.0.0.1', 0), self.seed_dir)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+
+    def get(self, path):
+        return self.opener.open(self.base_url + path).read()
+
+    def testServeStoredSeed(self):
+        token = uvtool.seed.store_seed(
+            b'#cloud-config\n', b'instance-id: foo\n', seed_dir=self.seed_dir)
+        url = uvtool.seed.seed_url(self.base_url, token)
+        self.assertEqual(self.opener.open(url + 'user-data').read(),
+            b'#cloud-config\n')
+        self.assertEqual(self.opener.open(url + 'meta-data').read(),
+            b'instance-id: foo\n')
+        self.assertEqual(self.opener.open(url + 'vendor-data').read(), b'')
+
+    def testUnknownPathsAreNotFound(self):
+        token = uvtool.seed.store_seed(b'', b'', seed_dir=self.seed_dir)
+        for path in [
+                '%s/../../etc/passwd' % token,
+                '%s/other' % token,
+                '0' * 32 + '/meta-data',
+                '.tmp-%s/meta-data' % token]:
+            with self.assertRaises(urllib2.HTTPError) as cm:
+                self.get(path)
+            self.assertEqual(cm.exception.code, 404)
+
+    def testRemoveSeed(self):
+        token = uvtool.seed.store_seed(b'', b'', seed_dir=self.seed_dir)
+        uvtool.seed.remove_seed(token, seed_dir=self.seed_dir)
+        self.assertEqual(os.listdir(self.seed_dir), [])
+        with self.assertRaises(urllib2.HTTPError):
+            self.get('%s/meta-data' % token)
+
+    def testEnsureUsesRunningServer(self):
+        token = uvtool.seed.store_seed(b'', b'', seed_dir=self.seed_dir)
+        uvtool.seed.ensure_seed_server(
+            self.base_url, token, seed_dir=self.seed_dir, timeout=0)
+
+    def testUserDataFetchEndsWait(self):
+        token = uvtool.seed.store_seed(b'', b'', seed_dir=self.seed_dir)
+        self.assertEqual(uvtool.seed.pending_seeds(self.seed_dir), [token])
+        self.get('%s/meta-data' % token)
+        self.assertEqual(uvtool.seed.pending_seeds(self.seed_dir), [token])
+        self.get('%s/user-data' % token)
+        self.assertEqual(uvtool.seed.pending_seeds(self.seed_dir), [])
+        # Still served, for example to the guest's next boot
+        self.get('%s/user-data' % token)
+
+    def testPendingSeedsExpire(self):
+        uvtool.seed.store_seed(b'', b'', seed_dir=self.seed_dir)
+        self.assertEqual(
+            uvtool.seed.pending_seeds(
+                self.seed_dir,
+                now=time.time() + uvtool.seed.SEED_PENDING_TIMEOUT + 1),
+            []
+        )
+
+    def testDefaultPortIsPerUser(self):
+        self.assertEqual(
+            uvtool.seed.default_seed_port(0), uvtool.seed.SEED_SERVER_PORT)
+        self.assertNotEqual(
+            uvtool.seed.default_seed_port(1000),
+            uvtool.seed.default_seed_port(1001)
+        )
+
+    @mock.patch('uvtool.seed.SEED_IDLE_CHECK_INTERVAL', 0.01)
+    @mock.patch('uvtool.seed.SEED_IDLE_TIMEOUT', 0)
+    def testServerStartedOnDemandStopsWhenIdle(self):
+        token = uvtool.seed.store_seed(b'', b'', seed_dir=self.seed_dir)
+        thread = threading.Thread(
+            target=uvtool.seed.serve, args=('127.0.0.1', 0, self.seed_dir),
+            kwargs={'stop_when_idle': True}
+        )
+        thread.daemon = True
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        uvtool.seed.remove_seed(token, seed_dir=self.seed_dir)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    @mock.patch('uvtool.parallel.start_detached')
+    def testEnsureRefusesPortOfAnotherServer(self, start_detached):
+        # The running server has other seeds, as another user's would
+        other_seed_dir = tempfile.mkdtemp(prefix='uvtool-test-')
+        self.addCleanup(shutil.rmtree, other_seed_dir)
+        token = uvtool.seed.store_seed(b'', b'', seed_dir=other_seed_dir)
+        with self.assertRaises(RuntimeError) as cm:
+            uvtool.seed.ensure_seed_server(
+                self.base_url, token, seed_dir=other_seed_dir, timeout=0.2)
+        self.assertIn('--seed-url', str(cm.exception))
+        self.assertFalse(start_detached.called)
@@ -14,6 +14,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
 
 import mock
@@ -37,12 +42,29 @@ ENCODED_FAKE_VOLUME_PRODUCT_NAME_0 = simplestreams._encode_libvirt_pool_name(
     FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_0)
 ENCODED_FAKE_VOLUME_PRODUCT_NAME_1 = simplestreams._encode_libvirt_pool_name(
     FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_1)
+# Volumes are named after the sha256 of their content in the fake streams
+FAKE_VOLUME_NAME_0 = simplestreams._content_volume_name(
+    '520e579da0a29a08f73aaa018eed12b6778460ea446f442dedaa8a950674afda')
+FAKE_VOLUME_NAME_1 = simplestreams._content_volume_name(
+    'cc4dea38d5e5db5e60a919c4957842141a264116bb848577a5c1a7db6ca3459c')
 
 @unittest.skipIf(ON_PRECISE, 'mock version is too old')
 @mock.patch('uvtool.libvirt.simplestreams.uvtool.libvirt')
-@mock.patch('uvtool.libvirt.simplestreams.pool_metadata', new=simplestreams.Metadata())
 @mock.patch('uvtool.libvirt.simplestreams.libvirt')
 class TestSimpleStreams(unittest.TestCase):
+    def setUp(self):
+        # Each test gets its own empty metadata catalog
+        metadata_dir = tempfile.mkdtemp(prefix='uvtool-test-')
+        self.addCleanup(shutil.rmtree, metadata_dir)
+        for name, store in [
+                ('pool_metadata', simplestreams.Metadata(metadata_dir)),
+                ('metadata_cache', simplestreams.MetadataCache(metadata_dir)),
+                ]:
+            patcher = mock.patch(
+                'uvtool.libvirt.simplestreams.' + name, new=store)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
     def testSync(self, libvirt, uvtool_libvirt):
         # If you're changing any of ENCODED_FAKE_VOLUME_PRODUCT_NAME make sure
         # to change pool_type return value appropriately
@@ -50,7 +72,7 @@ class TestSimpleStreams(unittest.TestCase):
         uvtool_libvirt.have_volume_by_name.return_value = False
         uvtool_libvirt.get_all_domain_volume_names.return_value = []
         uvtool_libvirt.volume_names_in_pool.return_value = [
-            ENCODED_FAKE_VOLUME_PRODUCT_NAME_0]
+            FAKE_VOLUME_NAME_0]
         simplestreams.main(
             'sync '
             '--no-authentication '
@@ -60,18 +82,18 @@ class TestSimpleStreams(unittest.TestCase):
             .split()
         )
         # Check that we have mocked libvirt correctly, which means that
-        # this test is working. We expect libvirt.open to have been called at
-        # least once by uvtool.libvirt.simplestreams directly. This is more of
-        # an assertion about the test being correct than part of the test
-        # itself.
-        libvirt.assert_has_calls([mock.call.open(u'qemu:///system')])
+        # this test is working. We expect the shared libvirt session to have
+        # been fetched at least once by uvtool.libvirt.simplestreams directly.
+        # This is more of an assertion about the test being correct than part
+        # of the test itself.
+        self.assertTrue(uvtool_libvirt.get_session.called)
 
         # create_volume_from_fobj should have been called exactly once to
         # create the volume with the name that we expect
         self.assertEqual(uvtool_libvirt.create_volume_from_fobj.call_count, 1)
         self.assertEqual(
             uvtool_libvirt.create_volume_from_fobj.call_args[0][0],
-            ENCODED_FAKE_VOLUME_PRODUCT_NAME_0
+            FAKE_VOLUME_NAME_0
         )
         # Make sure the only calls to uvtool.libvirt were ones that we have
         # either whitelisted to be query-only (no side effects), or that we
@@ -85,6 +107,8 @@ class TestSimpleStreams(unittest.TestCase):
 
                 # whitelist of query functions that produce no side effects
                 'create_volume_from_fobj',
+                'get_session',
+                'set_default_uri',
                 'get_libvirt_pool_object',
                 'have_volume_by_name',
                 'volume_names_in_pool',
@@ -92,19 +116,19 @@ class TestSimpleStreams(unittest.TestCase):
             ])
 
     def _testResync(self, libvirt, uvtool_libvirt, old_volume_delete_expected,
-            volumes_in_use=None):
+            volumes_in_use=None, extra_args=''):
         # If you're changing any of ENCODED_FAKE_VOLUME_PRODUCT_NAME make sure
         # to change pool_type return value appropriately
         uvtool_libvirt.pool_type.return_value = 'dir'
         uvtool_libvirt.have_volume_by_name.side_effect = (
-            lambda name, **kwargs: name == ENCODED_FAKE_VOLUME_PRODUCT_NAME_0)
+            lambda name, **kwargs: name == FAKE_VOLUME_NAME_0)
         if volumes_in_use:
             uvtool_libvirt.get_all_domain_volume_names.return_value = list(
                 volumes_in_use)
         else:
             uvtool_libvirt.get_all_domain_volume_names.return_value = []
         uvtool_libvirt.volume_names_in_pool.return_value = [
-            ENCODED_FAKE_VOLUME_PRODUCT_NAME_0]
+            FAKE_VOLUME_NAME_0]
         simplestreams.main(
             'sync '
             '--no-authentication '
@@ -115,13 +139,13 @@ class TestSimpleStreams(unittest.TestCase):
         )
         uvtool_libvirt.reset_mock()
         uvtool_libvirt.volume_names_in_pool.return_value = [
-            ENCODED_FAKE_VOLUME_PRODUCT_NAME_0]
+            FAKE_VOLUME_NAME_0]
         simplestreams.main(
-            'sync '
+            ('sync '
             '--no-authentication '
             '--source=uvtool/tests/streams/fake_stream_1 '
             '--path streams/v1/index.json '
-            'release=precise arch=amd64 '
+            'release=precise arch=amd64 ' + extra_args)
             .split()
         )
         # create_volume_from_fobj should have been called exactly once to
@@ -129,7 +153,7 @@ class TestSimpleStreams(unittest.TestCase):
         self.assertEqual(uvtool_libvirt.create_volume_from_fobj.call_count, 1)
         self.assertEqual(
             uvtool_libvirt.create_volume_from_fobj.call_args[0][0],
-            ENCODED_FAKE_VOLUME_PRODUCT_NAME_1
+            FAKE_VOLUME_NAME_1
         )
 
         if old_volume_delete_expected:
@@ -139,7 +163,7 @@ class TestSimpleStreams(unittest.TestCase):
                 uvtool_libvirt.delete_volume_by_name.call_count, 1)
             self.assertEqual(
                 uvtool_libvirt.delete_volume_by_name.call_args[0][0],
-                ENCODED_FAKE_VOLUME_PRODUCT_NAME_0
+                FAKE_VOLUME_NAME_0
             )
         else:
             # delete_volume_by_name should not have been called at all
@@ -162,6 +186,8 @@ class TestSimpleStreams(unittest.TestCase):
 
                 # whitelist of query functions that produce no side effects
                 'create_volume_from_fobj',
+                'get_session',
+                'set_default_uri',
                 'get_libvirt_pool_object',
                 'have_volume_by_name',
                 'volume_names_in_pool',
@@ -177,6 +203,254 @@ class TestSimpleStreams(unittest.TestCase):
             libvirt,
             uvtool_libvirt,
             False,
-            ['foo.qcow', 'foo-ds.qcow', ENCODED_FAKE_VOLUME_PRODUCT_NAME_0]
+            ['foo.qcow', 'foo-ds.qcow', FAKE_VOLUME_NAME_0]
         )
 
+    def testIdenticalContentIsNotUploadedAgain(self, libvirt, uvtool_libvirt):
+        # Another product with the same content already put it in the pool
+        uvtool_libvirt.pool_type.return_value = 'dir'
+        uvtool_libvirt.have_volume_by_name.side_effect = (
+            lambda name, **kwargs: name == FAKE_VOLUME_NAME_0)
+        uvtool_libvirt.get_all_domain_volume_names.return_value = []
+        uvtool_libvirt.volume_names_in_pool.return_value = [
+            FAKE_VOLUME_NAME_0]
+        simplestreams.pool_metadata.set(
+            'com.ubuntu.cloud.daily:server:12.04:amd64', FAKE_VOLUME_VERSION_0,
+            {'product_name': 'com.ubuntu.cloud.daily:server:12.04:amd64',
+             'version_name': FAKE_VOLUME_VERSION_0},
+            volume=FAKE_VOLUME_NAME_0
+        )
+        simplestreams.main(
+            'sync '
+            '--no-authentication '
+            '--source=uvtool/tests/streams/fake_stream_0 '
+            '--path streams/v1/index.json '
+            'release=precise arch=amd64 '
+            .split()
+        )
+        self.assertEqual(uvtool_libvirt.create_volume_from_fobj.call_count, 0)
+        self.assertEqual(uvtool_libvirt.delete_volume_by_name.call_count, 0)
+        self.assertEqual(
+            simplestreams.pool_metadata.volume(
+                FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_0),
+            FAKE_VOLUME_NAME_0
+        )
+        self.assertEqual(
+            simplestreams.pool_metadata.references(FAKE_VOLUME_NAME_0), 2)
+        self.assertEqual(
+            simplestreams.get_libvirt_pool_name(
+                FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_0, 'uvtool'),
+            FAKE_VOLUME_NAME_0
+        )
+
+    def testUnchangedSourceIsNotWalkedAgain(self, libvirt, uvtool_libvirt):
+        uvtool_libvirt.pool_type.return_value = 'dir'
+        uvtool_libvirt.have_volume_by_name.return_value = False
+        uvtool_libvirt.get_all_domain_volume_names.return_value = []
+        uvtool_libvirt.volume_names_in_pool.return_value = [
+            FAKE_VOLUME_NAME_0]
+        argv = (
+            'sync '
+            '--no-authentication '
+            '--source=uvtool/tests/streams/fake_stream_0 '
+            '--path streams/v1/index.json '
+            'release=precise arch=amd64 '
+            .split()
+        )
+        simplestreams.main(argv)
+        self.assertEqual(uvtool_libvirt.create_volume_from_fobj.call_count, 1)
+
+        uvtool_libvirt.reset_mock()
+        uvtool_libvirt.volume_names_in_pool.return_value = [
+            FAKE_VOLUME_NAME_0]
+        simplestreams.main(argv)
+        self.assertEqual(uvtool_libvirt.have_volume_by_name.call_count, 0)
+        self.assertEqual(uvtool_libvirt.create_volume_from_fobj.call_count, 0)
+        # Only the volume names are listed once; no volume or domain is
+        # looked at for cleaning up
+        self.assertEqual(uvtool_libvirt.volume_names_in_pool.call_count, 1)
+        self.assertEqual(
+            uvtool_libvirt.get_all_domain_volume_names.call_count, 0)
+        self.assertEqual(uvtool_libvirt.VolumeDependencyIndex.call_count, 0)
+        self.assertEqual(uvtool_libvirt.delete_volume_by_name.call_count, 0)
+
+        # If the volume goes missing, the source must be walked again
+        uvtool_libvirt.reset_mock()
+        uvtool_libvirt.volume_names_in_pool.return_value = []
+        simplestreams.main(argv)
+        self.assertEqual(uvtool_libvirt.create_volume_from_fobj.call_count, 1)
+
+    def testResyncWithJobs(self, libvirt, uvtool_libvirt):
+        self._testResync(libvirt, uvtool_libvirt, True, extra_args='--jobs 2')
+
+    def testResyncWithJobsKeepsOldVersionOnFailure(
+            self, libvirt, uvtool_libvirt):
+        uvtool_libvirt.pool_type.return_value = 'dir'
+        uvtool_libvirt.have_volume_by_name.side_effect = (
+            lambda name, **kwargs: name == FAKE_VOLUME_NAME_0)
+        uvtool_libvirt.get_all_domain_volume_names.return_value = []
+        uvtool_libvirt.volume_names_in_pool.return_value = [
+            FAKE_VOLUME_NAME_0]
+        simplestreams.main(
+            'sync '
+            '--no-authentication '
+            '--source=uvtool/tests/streams/fake_stream_0 '
+            '--path streams/v1/index.json '
+            'release=precise arch=amd64 '
+            .split()
+        )
+        uvtool_libvirt.reset_mock()
+        uvtool_libvirt.create_volume_from_fobj.side_effect = RuntimeError(
+            'upload failed')
+        with self.assertRaises(SystemExit):
+            simplestreams.main(
+                'sync '
+                '--no-authentication '
+                '--source=uvtool/tests/streams/fake_stream_1 '
+                '--path streams/v1/index.json '
+                '--jobs 2 '
+                'release=precise arch=amd64 '
+                .split()
+            )
+        # The failed version must not be recorded, and the version it was
+        # meant to replace must be kept
+        self.assertEqual(uvtool_libvirt.delete_volume_by_name.call_count, 0)
+        self.assertTrue(simplestreams.pool_metadata.has(
+            FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_0))
+        self.assertFalse(simplestreams.pool_metadata.has(
+            FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_1))
+
+
+
+class TestMetadata(unittest.TestCase):
+    def setUp(self):
+        self.metadata_dir = tempfile.mkdtemp(prefix='uvtool-test-')
+        self.addCleanup(shutil.rmtree, self.metadata_dir)
+
+    def fake_metadata(self, version, release='precise', arch='amd64'):
+        return {
+            'product_name': FAKE_VOLUME_PRODUCT_NAME,
+            'version_name': version,
+            'release': release,
+            'arch': arch,
+            'label': 'release',
+        }
+
+    def testMigrateMetadataFiles(self):
+        metadata = self.fake_metadata(FAKE_VOLUME_VERSION_0)
+        legacy_path = os.path.join(
+            self.metadata_dir, ENCODED_FAKE_VOLUME_PRODUCT_NAME_0)
+        with open(legacy_path, 'w') as f:
+            json.dump(metadata, f)
+
+        catalog = simplestreams.Metadata(self.metadata_dir)
+        self.assertEqual(
+            catalog.get(
+                FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_0
+            ).get(),
+            metadata
+        )
+        self.assertFalse(os.path.exists(legacy_path))
+
+    def testFind(self):
+        catalog = simplestreams.Metadata(self.metadata_dir)
+        catalog.get(FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_0).set(
+            self.fake_metadata(FAKE_VOLUME_VERSION_0))
+        catalog.get(FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_1).set(
+            self.fake_metadata(FAKE_VOLUME_VERSION_1, release='trusty'))
+
+        self.assertEqual(
+            [m['version_name'] for m in catalog.find(release='trusty')],
+            [FAKE_VOLUME_VERSION_1]
+        )
+        self.assertEqual(len(catalog.find(arch='amd64')), 2)
+        self.assertEqual(catalog.find(arch='i386'), [])
+
+        catalog.delete(FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_1)
+        self.assertFalse(
+            catalog.has(FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_1))
+        self.assertTrue(
+            catalog.contains(ENCODED_FAKE_VOLUME_PRODUCT_NAME_0))
+
+
+    def testAddVolumeColumn(self):
+        # A catalog from before volumes were recorded
+        db = sqlite3.connect(
+            os.path.join(self.metadata_dir, simplestreams.CATALOG_NAME))
+        with db:
+            db.execute(
+                '''CREATE TABLE items (
+                    product TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    release TEXT,
+                    arch TEXT,
+                    label TEXT,
+                    metadata TEXT NOT NULL,
+                    PRIMARY KEY (product, version)
+                )'''
+            )
+            db.execute(
+                'INSERT INTO items VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_0,
+                    'precise', 'amd64', 'release',
+                    json.dumps(self.fake_metadata(FAKE_VOLUME_VERSION_0)),
+                )
+            )
+        db.close()
+
+        catalog = simplestreams.Metadata(self.metadata_dir)
+        self.assertEqual(
+            catalog.volumes(),
+            [(FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_0, None)]
+        )
+        catalog.set(
+            FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_1,
+            self.fake_metadata(FAKE_VOLUME_VERSION_1),
+            volume=FAKE_VOLUME_NAME_1
+        )
+        self.assertEqual(catalog.references(FAKE_VOLUME_NAME_1), 1)
+        self.assertTrue(catalog.contains(FAKE_VOLUME_NAME_1))
+        self.assertFalse(catalog.contains(FAKE_VOLUME_NAME_0))
+
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        metadata_dir = tempfile.mkdtemp(prefix='uvtool-test-')
+        self.addCleanup(shutil.rmtree, metadata_dir)
+        self.cache = simplestreams.MetadataCache(metadata_dir)
+
+    def testVerifiedOnlyOnce(self):
+        verify = mock.Mock(return_value='payload')
+        for _ in range(2):
+            self.assertEqual(
+                self.cache.verified('content', 'keyring:1', verify),
+                'payload'
+            )
+        self.assertEqual(verify.call_count, 1)
+        # A different keyring must verify again
+        self.cache.verified('content', 'keyring:2', verify)
+        self.assertEqual(verify.call_count, 2)
+
+    def testFetchRevalidates(self):
+        response = mock.Mock()
+        response.read.return_value = b'{"format": "index:1.0"}'
+        response.info.return_value.getheader.side_effect = (
+            lambda name: {'etag': '"v1"'}.get(name))
+        with mock.patch('uvtool.libvirt.simplestreams.urllib2') as urllib2:
+            urllib2.urlopen.return_value = response
+            self.assertEqual(
+                self.cache.fetch('http://example.com/index.json'),
+                '{"format": "index:1.0"}'
+            )
+
+            class NotModified(Exception):
+                code = 304
+            urllib2.HTTPError = NotModified
+            urllib2.urlopen.side_effect = NotModified()
+            self.assertEqual(
+                self.cache.fetch('http://example.com/index.json'),
+                '{"format": "index:1.0"}'
+            )
+            request = urllib2.Request.return_value
+            request.add_header.assert_called_with('If-None-Match', '"v1"')
@@ -0,0 +1,95 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import mock
+
+import uvtool.ssh
+
+
+def fake_keygen(key_type, private_path):
+    with open(private_path, 'wb') as f:
+        f.write(b'private ' + os.path.basename(os.path.dirname(private_path)))
+    with open(private_path + '.pub', 'wb') as f:
+        f.write(b'ssh-' + key_type + b' public\n')
+
+
+@mock.patch('uvtool.ssh._start_background_fill')
+@mock.patch('uvtool.ssh._keygen', side_effect=fake_keygen)
+class TestHostKeyPool(unittest.TestCase):
+    KEY_TYPES = ['rsa', 'ed25519']
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp(prefix='uvtool-test-')
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.pool_dir = os.path.join(tmp_dir, 'ssh-host-keys')
+
+    def ready(self):
+        return uvtool.ssh._ready_key_sets(self.KEY_TYPES, self.pool_dir)
+
+    def testFillAndTake(self, keygen, start_background_fill):
+        uvtool.ssh.fill_host_key_pool(
+            self.KEY_TYPES, pool_dir=self.pool_dir, size=3)
+        self.assertEqual(len(self.ready()), 3)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(self.pool_dir).st_mode), 0o700)
+
+        keygen.reset_mock()
+        keys, known_hosts = uvtool.ssh.take_ssh_host_keys(
+            self.KEY_TYPES, pool_dir=self.pool_dir, pool_size=3)
+        # Taken from the pool, not generated
+        self.assertEqual(keygen.call_count, 0)
+        self.assertEqual(
+            sorted(keys), [
+                b'ed25519_private', b'ed25519_public',
+                b'rsa_private', b'rsa_public',
+            ]
+        )
+        self.assertEqual(known_hosts, b'ssh-rsa public\nssh-ed25519 public\n')
+        self.assertEqual(len(self.ready()), 2)
+        start_background_fill.assert_called_once_with(
+            self.KEY_TYPES, self.pool_dir, 3)
+
+        # Each set is only ever handed out once
+        other_keys, _ = uvtool.ssh.take_ssh_host_keys(
+            self.KEY_TYPES, pool_dir=self.pool_dir, pool_size=3)
+        self.assertNotEqual(keys[b'rsa_private'], other_keys[b'rsa_private'])
+
+    def testEmptyPoolGenerates(self, keygen, start_background_fill):
+        keys, _ = uvtool.ssh.take_ssh_host_keys(
+            self.KEY_TYPES, pool_dir=self.pool_dir, pool_size=3)
+        self.assertEqual(keygen.call_count, 2)
+        self.assertIn(b'rsa_private', keys)
+        self.assertTrue(start_background_fill.called)
+
+    def testOtherKeyTypesAreNotTaken(self, keygen, start_background_fill):
+        uvtool.ssh.fill_host_key_pool(
+            ['rsa'], pool_dir=self.pool_dir, size=1)
+        keygen.reset_mock()
+        uvtool.ssh.take_ssh_host_keys(
+            self.KEY_TYPES, pool_dir=self.pool_dir, pool_size=1)
+        self.assertEqual(keygen.call_count, 2)
+
+    def testPoolDisabled(self, keygen, start_background_fill):
+        uvtool.ssh.take_ssh_host_keys(
+            self.KEY_TYPES, pool_dir=self.pool_dir, pool_size=0)
+        self.assertFalse(os.path.exists(self.pool_dir))
+        self.assertFalse(start_background_fill.called)
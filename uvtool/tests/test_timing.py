@@ -0,0 +1,74 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import mock
+
+import uvtool.parallel
+import uvtool.timing
+
+
+class TestMonotonic(unittest.TestCase):
+    def testFallsBackToOsTimes(self):
+        with mock.patch('uvtool.timing.time', spec=['time']):
+            with mock.patch('os.times', return_value=(0, 0, 0, 0, 42.5)):
+                self.assertEqual(uvtool.timing.monotonic(), 42.5)
+
+
+class TestTimings(unittest.TestCase):
+    def setUp(self):
+        self.now = [100.0]
+        patch = mock.patch(
+            'uvtool.timing.monotonic', lambda: self.now[0])
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def testPhasesAreRelativeToCreationAndSorted(self):
+        timings = uvtool.timing.Timings()
+        self.now[0] = 101.5
+        with timings.phase('second'):
+            self.now[0] = 103.0
+        timings.add('first', 100.5, 101.0)
+        self.assertEqual(timings.as_dict()['phases'], [
+            {'name': 'first', 'start': 0.5, 'duration': 0.5},
+            {'name': 'second', 'start': 1.5, 'duration': 1.5},
+        ])
+
+    def testFailedPhaseIsRecorded(self):
+        timings = uvtool.timing.Timings()
+        with self.assertRaises(ValueError):
+            with timings.phase('broken'):
+                raise ValueError()
+        self.assertEqual(
+            [phase['name'] for phase in timings.as_dict()['phases']],
+            ['broken']
+        )
+
+    def testTaskGraphRecordsTasks(self):
+        timings = uvtool.timing.Timings()
+        graph = uvtool.parallel.TaskGraph()
+        graph.add('a', lambda: 1)
+        graph.add('b', lambda a: a + 1, requires=['a'])
+        self.assertEqual(graph.run(timings=timings), {'a': 1, 'b': 2})
+        self.assertEqual(
+            sorted(phase['name'] for phase in timings.as_dict()['phases']),
+            ['a', 'b']
+        )
+
+    def testNoTimings(self):
+        with uvtool.timing.phase(None, 'ignored'):
+            pass
@@ -0,0 +1,261 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import socket
+import threading
+import unittest
+
+import libvirt
+import mock
+
+import uvtool.wait
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestPollForTrue(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patches = [
+            mock.patch('uvtool.wait.monotonic', self.clock.monotonic),
+            mock.patch('uvtool.wait.time.sleep', self.clock.sleep),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def testBacksOffExponentiallyUpToInterval(self):
+        results = [False] * 7 + [True]
+        self.assertTrue(
+            uvtool.wait.poll_for_true(lambda: results.pop(0), 0.5, 60))
+        self.assertEqual(
+            [round(s, 6) for s in self.clock.sleeps],
+            [0.05, 0.1, 0.2, 0.4, 0.5, 0.5, 0.5]
+        )
+
+    def testNeverSleepsPastDeadline(self):
+        self.assertFalse(uvtool.wait.poll_for_true(lambda: False, 8, 1))
+        self.assertEqual(self.clock.now, 1001.0)
+
+    def testTimeTakenByAttemptCountsTowardsDelay(self):
+        def slow_attempt():
+            self.clock.now += 0.03
+            return len(self.clock.sleeps) == 2
+
+        self.assertTrue(uvtool.wait.poll_for_true(slow_attempt, 1, 60))
+        self.assertEqual(
+            [round(s, 6) for s in self.clock.sleeps], [0.02, 0.07])
+
+    def testCancel(self):
+        calls = []
+        self.assertFalse(uvtool.wait.poll_for_true(
+            lambda: calls.append(None),
+            1, 60,
+            cancel=lambda: len(calls) == 3,
+        ))
+        self.assertEqual(len(calls), 3)
+
+
+class TestTryConnect(unittest.TestCase):
+    def testOpenPort(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        with contextlib.closing(listener):
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            port = listener.getsockname()[1]
+            self.assertTrue(uvtool.wait.try_connect('127.0.0.1', port, 1))
+
+    def testClosedPort(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        with contextlib.closing(s):
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        self.assertFalse(uvtool.wait.try_connect('127.0.0.1', port, 1))
+
+
+class FakeLeaseModifyWaiter(object):
+    instances = []
+
+    def __init__(self, watch_files=None):
+        self.changed = threading.Event()
+        self.process_event = mock.Mock()
+        self.closed = threading.Event()
+        self.instances.append(self)
+
+    def start_watching(self):
+        pass
+
+    def wait(self, timeout):
+        if self.changed.wait(timeout):
+            self.changed.clear()
+            return True
+        return False
+
+    def close(self):
+        self.closed.set()
+
+
+class TestLeaseWatcher(unittest.TestCase):
+    def setUp(self):
+        FakeLeaseModifyWaiter.instances[:] = []
+        self.leases = {}
+        self.lookups = []
+
+        def macs_to_ips(macs, session=None):
+            self.lookups.append(sorted(macs))
+            return dict((m, self.leases[m]) for m in macs if m in self.leases)
+
+        patches = [
+            mock.patch('uvtool.wait.LeaseModifyWaiter',
+                FakeLeaseModifyWaiter),
+            mock.patch('uvtool.libvirt.macs_to_ips', macs_to_ips),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def testOneWatchServesManyWaiters(self):
+        watcher = uvtool.wait.LeaseWatcher()
+        results = {}
+        registered = threading.Semaphore(0)
+        original_lookup = watcher._lookup
+
+        def lookup(macs):
+            original_lookup(macs)
+            if len(macs) == 1:
+                registered.release()
+
+        watcher._lookup = lookup
+
+        def wait(mac):
+            results[mac] = watcher.wait(mac, 10)
+
+        threads = [
+            threading.Thread(target=wait, args=(mac,))
+            for mac in ['52:54:00:00:00:01', '52:54:00:00:00:02']
+        ]
+        for thread in threads:
+            thread.start()
+        registered.acquire()
+        registered.acquire()
+        self.leases.update({
+            '52:54:00:00:00:01': '192.168.122.11',
+            '52:54:00:00:00:02': '192.168.122.12',
+        })
+        FakeLeaseModifyWaiter.instances[0].changed.set()
+        for thread in threads:
+            thread.join(10)
+        watcher.close()
+
+        self.assertEqual(len(FakeLeaseModifyWaiter.instances), 1)
+        self.assertEqual(results, {
+            '52:54:00:00:00:01': '192.168.122.11',
+            '52:54:00:00:00:02': '192.168.122.12',
+        })
+        # After each waiter's own first check, one lookup covers both
+        self.assertEqual(
+            self.lookups[-1], ['52:54:00:00:00:01', '52:54:00:00:00:02'])
+        self.assertTrue(FakeLeaseModifyWaiter.instances[0].closed.wait(10))
+
+    def testCancel(self):
+        watcher = uvtool.wait.LeaseWatcher()
+        with contextlib.closing(watcher):
+            self.assertIsNone(watcher.wait(
+                '52:54:00:00:00:01', 10, cancel=lambda: True))
+        self.assertTrue(FakeLeaseModifyWaiter.instances[0].closed.wait(10))
+
+
+class FakeStream(object):
+    """A non-blocking libvirt stream, fed by a fake event loop."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.buffered = []
+        self.callback = None
+        self.aborted = threading.Event()
+        self.removed = False
+
+    def eventAddCallback(self, events, callback, opaque):
+        self.callback = callback
+        threading.Thread(target=self.feed).start()
+
+    def feed(self):
+        for chunk in self.chunks:
+            self.buffered.append(chunk)
+            self.callback(self, 1, None)
+
+    def recv(self, nbytes):
+        if self.buffered:
+            return self.buffered.pop(0)
+        return -2
+
+    def eventRemoveCallback(self):
+        self.removed = True
+
+    def abort(self):
+        self.aborted.set()
+
+
+@mock.patch('libvirt.VIR_STREAM_NONBLOCK', 1, create=True)
+@mock.patch('libvirt.VIR_STREAM_EVENT_READABLE', 1, create=True)
+@mock.patch('libvirt.VIR_STREAM_EVENT_ERROR', 4, create=True)
+@mock.patch('libvirt.VIR_STREAM_EVENT_HANGUP', 8, create=True)
+class TestWaitForReadyChannel(unittest.TestCase):
+    def wait(self, chunks, **kwargs):
+        stream = FakeStream(chunks)
+        session = mock.Mock()
+        session.conn.newStream.return_value = stream
+        domain = mock.Mock()
+        result = uvtool.wait.wait_for_ready_channel(
+            domain, session=session, **kwargs)
+        session.conn.newStream.assert_called_once_with(1)
+        domain.openChannel.assert_called_once_with(
+            uvtool.libvirt.READY_CHANNEL_NAME, stream, 0)
+        self.assertTrue(stream.removed)
+        self.assertTrue(stream.aborted.is_set())
+        return result
+
+    def testMessageSplitAcrossReads(self):
+        self.assertTrue(self.wait([b'boot-fin', b'ished\n'], timeout=10))
+
+    def testTimeout(self):
+        self.assertFalse(self.wait([b'noise'], timeout=0.1))
+
+    def testCancel(self):
+        self.assertFalse(self.wait([], timeout=10, cancel=lambda: True))
+
+    def testNoEventLoop(self):
+        stream = FakeStream([])
+        session = mock.Mock()
+        session.conn.newStream.return_value = stream
+        with mock.patch.object(stream, 'eventAddCallback',
+                side_effect=libvirt.libvirtError('no event loop')):
+            self.assertRaises(
+                libvirt.libvirtError, uvtool.wait.wait_for_ready_channel,
+                mock.Mock(), 10, session=session)
+        self.assertTrue(stream.aborted.is_set())
@@ -0,0 +1,256 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import libvirt
+import mock
+
+import uvtool.wait
+import uvtool.watchd
+
+
+def fake_domain(name, state=None):
+    domain = mock.Mock()
+    domain.name.return_value = name
+    domain.state.return_value = [state, 0]
+    return domain
+
+
+@mock.patch('libvirt.VIR_DOMAIN_EVENT_DEFINED', 0, create=True)
+@mock.patch('libvirt.VIR_DOMAIN_EVENT_UNDEFINED', 1, create=True)
+class TestWatchState(unittest.TestCase):
+    def state(self):
+        session = mock.Mock()
+        session.conn.listAllDomains.return_value = [
+            fake_domain('a', libvirt.VIR_DOMAIN_SHUTOFF)]
+        state = uvtool.watchd.WatchState(session)
+        state.watch_domains()
+        callback = session.conn.domainEventRegisterAny.call_args[0][2]
+        return state, lambda name, event: callback(
+            session.conn, fake_domain(name), event, 0, None)
+
+    def testEventsUpdateStates(self):
+        state, event = self.state()
+        self.assertEqual(
+            state.states(['a', 'b']), {'a': libvirt.VIR_DOMAIN_SHUTOFF})
+        event('a', libvirt.VIR_DOMAIN_EVENT_STARTED)
+        event('b', libvirt.VIR_DOMAIN_EVENT_DEFINED)
+        self.assertEqual(state.states(['a', 'b']), {
+            'a': libvirt.VIR_DOMAIN_RUNNING,
+            'b': libvirt.VIR_DOMAIN_SHUTOFF,
+        })
+        event('a', libvirt.VIR_DOMAIN_EVENT_CRASHED)
+        event('b', libvirt.VIR_DOMAIN_EVENT_UNDEFINED)
+        self.assertEqual(
+            state.states(['a', 'b']), {'a': libvirt.VIR_DOMAIN_CRASHED})
+
+    def testWaitForState(self):
+        state, event = self.state()
+        running = [libvirt.VIR_DOMAIN_RUNNING]
+        self.assertEqual(
+            state.wait_for_state('a', running, 0), libvirt.VIR_DOMAIN_SHUTOFF)
+        timer = threading.Timer(
+            0.05, event, ['a', libvirt.VIR_DOMAIN_EVENT_STARTED])
+        timer.start()
+        self.assertEqual(
+            state.wait_for_state('a', running, 10), libvirt.VIR_DOMAIN_RUNNING)
+        timer.join()
+
+    @mock.patch('uvtool.libvirt.libvirt_network_leases')
+    @mock.patch('uvtool.libvirt.dnsmasq_leases')
+    def testLeasesAreServedFromMemory(self, dnsmasq_leases,
+            libvirt_network_leases):
+        dnsmasq_leases.return_value = {'52:54:00:00:00:01': '192.168.122.11'}
+        libvirt_network_leases.return_value = {
+            '52:54:00:00:00:01': '10.0.0.1', '52:54:00:00:00:02': '10.0.0.2'}
+        state, _ = self.state()
+        state.refresh_leases()
+        state.refresh_network_leases()
+        self.assertEqual(
+            state.ips(['52:54:00:00:00:01', '52:54:00:00:00:02',
+                '52:54:00:00:00:03']),
+            {
+                '52:54:00:00:00:01': '192.168.122.11',
+                '52:54:00:00:00:02': '10.0.0.2',
+            }
+        )
+        self.assertEqual(state.wait_for_lease('52:54:00:00:00:02', 0),
+            '10.0.0.2')
+        self.assertEqual(dnsmasq_leases.call_count, 1)
+        self.assertEqual(libvirt_network_leases.call_count, 1)
+
+    @mock.patch('uvtool.libvirt.libvirt_network_leases', return_value={})
+    @mock.patch('uvtool.libvirt.dnsmasq_leases')
+    def testWaitForLease(self, dnsmasq_leases, libvirt_network_leases):
+        state, _ = self.state()
+        dnsmasq_leases.return_value = {}
+        state.refresh_leases()
+        state.refresh_network_leases()
+        self.assertIsNone(state.wait_for_lease('52:54:00:00:00:01', 0))
+
+        libvirt_network_leases.return_value = {'52:54:00:00:00:01': '10.0.0.1'}
+        timer = threading.Timer(0.05, state.refresh_network_leases)
+        timer.start()
+        self.assertEqual(
+            state.wait_for_lease('52:54:00:00:00:01', 10), '10.0.0.1')
+        timer.join()
+
+        dnsmasq_leases.return_value = {'52:54:00:00:00:02': '192.168.122.12'}
+        timer = threading.Timer(0.05, state.refresh_leases)
+        timer.start()
+        self.assertEqual(
+            state.wait_for_lease('52:54:00:00:00:02', 10), '192.168.122.12')
+        timer.join()
+        # Waiting never asks libvirt itself
+        self.assertEqual(libvirt_network_leases.call_count, 2)
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.socket_path = os.path.join(self.tmpdir, 'watchd.sock')
+        self.session = mock.Mock()
+        self.session.uri = 'qemu:///system'
+        patch = mock.patch(
+            'uvtool.watchd.default_socket_path',
+            lambda uri: self.socket_path
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def serve(self, state):
+        server = uvtool.watchd.WatchServer(self.socket_path, state)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+        self.addCleanup(stop)
+
+    @mock.patch('uvtool.wait.LeaseWatcher')
+    def testNotRunning(self, LeaseWatcher):
+        self.assertRaises(
+            uvtool.watchd.NotRunningError,
+            uvtool.watchd.macs_to_ips, ['52:54:00:00:00:01'], self.session
+        )
+        self.assertIs(
+            uvtool.watchd.lease_watcher(self.session),
+            LeaseWatcher.return_value
+        )
+
+    def testRequests(self):
+        state = mock.Mock()
+        state.ips.return_value = {'52:54:00:00:00:01': '192.168.122.11'}
+        state.states.return_value = {'a': 1}
+        state.wait_for_lease.side_effect = [None, '192.168.122.11']
+        self.serve(state)
+
+        self.assertEqual(
+            uvtool.watchd.macs_to_ips(['52:54:00:00:00:01'], self.session),
+            {'52:54:00:00:00:01': '192.168.122.11'}
+        )
+        self.assertEqual(
+            uvtool.watchd.domain_states(['a'], self.session), {'a': 1})
+        watcher = uvtool.watchd.lease_watcher(self.session)
+        self.assertIsInstance(watcher, uvtool.watchd.LeaseClient)
+        self.assertEqual(
+            watcher.wait('52:54:00:00:00:01', 10), '192.168.122.11')
+        # Each request only waits a short slice, so that clients can cancel
+        self.assertLessEqual(
+            state.wait_for_lease.call_args[0][1], uvtool.watchd.WAIT_SLICE)
+
+    def testDomainWatcher(self):
+        state = mock.Mock()
+        state.states.return_value = {'a': libvirt.VIR_DOMAIN_SHUTOFF}
+        state.wait_for_state.side_effect = [
+            libvirt.VIR_DOMAIN_SHUTOFF, libvirt.VIR_DOMAIN_RUNNING]
+        self.serve(state)
+
+        watcher = uvtool.watchd.domain_watcher(
+            fake_domain('a'), session=self.session)
+        self.assertIsInstance(watcher, uvtool.watchd.DomainStateClient)
+        self.assertTrue(watcher.is_stopped())
+        self.assertFalse(watcher.is_running())
+        self.assertTrue(watcher.wait_until_running(10))
+        self.assertEqual(state.wait_for_state.call_args[0][:2],
+            ('a', [libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_BLOCKED]))
+
+    @mock.patch('uvtool.libvirt.DomainLifecycleWatcher')
+    def testDomainWatcherNotRunning(self, DomainLifecycleWatcher):
+        self.assertIs(
+            uvtool.watchd.domain_watcher(fake_domain('a'), self.session),
+            DomainLifecycleWatcher.return_value
+        )
+
+    def testErrorsAreRaised(self):
+        state = mock.Mock()
+        state.ips.side_effect = ValueError('broken')
+        self.serve(state)
+        with self.assertRaises(uvtool.watchd.WatchdError) as cm:
+            uvtool.watchd.macs_to_ips(['52:54:00:00:00:01'], self.session)
+        self.assertNotIsInstance(cm.exception, uvtool.watchd.NotRunningError)
+
+    def testTimeout(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind(self.socket_path)
+        listener.listen(1)
+        self.assertRaises(
+            uvtool.watchd.WatchdError, uvtool.watchd._request,
+            {'op': 'states', 'names': []}, self.socket_path, timeout=0.01
+        )
+
+    def testSharedDirectoryIsNotTrusted(self):
+        self.serve(mock.Mock())
+        os.chmod(self.tmpdir, 0o755)
+        self.assertRaises(
+            uvtool.watchd.NotRunningError,
+            uvtool.watchd.macs_to_ips, ['52:54:00:00:00:01'], self.session
+        )
+        self.assertRaises(
+            uvtool.watchd.WatchdError,
+            uvtool.watchd._check_socket_dir, self.tmpdir
+        )
+        os.chmod(self.tmpdir, 0o700)
+        uvtool.watchd._check_socket_dir(self.tmpdir)
+
+    @mock.patch('uvtool.libvirt.DomainLifecycleWatcher')
+    @mock.patch('uvtool.wait.LeaseWatcher')
+    def testClientsFallBackOnErrors(self, LeaseWatcher,
+            DomainLifecycleWatcher):
+        state = mock.Mock()
+        state.states.side_effect = [{}, {}, ValueError('broken')]
+        state.wait_for_lease.side_effect = ValueError('broken')
+        self.serve(state)
+        LeaseWatcher.return_value.wait.return_value = '192.168.122.11'
+        DomainLifecycleWatcher.return_value.is_stopped.return_value = False
+
+        watcher = uvtool.watchd.lease_watcher(self.session)
+        self.assertEqual(
+            watcher.wait('52:54:00:00:00:01', 10), '192.168.122.11')
+        domain_watcher = uvtool.watchd.domain_watcher(
+            fake_domain('a'), self.session)
+        self.assertFalse(domain_watcher.is_stopped())
+        self.assertTrue(DomainLifecycleWatcher.return_value.is_stopped.called)
@@ -0,0 +1,93 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A monotonic clock, and a record of how long each phase of an operation
+took.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import contextlib
+import os
+import threading
+import time
+
+
+def monotonic():
+    """Return seconds from an arbitrary point, never going backwards.
+
+    time.monotonic only exists from Python 3.3. os.times()[4] is the
+    elapsed real time since a fixed point in the past, which is not
+    affected by changes to the system clock.
+
+    """
+    clock = getattr(time, 'monotonic', None)
+    if clock is not None:
+        return clock()
+    return os.times()[4]
+
+
+class Timings(object):
+    """The named phases of one operation, timed with the monotonic clock.
+
+    Each phase is kept as its start, counted from when the Timings was
+    created, and its duration, both in seconds. Phases may overlap and may
+    be recorded from several threads. started is the wall clock time at
+    creation, to relate the timings of operations in different processes.
+
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._origin = monotonic()
+        self._lock = threading.Lock()
+        self._phases = []
+
+    def add(self, name, start, end):
+        """Record a phase from the monotonic clock times start to end."""
+        with self._lock:
+            self._phases.append({
+                'name': name,
+                'start': round(start - self._origin, 6),
+                'duration': round(end - start, 6),
+            })
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Record the time taken by the body as the phase name."""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, start, monotonic())
+
+    def as_dict(self):
+        with self._lock:
+            phases = sorted(self._phases, key=lambda phase: phase['start'])
+        return {'started': self.started, 'phases': phases}
+
+
+@contextlib.contextmanager
+def phase(timings, name):
+    """Like Timings.phase, but timings may be None to record nothing."""
+    if timings is None:
+        yield
+    else:
+        with timings.phase(name):
+            yield
@@ -14,17 +14,22 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import collections
 import contextlib
-import functools
+import errno
 import os
+import select
 import socket
 import sys
+import threading
 import time
 
+import libvirt
 import pyinotify
 
 import uvtool.libvirt
@@ -32,9 +37,16 @@ from uvtool.libvirt import (
     LIBVIRT_DNSMASQ_LEASE_FILE,
     LIBVIRT_DNSMASQ_STATUS_FILE
 )
+from uvtool.timing import monotonic
 
 SSH_PORT = 22
 
+# The first retry comes quickly, and the delay doubles up to the interval
+INITIAL_RETRY_DELAY = 0.05
+CONNECT_ATTEMPT_TIMEOUT = 1.0
+# How often long waits check whether they should give up early
+CANCEL_CHECK_INTERVAL = 0.5
+
 
 class ProcessEvent(pyinotify.ProcessEvent):
     def _uvtool_process_generic(self, event):
@@ -78,18 +90,16 @@ class LeaseModifyWaiter(object):
                 watched_dirs.add(parent_path)
 
     def wait(self, timeout):
-        # Should use CLOCK_MONOTONIC here, but it is only available since
-        # Python 3.3.
-        deadline = time.time() + timeout
+        deadline = monotonic() + timeout
 
-        remaining_time = deadline - time.time()
+        remaining_time = deadline - monotonic()
         while remaining_time > 0:
             if self.notifier.check_events(timeout=(remaining_time*1000)):
                 self.notifier.read_events()
                 self.notifier.process_events()
                 if self.process_event._uvtool_modified:
                     return True
-            remaining_time = deadline - time.time()
+            remaining_time = deadline - monotonic()
         return False
 
     def close(self):
@@ -100,56 +110,227 @@ def lease_has_mac(mac):
     return uvtool.libvirt.mac_to_ip(mac) is not None
 
 
-def wait_for_libvirt_dnsmasq_lease(mac, timeout):
+class LeaseWatcher(object):
+    """Wait for the leases of many MAC addresses with one inotify watch.
+
+    A single thread follows changes to the lease files. On each change it
+    looks up every MAC address still being waited for in one batch, and
+    wakes the waiters whose addresses got a lease.
+
+    """
+
+    def __init__(self, watch_files=None, session=None):
+        self.session = session
+        self._condition = threading.Condition()
+        self._pending = collections.Counter()
+        self._ips = {}
+        self._closed = threading.Event()
+        self._waiter = LeaseModifyWaiter(watch_files)
+        self._waiter.start_watching()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _lookup(self, macs):
+        ips = uvtool.libvirt.macs_to_ips(macs, session=self.session)
+        with self._condition:
+            self._ips.update(ips)
+            self._condition.notify_all()
+
+    def _run(self):
+        with contextlib.closing(self._waiter):
+            while not self._closed.is_set():
+                if not self._waiter.wait(timeout=CANCEL_CHECK_INTERVAL):
+                    continue
+                self._waiter.process_event._uvtool_modified = False
+                with self._condition:
+                    macs = list(self._pending)
+                if not macs:
+                    continue
+                try:
+                    self._lookup(macs)
+                except Exception:
+                    # Leave it to the next change to try again, rather than
+                    # stopping the watch for every waiter
+                    pass
+
+    def wait(self, mac, timeout, cancel=None):
+        """Return the IP address leased to mac, or None if there is none.
+
+        cancel, if given, is called every so often; once it returns True,
+        stop waiting and return None.
+
+        """
+        deadline = monotonic() + timeout
+        with self._condition:
+            self._pending[mac] += 1
+        try:
+            # Check after registering to avoid the race of a lease arriving
+            # between the last check and this waiter being known
+            self._lookup([mac])
+            with self._condition:
+                while mac not in self._ips:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return None
+                    if cancel is not None and cancel():
+                        return None
+                    self._condition.wait(
+                        min(remaining, CANCEL_CHECK_INTERVAL))
+                return self._ips[mac]
+        finally:
+            with self._condition:
+                self._pending[mac] -= 1
+                if not self._pending[mac]:
+                    del self._pending[mac]
+
+    def close(self):
+        """Stop watching, without waiting for the watching thread to exit."""
+        self._closed.set()
+
+
+def wait_for_libvirt_dnsmasq_lease(mac, timeout, cancel=None):
+    """Wait for mac to get a lease, and return True if it did.
+
+    cancel is as for LeaseWatcher.wait.
+
+    """
     # Shortcut check to save inotify setup
     if lease_has_mac(mac):
         return True
 
-    timeout_time = time.time() + timeout
-    waiter = LeaseModifyWaiter()
-    with contextlib.closing(waiter):
-        waiter.start_watching()
-        # Check after we've set up a watch to avoid the race of something
-        # happening between the last check and the watch starting
-        if lease_has_mac(mac):
-            return True
-        current_time = time.time()
-        while current_time < timeout_time:
-            remaining_time_to_timeout = timeout_time - current_time
-            waiter.wait(timeout=remaining_time_to_timeout)
-            if lease_has_mac(mac):
-                return True
-            current_time = time.time()
-        return False
+    watcher = LeaseWatcher()
+    with contextlib.closing(watcher):
+        return watcher.wait(mac, timeout, cancel=cancel) is not None
 
 
-def has_open_ssh_port(host, timeout=4):
+def wait_for_ready_channel(domain, timeout, cancel=None, session=None):
+    """Wait for domain to announce over its ready channel that it booted.
+
+    Return True if it did. libvirt relays the channel, so this needs no
+    network access to the guest and works with remote libvirt URIs. The
+    channel is read without blocking, as libvirt's event loop reports it
+    readable, so uvtool.libvirt.start_event_loop must have been called
+    before the session's connection was opened.
+
+    Raise libvirt.libvirtError if the channel cannot be opened, for
+    example because something else has it open, or cannot be followed
+    because there is no event loop. cancel is as for LeaseWatcher.wait.
+
+    """
+    conn = uvtool.libvirt._session(session).conn
+    stream = conn.newStream(libvirt.VIR_STREAM_NONBLOCK)
+    received = [b'']
+    ready = threading.Event()
+    done = threading.Event()
+
+    def readable(stream, events, opaque):
+        try:
+            while not done.is_set():
+                chunk = stream.recv(4096)
+                if chunk == -2:
+                    # Nothing more until the next event
+                    return
+                if not chunk:
+                    done.set()
+                    return
+                received[0] = (received[0] + chunk)[-4096:]
+                if uvtool.libvirt.READY_MESSAGE in received[0]:
+                    ready.set()
+                    done.set()
+        except libvirt.libvirtError:
+            # The guest went away, or the stream was aborted
+            done.set()
+
+    try:
+        domain.openChannel(uvtool.libvirt.READY_CHANNEL_NAME, stream, 0)
+        stream.eventAddCallback(
+            libvirt.VIR_STREAM_EVENT_READABLE |
+                libvirt.VIR_STREAM_EVENT_ERROR |
+                libvirt.VIR_STREAM_EVENT_HANGUP,
+            readable, None
+        )
+    except libvirt.libvirtError:
+        _abort_stream(stream)
+        raise
+
+    deadline = monotonic() + timeout
+    try:
+        while not done.is_set():
+            remaining = deadline - monotonic()
+            if remaining <= 0 or (cancel is not None and cancel()):
+                break
+            done.wait(min(remaining, CANCEL_CHECK_INTERVAL))
+    finally:
+        done.set()
+        try:
+            stream.eventRemoveCallback()
+        except libvirt.libvirtError:
+            pass
+        _abort_stream(stream)
+    return ready.is_set()
+
+
+def _abort_stream(stream):
+    # Nothing is ever sent to the guest, so there is nothing to flush
+    try:
+        stream.abort()
+    except libvirt.libvirtError:
+        pass
+
+
+def try_connect(host, port, timeout):
+    """Return True if a TCP connection to host and port opens in time."""
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     with contextlib.closing(s):
-        s.settimeout(timeout)
+        s.setblocking(0)
+        error = s.connect_ex((host, port))
+        if error == 0:
+            return True
+        if error not in [errno.EINPROGRESS, errno.EWOULDBLOCK]:
+            return False
         try:
-            s.connect((host, SSH_PORT))
-        except:
+            writable = select.select([], [s], [], timeout)[1]
+        except select.error:
             return False
-        else:
-            return True
+        return bool(writable) and s.getsockopt(
+            socket.SOL_SOCKET, socket.SO_ERROR) == 0
+
+
+def has_open_ssh_port(host, timeout=4):
+    return try_connect(host, SSH_PORT, timeout)
 
 
-def poll_for_true(fn, interval, timeout):
-    timeout_time = time.time() + timeout
-    while time.time() < timeout_time:
+def poll_for_true(fn, interval, timeout, cancel=None):
+    """Call fn until it returns True, and return whether it did in time.
+
+    Retries start after INITIAL_RETRY_DELAY, with the delay doubling up to
+    interval. The time taken by fn itself counts towards the delay, and no
+    delay goes beyond the timeout. cancel is as for
+    wait_for_libvirt_dnsmasq_lease.
+
+    """
+    deadline = monotonic() + timeout
+    delay = min(INITIAL_RETRY_DELAY, interval)
+    while True:
+        started = monotonic()
         if fn():
             return True
-        # This could do with a little more care to ensure that we never
-        # sleep beyond timeout_time.
-        time.sleep(interval)
-    return False
+        if cancel is not None and cancel():
+            return False
+        now = monotonic()
+        if now >= deadline:
+            return False
+        time.sleep(max(0, min(started + delay, deadline) - now))
+        delay = min(delay * 2, interval)
 
 
-def wait_for_open_ssh_port(host, interval, timeout):
+def wait_for_open_ssh_port(host, interval, timeout, cancel=None):
+    deadline = monotonic() + timeout
     return poll_for_true(
-        functools.partial(has_open_ssh_port, host),
-        interval, timeout
+        lambda: has_open_ssh_port(host, timeout=max(0, min(
+            CONNECT_ATTEMPT_TIMEOUT, deadline - monotonic()))),
+        interval, timeout, cancel=cancel
     )
 
 
@@ -177,7 +358,7 @@ def main():
 
     ssh_parser = subparsers.add_parser('ssh')
     ssh_parser.set_defaults(func=main_ssh)
-    ssh_parser.add_argument('--interval', type=float, default=8.0)
+    ssh_parser.add_argument('--interval', type=float, default=1.0)
     ssh_parser.add_argument('host')
 
     args = parser.parse_args()
@@ -0,0 +1,521 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""An optional daemon that keeps DHCP leases and domain states at hand.
+
+Without it, every uvt-kvm process reads the dnsmasq files and asks libvirt
+afresh. watchd follows the lease files with inotify and the domains with
+libvirt lifecycle events, and polls the DHCP leases of the other libvirt
+networks on a timer, whatever the number of clients. It answers lookups
+and waits for leases from memory over a unix socket, without asking
+libvirt anything per request. Each request is one line of JSON, answered by
+one line of JSON:
+
+    {"op": "ips", "macs": [MAC, ...]}  ->  {"ips": {MAC: IP, ...}}
+    {"op": "states", "names": [NAME, ...]}  ->  {"states": {NAME: STATE}}
+    {"op": "wait-lease", "mac": MAC, "timeout": SECONDS}  ->  {"ip": IP}
+    {"op": "wait-state", "name": NAME, "states": [STATE, ...],
+        "timeout": SECONDS}  ->  {"state": STATE}
+
+States are libvirt's VIR_DOMAIN_* numbers; an unknown domain is left out,
+or null. The waits answer as soon as there is a lease, or the domain is in
+one of the given states, or with what there is once the timeout passes.
+Failed requests are answered with {"error": MESSAGE}.
+
+Each libvirt URI has its own daemon and socket. The socket lives in a
+directory that only its user can use, and neither side goes near a socket
+in a directory that anybody else owns or could write to. The client
+functions here raise NotRunningError when there is no daemon that can be
+trusted, and WatchdError when it fails, so that callers can fall back to
+doing the work themselves.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import contextlib
+import errno
+import hashlib
+import json
+import os
+import socket
+import stat
+import SocketServer
+import threading
+import time
+
+import libvirt
+
+import uvtool.libvirt
+import uvtool.wait
+from uvtool.timing import monotonic
+
+# The lease files are read again after this long even without any change
+# notification, in case one was missed
+LEASE_REFRESH_INTERVAL = 60
+# Networks other than the default one have no local files to follow, so
+# their leases are asked from libvirt this often instead
+NETWORK_LEASE_REFRESH_INTERVAL = 2
+CLIENT_TIMEOUT = 5
+# How long a single wait-lease request lasts at most, so that clients can
+# give up early
+WAIT_SLICE = uvtool.wait.CANCEL_CHECK_INTERVAL
+
+
+class WatchdError(RuntimeError):
+    pass
+
+
+class NotRunningError(WatchdError):
+    pass
+
+
+def default_socket_path(uri):
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        socket_dir = os.path.join(runtime_dir, 'uvtool')
+    else:
+        # Anybody can create this before we do; _check_socket_dir will
+        # refuse it then
+        socket_dir = '/tmp/uvtool-%d' % os.getuid()
+    uri_hash = hashlib.sha1(uri.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(socket_dir, 'watchd-%s.sock' % uri_hash)
+
+
+def _check_socket_dir(socket_dir):
+    """Raise WatchdError unless socket_dir is a real directory that is
+    owned by this user and that nobody else can use.
+
+    """
+    st = os.lstat(socket_dir)
+    if not stat.S_ISDIR(st.st_mode):
+        raise WatchdError("%s is not a directory." % repr(socket_dir))
+    if st.st_uid != os.getuid():
+        raise WatchdError(
+            "%s is owned by uid %d." % (repr(socket_dir), st.st_uid))
+    if stat.S_IMODE(st.st_mode) & 0o077:
+        raise WatchdError("%s has mode %o; it must be 0700." % (
+            repr(socket_dir), stat.S_IMODE(st.st_mode)))
+
+
+# What the domain's state is after each lifecycle event
+_EVENT_STATES = {
+    'VIR_DOMAIN_EVENT_STARTED': 'VIR_DOMAIN_RUNNING',
+    'VIR_DOMAIN_EVENT_RESUMED': 'VIR_DOMAIN_RUNNING',
+    'VIR_DOMAIN_EVENT_SUSPENDED': 'VIR_DOMAIN_PAUSED',
+    'VIR_DOMAIN_EVENT_STOPPED': 'VIR_DOMAIN_SHUTOFF',
+    'VIR_DOMAIN_EVENT_CRASHED': 'VIR_DOMAIN_CRASHED',
+    'VIR_DOMAIN_EVENT_PMSUSPENDED': 'VIR_DOMAIN_PMSUSPENDED',
+}
+
+
+class WatchState(object):
+    """The leases and domain states that watchd keeps up to date."""
+
+    def __init__(self, session):
+        self.session = session
+        self._condition = threading.Condition()
+        self._file_ips = {}
+        self._network_ips = {}
+        self._states = {}
+        self._event_states = dict(
+            (getattr(libvirt, event), getattr(libvirt, state))
+            for event, state in _EVENT_STATES.items()
+            if hasattr(libvirt, event)
+        )
+
+    def refresh_leases(self):
+        ips = uvtool.libvirt.dnsmasq_leases()
+        with self._condition:
+            self._file_ips = ips
+            self._condition.notify_all()
+
+    def refresh_network_leases(self):
+        ips = uvtool.libvirt.libvirt_network_leases(session=self.session)
+        with self._condition:
+            self._network_ips = ips
+            self._condition.notify_all()
+
+    def watch_domains(self):
+        """Follow domain lifecycle events, then read the current states.
+
+        uvtool.libvirt.start_event_loop must have been called before the
+        session's connection was opened.
+
+        """
+        conn = self.session.conn
+        conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+            self._lifecycle_event, None
+        )
+        # Only read the states once registered, so that no change can fall
+        # between the two
+        for domain in conn.listAllDomains(0):
+            try:
+                state = domain.state(0)[0]
+            except libvirt.libvirtError:
+                continue
+            with self._condition:
+                self._states.setdefault(domain.name(), state)
+
+    def _lifecycle_event(self, conn, domain, event, detail, opaque):
+        name = domain.name()
+        with self._condition:
+            if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+                self._states.pop(name, None)
+            elif event == libvirt.VIR_DOMAIN_EVENT_DEFINED:
+                self._states.setdefault(name, libvirt.VIR_DOMAIN_SHUTOFF)
+            elif event in self._event_states:
+                self._states[name] = self._event_states[event]
+            self._condition.notify_all()
+
+    def _ip(self, mac):
+        # The same order as uvtool.libvirt.macs_to_ips; the caller must
+        # hold the condition
+        return (
+            self._file_ips.get(mac.lower()) or
+            self._network_ips.get(mac.lower())
+        )
+
+    def ips(self, macs):
+        with self._condition:
+            return dict(
+                (mac, self._ip(mac)) for mac in macs if self._ip(mac))
+
+    def states(self, names):
+        with self._condition:
+            return dict(
+                (name, self._states[name])
+                for name in names if name in self._states
+            )
+
+    def wait_for_state(self, name, states, timeout):
+        deadline = monotonic() + timeout
+        with self._condition:
+            while self._states.get(name) not in states:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._states.get(name)
+
+    def wait_for_lease(self, mac, timeout):
+        deadline = monotonic() + timeout
+        with self._condition:
+            while not self._ip(mac):
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._ip(mac)
+
+
+class WatchRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        state = self.server.state
+        try:
+            request = json.loads(self.rfile.readline())
+            op = request['op']
+            if op == 'ips':
+                response = {'ips': state.ips(request['macs'])}
+            elif op == 'states':
+                response = {'states': state.states(request['names'])}
+            elif op == 'wait-lease':
+                response = {'ip': state.wait_for_lease(
+                    request['mac'], min(float(request['timeout']), WAIT_SLICE))}
+            elif op == 'wait-state':
+                response = {'state': state.wait_for_state(
+                    request['name'], request['states'],
+                    min(float(request['timeout']), WAIT_SLICE))}
+            else:
+                response = {'error': 'unknown op %s' % repr(op)}
+        except Exception as e:
+            response = {'error': str(e)}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class WatchServer(SocketServer.ThreadingMixIn,
+        SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, state):
+        self.state = state
+        SocketServer.UnixStreamServer.__init__(
+            self, socket_path, WatchRequestHandler)
+
+
+def _follow_leases(state):
+    waiter = uvtool.wait.LeaseModifyWaiter()
+    with contextlib.closing(waiter):
+        waiter.start_watching()
+        while True:
+            waiter.wait(timeout=LEASE_REFRESH_INTERVAL)
+            waiter.process_event._uvtool_modified = False
+            state.refresh_leases()
+
+
+def _poll_network_leases(state):
+    while True:
+        time.sleep(NETWORK_LEASE_REFRESH_INTERVAL)
+        try:
+            state.refresh_network_leases()
+        except libvirt.libvirtError:
+            # Keep the last known leases; a lost connection stops the
+            # server anyway
+            pass
+
+
+def _remove_stale_socket(socket_path):
+    try:
+        _request({'op': 'states', 'names': []}, socket_path)
+    except NotRunningError:
+        try:
+            os.unlink(socket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    else:
+        raise RuntimeError(
+            "watchd is already running on %s." % repr(socket_path))
+
+
+def serve(uri, socket_path=None):
+    """Serve lookups for uri on a unix socket until interrupted."""
+    if socket_path is None:
+        socket_path = default_socket_path(uri)
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    try:
+        os.makedirs(socket_dir, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    _check_socket_dir(socket_dir)
+    _remove_stale_socket(socket_path)
+
+    # Must come before the connection is opened for events to be delivered
+    uvtool.libvirt.start_event_loop()
+    session = uvtool.libvirt.get_session(uri)
+    state = WatchState(session)
+    state.watch_domains()
+    state.refresh_leases()
+    state.refresh_network_leases()
+    for target in [_follow_leases, _poll_network_leases]:
+        thread = threading.Thread(target=target, args=(state,))
+        thread.daemon = True
+        thread.start()
+
+    old_umask = os.umask(0o077)
+    try:
+        server = WatchServer(socket_path, state)
+    finally:
+        os.umask(old_umask)
+    # Stop, so that clients fall back to libvirt directly, rather than
+    # serve states that libvirt events no longer update
+    session.conn.registerCloseCallback(
+        lambda conn, reason, opaque: threading.Thread(
+            target=server.shutdown).start(),
+        None
+    )
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def _request(request, socket_path, timeout=CLIENT_TIMEOUT):
+    try:
+        _check_socket_dir(os.path.dirname(os.path.abspath(socket_path)))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        raise NotRunningError(socket_path)
+    except WatchdError as e:
+        # Whoever listens there may not be watchd
+        raise NotRunningError(str(e))
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with contextlib.closing(s):
+        s.settimeout(timeout)
+        try:
+            s.connect(socket_path)
+        except socket.error as e:
+            if e.errno in [errno.ENOENT, errno.ECONNREFUSED]:
+                raise NotRunningError(socket_path)
+            raise WatchdError("watchd: %s" % e)
+        try:
+            s.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            with contextlib.closing(s.makefile('rb')) as f:
+                line = f.readline()
+        except socket.error as e:
+            # Including socket.timeout
+            raise WatchdError("watchd: %s" % e)
+    if not line:
+        raise NotRunningError(socket_path)
+    try:
+        response = json.loads(line)
+    except ValueError as e:
+        raise WatchdError("watchd: %s" % e)
+    if 'error' in response:
+        raise WatchdError("watchd: %s" % response['error'])
+    return response
+
+
+def _session_socket_path(session):
+    return default_socket_path(uvtool.libvirt._session(session).uri)
+
+
+def macs_to_ips(macs, session=None):
+    """As uvtool.libvirt.macs_to_ips, but answered by watchd."""
+    return _request(
+        {'op': 'ips', 'macs': list(macs)}, _session_socket_path(session)
+    )['ips']
+
+
+def domain_states(names, session=None):
+    """Return the libvirt state of each of names that exists, by name."""
+    return _request(
+        {'op': 'states', 'names': list(names)}, _session_socket_path(session)
+    )['states']
+
+
+class LeaseClient(object):
+    """A uvtool.wait.LeaseWatcher that leaves the watching to watchd."""
+
+    def __init__(self, session=None):
+        self.session = uvtool.libvirt._session(session)
+        self.socket_path = _session_socket_path(self.session)
+        self._fallback = None
+        self._fallback_lock = threading.Lock()
+        # Fail now, while the caller can still fall back
+        _request({'op': 'states', 'names': []}, self.socket_path)
+
+    def _fall_back(self):
+        with self._fallback_lock:
+            if self._fallback is None:
+                self._fallback = uvtool.wait.LeaseWatcher(
+                    session=self.session)
+            return self._fallback
+
+    def wait(self, mac, timeout, cancel=None):
+        deadline = monotonic() + timeout
+        while True:
+            remaining = max(0, deadline - monotonic())
+            if self._fallback is not None:
+                return self._fallback.wait(mac, remaining, cancel)
+            try:
+                ip = _request(
+                    {'op': 'wait-lease', 'mac': mac, 'timeout': remaining},
+                    self.socket_path, timeout=remaining + CLIENT_TIMEOUT,
+                )['ip']
+            except WatchdError:
+                # watchd went away or broke; carry on without it
+                return self._fall_back().wait(mac, remaining, cancel)
+            if ip is not None or remaining <= 0:
+                return ip
+            if cancel is not None and cancel():
+                return None
+
+    def close(self):
+        if self._fallback is not None:
+            self._fallback.close()
+
+
+def lease_watcher(session=None):
+    """Return a LeaseClient if watchd is running, or else a LeaseWatcher."""
+    try:
+        return LeaseClient(session=session)
+    except NotRunningError:
+        return uvtool.wait.LeaseWatcher(session=session)
+
+
+class DomainStateClient(object):
+    """A uvtool.libvirt.DomainLifecycleWatcher that asks watchd."""
+
+    RUNNING_STATES = uvtool.libvirt.DomainLifecycleWatcher.RUNNING_STATES
+    STOPPED_STATES = uvtool.libvirt.DomainLifecycleWatcher.STOPPED_STATES
+
+    def __init__(self, domain, session=None):
+        self.domain = domain
+        self.name = domain.name()
+        self.session = uvtool.libvirt._session(session)
+        self.socket_path = _session_socket_path(self.session)
+        self._fallback = None
+        # Fail now, while the caller can still fall back
+        self._state()
+
+    def _state(self):
+        return domain_states([self.name], session=self.session).get(self.name)
+
+    def _fall_back(self):
+        # watchd went away or broke; carry on without it
+        if self._fallback is None:
+            self._fallback = uvtool.libvirt.DomainLifecycleWatcher(
+                self.domain, session=self.session)
+        return self._fallback
+
+    def is_running(self):
+        if self._fallback is None:
+            try:
+                return self._state() in self.RUNNING_STATES
+            except WatchdError:
+                pass
+        return self._fall_back().is_running()
+
+    def is_stopped(self):
+        if self._fallback is None:
+            try:
+                return self._state() in self.STOPPED_STATES
+            except WatchdError:
+                pass
+        return self._fall_back().is_stopped()
+
+    def wait_until_running(self, timeout):
+        deadline = monotonic() + timeout
+        while True:
+            remaining = max(0, deadline - monotonic())
+            if self._fallback is not None:
+                return self._fallback.wait_until_running(remaining)
+            try:
+                state = _request(
+                    {
+                        'op': 'wait-state', 'name': self.name,
+                        'states': self.RUNNING_STATES, 'timeout': remaining,
+                    },
+                    self.socket_path, timeout=remaining + CLIENT_TIMEOUT,
+                )['state']
+            except WatchdError:
+                return self._fall_back().wait_until_running(remaining)
+            if state in self.RUNNING_STATES:
+                return True
+            if remaining <= 0:
+                return False
+
+    def close(self):
+        if self._fallback is not None:
+            self._fallback.close()
+
+
+def domain_watcher(domain, session=None):
+    """Return a DomainStateClient if watchd is running, or else a
+    uvtool.libvirt.DomainLifecycleWatcher.
+
+    """
+    try:
+        return DomainStateClient(domain, session=session)
+    except NotRunningError:
+        return uvtool.libvirt.DomainLifecycleWatcher(domain, session=session)